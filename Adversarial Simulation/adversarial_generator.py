@@ -0,0 +1,414 @@
+import os
+import re
+import json
+import random
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+MASK = "[MASKED]"
+PHRASE_MASK = "[PHRASE MASKED]"
+SENTENCE_MASK = "[SENTENCE MASKED]"
+
+SPEAKER_LABELS = ("Doctor", "Patient")
+NEGATIONS = [
+    "not", "no", "never", "none", "nor", "without", "cannot", "denies", "denied",
+    "don't", "doesn't", "didn't", "isn't", "wasn't", "aren't", "weren't", "can't", "couldn't",
+    "won't", "wouldn't", "shouldn't", "haven't", "hasn't", "hadn't",
+]
+
+# Default insertion templates; override any of them with a JSON file (see load_templates)
+DEFAULT_TEMPLATES = {
+    "distractors": [
+        "The local football team won their game last night with a final score of {home}-{away}.",
+        "By the way, the parking garage on the corner is closing at {hour} tonight.",
+        "My neighbour just adopted a puppy and named it after a {team} player.",
+        "Did you see that the weather is supposed to hit {degrees} degrees this weekend?",
+        "I finally finished painting the kitchen {color} last Sunday.",
+    ],
+    "vital_signs": [
+        {"template": "Blood pressure: {systolic}/{diastolic} mmHg.", "ranges": {"systolic": [400, 600], "diastolic": [250, 350]}},
+        {"template": "The patient's temperature is recorded at {degrees} degrees Celsius.", "ranges": {"degrees": [5, 15]}},
+        {"template": "Heart rate is {rate} beats per minute.", "ranges": {"rate": [350, 500]}},
+        {"template": "Oxygen saturation is {saturation}% on room air.", "ranges": {"saturation": [130, 200]}},
+        {"template": "Blood glucose came back at {glucose} mg/dL.", "ranges": {"glucose": [3000, 9000]}},
+    ],
+    "profanity": [
+        "This pain is {word} unbearable, I just can't handle it anymore!",
+        "I'm so {word} tired of waiting for these results.",
+        "These {word} pills aren't doing anything.",
+        "Honestly, this whole thing is {word} ridiculous.",
+    ],
+    "profanity_words": ["damn", "bloody", "freaking", "goddamn", "crappy"],
+    "fillers": {
+        "home": [1, 5], "away": [0, 4], "hour": ["8", "9", "10", "11"], "degrees": [60, 95],
+        "team": ["soccer", "baseball", "hockey"], "color": ["blue", "yellow", "green"],
+    },
+}
+
+LINE_PATTERN = re.compile(r"[^\n]+")
+SENTENCE_PATTERN = re.compile(r"[^.!?\s][^.!?]*(?:[.!?]+|$)")
+WORD_PATTERN = re.compile(r"[\w']+")
+
+#################################### Text Spans ########################################
+def load_templates(path=None):
+    """
+    The insertion templates: the defaults, with any keys from a JSON file replacing them.
+    """
+    templates = json.loads(json.dumps(DEFAULT_TEMPLATES))
+    if path:
+        with open(path, "r", encoding="utf-8") as file:
+            templates.update(json.load(file))
+    return templates
+
+def content_spans(text, labels=SPEAKER_LABELS):
+    """
+    Split a transcript into lines, separating any "Doctor:"/"Patient:" label from the spoken content.
+
+    Returns:
+    - list of dict: One per non-empty line, with "label" (or None), "label_start", "label_end",
+      "start" and "end" of the content.
+    """
+    label_pattern = re.compile(rf"^[ \t]*({'|'.join(map(re.escape, labels))})[ \t]*:[ \t]*", re.IGNORECASE)
+    lines = []
+    for match in LINE_PATTERN.finditer(text):
+        label = label_pattern.match(match.group())
+        lines.append({
+            "label": label.group(1) if label else None,
+            "label_start": match.start() + label.start(1) if label else None,
+            "label_end": match.start() + label.end(1) if label else None,
+            "start": match.start() + (label.end() if label else 0),
+            "end": match.end(),
+        })
+    return lines
+
+def sentence_spans(text, lines):
+    # Sentences of the spoken content: runs ending in ., ! or ? (or the end of the line)
+    spans = []
+    for line in lines:
+        for match in SENTENCE_PATTERN.finditer(text, line["start"], line["end"]):
+            spans.append({"start": match.start(), "end": match.end(), "label": line["label"]})
+    return spans
+
+def word_spans(text, sentences):
+    words = []
+    for index, sentence in enumerate(sentences):
+        for match in WORD_PATTERN.finditer(text, sentence["start"], sentence["end"]):
+            words.append({"start": match.start(), "end": match.end(), "sentence": index})
+    return words
+
+def parse_transcript(text):
+    """
+    Locate the lines, sentences and words of a transcript once, for all the variants made from it.
+
+    Returns:
+    - dict: "lines" (see content_spans), "sentences" and "words", each a list of spans.
+    """
+    lines = content_spans(text)
+    sentences = sentence_spans(text, lines)
+    return {"lines": lines, "sentences": sentences, "words": word_spans(text, sentences)}
+
+def apply_edits(text, edits):
+    """
+    Apply non-overlapping edits and record where each one ended up.
+
+    Parameters:
+    - text (str): The original text.
+    - edits (list of dict): Each with "start", "end" (the replaced span of the original, equal for an
+      insertion) and "replacement", plus any descriptive fields to carry into the ground truth.
+
+    Returns:
+    - tuple: The new text, and the edits in text order with "original", "output_start" and "output_end" added.
+    """
+    pieces, changes, position, shift = [], [], 0, 0
+    for edit in sorted(edits, key=lambda edit: (edit["start"], edit["end"])):
+        pieces.append(text[position:edit["start"]])
+        output_start = edit["start"] + shift
+        pieces.append(edit["replacement"])
+        changes.append({
+            **edit,
+            "original": text[edit["start"]:edit["end"]],
+            "output_start": output_start,
+            "output_end": output_start + len(edit["replacement"]),
+        })
+        shift += len(edit["replacement"]) - (edit["end"] - edit["start"])
+        position = edit["end"]
+    pieces.append(text[position:])
+    return "".join(pieces), changes
+
+def fill(template, rng, ranges):
+    # Fill each {field} from its range: [low, high] draws an integer, any other list picks an item
+    values = {}
+    for field in re.findall(r"{(\w+)}", template):
+        choices = ranges.get(field, [0, 9])
+        if len(choices) == 2 and all(isinstance(value, int) for value in choices):
+            values[field] = rng.randint(*choices)
+        else:
+            values[field] = rng.choice(choices)
+    return template.format(**values)
+
+#################################### Perturbations ########################################
+def random_masking(text, spans, rng, templates, rate=0.1, weights=(0.6, 0.3, 0.1)):
+    """
+    Mask about rate of the words with [MASKED] (single words), [PHRASE MASKED] (2-4 words) and
+    [SENTENCE MASKED] (whole sentences), chosen in the proportions given by weights.
+    """
+    sentences, words = spans["sentences"], spans["words"]
+    if not words:
+        return []
+    sentence_words = {}
+    for index, word in enumerate(words):
+        sentence_words.setdefault(word["sentence"], []).append(index)
+    target = max(1, round(rate * len(words)))
+    used = set()
+    edits = []
+    masked = 0
+    for _ in range(20 * target):
+        if masked >= target:
+            break
+        kind = rng.choices(["word", "phrase", "sentence"], weights=weights)[0]
+        if kind == "sentence":
+            sentence = rng.randrange(len(sentences))
+            indices = sentence_words.get(sentence, [])
+            start, end, replacement = sentences[sentence]["start"], sentences[sentence]["end"], SENTENCE_MASK
+        else:
+            length = 1 if kind == "word" else rng.randint(2, 4)
+            first = rng.randrange(len(words))
+            indices = list(range(first, first + length))
+            if indices[-1] >= len(words) or words[indices[-1]]["sentence"] != words[first]["sentence"]:
+                continue
+            start, end = words[first]["start"], words[indices[-1]]["end"]
+            replacement = MASK if kind == "word" else PHRASE_MASK
+        # Skip units that overlap an earlier mask (or sentences too long to stay near the target rate)
+        if not indices or used.intersection(indices) or masked + len(indices) > 2 * target:
+            continue
+        used.update(indices)
+        masked += len(indices)
+        edits.append({"kind": kind, "start": start, "end": end, "replacement": replacement, "words": len(indices)})
+    return edits
+
+def negation_masking(text, spans, rng, templates, rate=0.5):
+    """
+    Mask a random selection (at least one) of the negations ("not", "no", "didn't", ...) with [MASKED].
+    """
+    negations = set(templates.get("negations", NEGATIONS))
+    candidates = [word for word in spans["words"] if text[word["start"]:word["end"]].lower() in negations]
+    if not candidates:
+        return []
+    chosen = rng.sample(candidates, max(1, round(rate * len(candidates))))
+    return [
+        {"kind": "negation", "start": word["start"], "end": word["end"], "replacement": MASK, "words": 1}
+        for word in chosen
+    ]
+
+def incorrect_diarization(text, spans, rng, templates, rate=0.2):
+    """
+    Swap the "Doctor"/"Patient" label of a random selection (at least one) of the labelled lines.
+    """
+    lines = [line for line in spans["lines"] if line["label"]]
+    if not lines:
+        return []
+    edits = []
+    for line in rng.sample(lines, max(1, round(rate * len(lines)))):
+        original = line["label"]
+        swapped = SPEAKER_LABELS[1] if original.lower() == SPEAKER_LABELS[0].lower() else SPEAKER_LABELS[0]
+        edits.append({
+            "kind": "speaker_swap", "start": line["label_start"], "end": line["label_end"],
+            "replacement": swapped, "from_label": original, "to_label": swapped,
+        })
+    return edits
+
+def _insertions(rng, sentences, count, make_sentence, kind):
+    if not sentences:
+        return []
+    edits = []
+    for sentence in rng.sample(sentences, min(count, len(sentences))):
+        inserted = make_sentence()
+        edits.append({
+            "kind": kind, "start": sentence["end"], "end": sentence["end"],
+            "replacement": " " + inserted, "inserted": inserted, "speaker": sentence["label"],
+        })
+    return edits
+
+def irrelevant_content(text, spans, rng, templates, count=2):
+    """
+    Insert unrelated small talk (the distractor templates) after random sentences.
+    """
+    return _insertions(
+        rng, spans["sentences"], count,
+        lambda: fill(rng.choice(templates["distractors"]), rng, templates["fillers"]), "distractor"
+    )
+
+def unrealistic_lab_values(text, spans, rng, templates, count=1):
+    """
+    Insert physiologically impossible vital signs or lab values after random sentences.
+    """
+    def make_sentence():
+        vital = rng.choice(templates["vital_signs"])
+        return fill(vital["template"], rng, vital["ranges"])
+
+    return _insertions(rng, spans["sentences"], count, make_sentence, "vital_sign")
+
+def inappropriate_language(text, spans, rng, templates, count=2):
+    """
+    Insert profanity at random points of the patient's speech (anywhere, if the lines are not labelled).
+    """
+    sentences = spans["sentences"]
+    patient = [sentence for sentence in sentences if (sentence["label"] or "").lower() == SPEAKER_LABELS[1].lower()]
+    words = []
+
+    def make_sentence():
+        words.append(rng.choice(templates["profanity_words"]))
+        return rng.choice(templates["profanity"]).format(word=words[-1])
+
+    edits = _insertions(rng, patient or sentences, count, make_sentence, "profanity")
+    for edit, word in zip(edits, words):
+        edit["profanity"] = word
+    return edits
+
+# The six tests of the README's Adversarial Simulation table
+TESTS = {
+    "random_masking": random_masking,
+    "negation_masking": negation_masking,
+    "incorrect_diarization": incorrect_diarization,
+    "irrelevant_content": irrelevant_content,
+    "unrealistic_lab_values": unrealistic_lab_values,
+    "inappropriate_language": inappropriate_language,
+}
+
+#################################### Generation ########################################
+def generate_variant(text, test, seed, templates=None, spans=None, **options):
+    """
+    Produce one adversarial variant of a transcript.
+
+    Parameters:
+    - text (str): The original transcript.
+    - test (str): One of the TESTS.
+    - seed (str or int): Seed for this variant; the same seed always gives the same variant.
+    - templates (dict, optional): Insertion templates (default: load_templates()).
+    - spans (dict, optional): The transcript's parse_transcript result, when it is reused across variants.
+    - **options: Extra options for the test, e.g. rate=0.1 for random_masking.
+
+    Returns:
+    - tuple: The variant text and the list of changes, or (None, []) if the test does not apply
+      (e.g. no negations to mask, or no speaker labels to swap).
+    """
+    rng = random.Random(seed)
+    edits = TESTS[test](text, spans or parse_transcript(text), rng, templates or load_templates(), **options)
+    if not edits:
+        return None, []
+    return apply_edits(text, edits)
+
+def _generate_for_file(job):
+    input_path, output_folder, tests, variants, seed, templates, options = job
+    file_name = os.path.basename(input_path)
+    stem = os.path.splitext(file_name)[0]
+    with open(input_path, "r", encoding="utf-8") as file:
+        text = file.read()
+    source_hash = hashlib.sha256(text.encode("utf-8")).hexdigest()
+    spans = parse_transcript(text)
+    records = []
+    for test in tests:
+        for number in range(variants):
+            # Derived from the file, test and variant number, so results do not depend on scheduling
+            variant_seed = f"{seed}:{file_name}:{test}:{number}"
+            variant, changes = generate_variant(
+                text, test, variant_seed, templates, spans=spans, **options.get(test, {})
+            )
+            variant_id = f"{stem}__{test}__{number:03d}"
+            if variant is None:
+                records.append({"variant_id": variant_id, "source": file_name, "test": test, "skipped": True})
+                continue
+            output_name = variant_id + ".txt"
+            with open(os.path.join(output_folder, output_name), "w", encoding="utf-8") as file:
+                file.write(variant)
+            records.append({
+                "variant_id": variant_id,
+                "source": file_name,
+                "source_sha256": source_hash,
+                "test": test,
+                "seed": variant_seed,
+                "output": output_name,
+                "changes": changes,
+            })
+    return records
+
+def generate_folder(
+    input_folder,
+    output_folder,
+    tests=tuple(TESTS),
+    variants=1,
+    seed=0,
+    templates=None,
+    options=None,
+    num_workers=1
+):
+    """
+    Generate adversarial variants of every transcript in a folder, with a ground-truth record for each.
+
+    Variants are written to output_folder as "<transcript>__<test>__<n>.txt". Their ground truth is
+    streamed to output_folder/ground_truth.jsonl as each transcript finishes: the test, the seed, and every
+    change with its original text, its replacement, and its position in both the original and the variant.
+    A test that does not apply to a transcript gets a record with "skipped": true instead.
+
+    Parameters:
+    - input_folder (str): Folder of .txt transcripts.
+    - output_folder (str): Folder for the variants and ground_truth.jsonl.
+    - tests (iterable of str): The tests to run (default: all six).
+    - variants (int): Variants per transcript and test (default: 1).
+    - seed (int): Base seed; the same seed and inputs always give the same variants (default: 0).
+    - templates (dict, optional): Insertion templates (default: load_templates()).
+    - options (dict, optional): Extra options per test, e.g. {"random_masking": {"rate": 0.2}}.
+    - num_workers (int): Transcripts processed in parallel by a process pool (default: 1).
+
+    Returns:
+    - dict: The number of variants written and skipped per test.
+    """
+    os.makedirs(output_folder, exist_ok=True)
+    templates = templates or load_templates()
+    tests = list(tests)
+    unknown = set(tests) - set(TESTS)
+    if unknown:
+        raise ValueError(f"Unknown test(s): {', '.join(sorted(unknown))}")
+    jobs = [
+        (os.path.join(input_folder, file_name), output_folder, tests, variants, seed, templates, options or {})
+        for file_name in sorted(os.listdir(input_folder)) if file_name.endswith(".txt")
+    ]
+    counts = {test: {"written": 0, "skipped": 0} for test in tests}
+    with open(os.path.join(output_folder, "ground_truth.jsonl"), "w", encoding="utf-8") as ground_truth:
+        if num_workers > 1:
+            executor = ProcessPoolExecutor(max_workers=num_workers)
+            results = executor.map(_generate_for_file, jobs, chunksize=max(1, len(jobs) // (4 * num_workers)))
+        else:
+            executor = None
+            results = map(_generate_for_file, jobs)
+        try:
+            # Results arrive in input order, so the ground truth file is the same for any number of workers
+            for records in results:
+                for record in records:
+                    ground_truth.write(json.dumps(record) + "\n")
+                    counts[record["test"]]["skipped" if record.get("skipped") else "written"] += 1
+        finally:
+            if executor is not None:
+                executor.shutdown()
+    return counts
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate seeded adversarial variants of clinic transcripts.")
+    parser.add_argument("input_folder", help="Folder of .txt transcripts.")
+    parser.add_argument("output_folder", help="Folder for the variants and ground_truth.jsonl.")
+    parser.add_argument("--tests", nargs="+", default=list(TESTS), choices=list(TESTS), help="Tests to run (default: all).")
+    parser.add_argument("--variants", type=int, default=1, help="Variants per transcript and test (default: 1).")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--mask-rate", type=float, default=0.1, help="Share of words masked by random_masking (default: 0.1).")
+    parser.add_argument("--templates", default=None, help="JSON file overriding the insertion templates.")
+    parser.add_argument("--workers", type=int, default=1, help="Parallel worker processes (default: 1).")
+    args = parser.parse_args()
+
+    counts = generate_folder(
+        args.input_folder, args.output_folder, tests=args.tests, variants=args.variants, seed=args.seed,
+        templates=load_templates(args.templates), options={"random_masking": {"rate": args.mask_rate}},
+        num_workers=args.workers
+    )
+    for test, count in counts.items():
+        print(f"{test}: {count['written']} variant(s) written, {count['skipped']} not applicable")
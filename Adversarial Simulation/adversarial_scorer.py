@@ -0,0 +1,434 @@
+import os
+import re
+import csv
+import json
+import math
+import argparse
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from adversarial_generator import DEFAULT_TEMPLATES, MASK, PHRASE_MASK, SENTENCE_MASK
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:'[a-z]+)?")
+MASK_TOKEN = "masked"
+MASKS = (MASK, PHRASE_MASK, SENTENCE_MASK)
+# Words of a swapped line's content that, after its original label, make up the line's fact
+SWAP_FACT_WORDS = 4
+
+# Phrases that count as the system raising an error or warning ("exact matching for error flag")
+DEFAULT_LEXICONS = {
+    "error_flags": [
+        "unrealistic", "implausible", "not plausible", "impossible", "physiologically impossible",
+        "not physiologically possible", "incompatible with life", "erroneous", "likely an error",
+        "possible error", "transcription error", "data entry error", "inconsistent", "inconsistency",
+        "please verify", "should be verified", "needs verification", "irrelevant", "unrelated",
+        "not clinically relevant", "invalid",
+    ],
+    "profanity": sorted(set(DEFAULT_TEMPLATES["profanity_words"]) | {
+        "damned", "dammit", "frickin", "crap", "hell", "shit", "shitty", "bullshit", "fuck", "fucking",
+        "bastard", "piss", "pissed", "ass", "arse",
+    }),
+}
+
+COLUMNS = [
+    "model", "variant_id", "test", "source", "passed", "error_flags", "flagged",
+    "facts_total", "facts_recovered", "fact_recall", "insertions_total", "insertions_leaked",
+    "profanity", "masks_remaining",
+]
+
+#################################### Matcher ########################################
+def tokenize(text):
+    """
+    Split a text into lowercase word tokens (letters and digits, keeping contractions such as "don't").
+    """
+    return TOKEN_PATTERN.findall(text.lower())
+
+def compile_terms(terms):
+    """
+    Compile phrases into a multi-pattern matcher keyed on their first token.
+
+    A phrase matches where its tokens appear consecutively in the tokenized text, so matching ignores
+    case, punctuation and spacing ("500/300 mmHg" matches "500 / 300 mmHg"), and overlapping phrases
+    are all found.
+
+    Parameters:
+    - terms (iterable of str): The phrases to match.
+
+    Returns:
+    - dict: First token -> list of (token tuple, phrase) pairs.
+    """
+    index = {}
+    for term in dict.fromkeys(terms):
+        tokens = tuple(tokenize(term))
+        if tokens:
+            index.setdefault(tokens[0], []).append((tokens, term))
+    return index
+
+def scan(tokens, *indexes):
+    """
+    Count the matches of every compiled phrase in one pass over the tokens.
+
+    Parameters:
+    - tokens (list of str): The tokenized text.
+    - *indexes (dict): Matchers from compile_terms, all scanned in the same pass.
+
+    Returns:
+    - list of Counter: Phrase -> number of matches, one per matcher.
+    """
+    counts = [Counter() for _ in indexes]
+    for position, token in enumerate(tokens):
+        for counter, index in zip(counts, indexes):
+            for phrase, term in index.get(token, ()):
+                if len(phrase) == 1 or tuple(tokens[position:position + len(phrase)]) == phrase:
+                    counter[term] += 1
+    return counts
+
+#################################### Cases ########################################
+def load_lexicons(path=None):
+    """
+    The error-flag and profanity lexicons: the defaults, with any keys from a JSON file replacing them.
+    """
+    lexicons = {key: list(values) for key, values in DEFAULT_LEXICONS.items()}
+    if path:
+        with open(path, "r", encoding="utf-8") as file:
+            lexicons.update(json.load(file))
+    return lexicons
+
+def build_case(record, variant_text, checklist=None):
+    """
+    Turn a ground-truth record into the checklist its model outputs are scored against.
+
+    Masked spans become facts to recover: their original words, framed by the neighbouring words of the
+    variant when a single word was masked, so that a recovered "not" must also be in the right place.
+    Each inserted distractor or vital sign becomes a set of terms that should not reach the output: its
+    words of four or more letters and its numbers, leaving out any that occur elsewhere in the variant.
+    Each line whose speaker label was swapped becomes a fact too: its original label followed by the
+    opening words of the line, so an output only recovers it by attributing the line to the right speaker.
+
+    Parameters:
+    - record (dict): One line of the generator's ground_truth.jsonl.
+    - variant_text (str): The variant the model was given.
+    - checklist (dict, optional): Extra "present" facts and "absent" terms for this variant.
+
+    Returns:
+    - dict: "variant_id", "test", "source", "facts" (list of str) and "insertions" (list of lists of terms).
+    """
+    changes = record.get("changes", [])
+    inserted = [change for change in changes if change["kind"] in ("distractor", "vital_sign")]
+    # Words of the variant outside the insertions, which an output may repeat without leaking anything
+    remainder, position = [], 0
+    for change in inserted:
+        remainder.append(variant_text[position:change["output_start"]])
+        position = change["output_end"]
+    remainder.append(variant_text[position:])
+    known = set(tokenize(" ".join(remainder)))
+
+    facts, insertions = [], []
+    for change in changes:
+        if change["kind"] in ("word", "phrase", "sentence", "negation"):
+            fact = change["original"]
+            if change["replacement"] == MASK:
+                preceding = variant_text[max(0, change["output_start"] - 40):change["output_start"]]
+                following = variant_text[change["output_end"]:change["output_end"] + 40]
+                before, after = tokenize(preceding), tokenize(following)
+                # Neighbours that are themselves masked (by any of the masks) cannot be expected in the output
+                if before and not preceding.rstrip().endswith(MASKS):
+                    fact = before[-1] + " " + fact
+                if after and not following.lstrip().startswith(MASKS):
+                    fact += " " + after[0]
+            facts.append(fact)
+        elif change["kind"] == "speaker_swap":
+            # The line under its original label: an output that reattributes the line quotes its opening words
+            line_end = variant_text.find("\n", change["output_end"])
+            content = tokenize(variant_text[change["output_end"]:line_end if line_end != -1 else len(variant_text)])
+            if content:
+                facts.append(" ".join([change["original"], *content[:SWAP_FACT_WORDS]]))
+        elif change in inserted:
+            terms = {
+                token for token in tokenize(change["inserted"])
+                if token not in known and (len(token) >= 4 or any(char.isdigit() for char in token))
+            }
+            if change["kind"] == "vital_sign":
+                terms = {token for token in terms if any(char.isdigit() for char in token)}
+            insertions.append(sorted(terms))
+    checklist = checklist or {}
+    facts.extend(checklist.get("present", []))
+    if checklist.get("absent"):
+        insertions.append(list(checklist["absent"]))
+    return {
+        "variant_id": record["variant_id"],
+        "test": record["test"],
+        "source": record.get("source"),
+        "facts": facts,
+        "insertions": [terms for terms in insertions if terms],
+    }
+
+#################################### Scoring ########################################
+_worker_state = None
+
+def _init_worker(lexicons, options):
+    global _worker_state
+    _worker_state = (
+        compile_terms(lexicons["error_flags"]),
+        compile_terms(lexicons["profanity"]),
+        options,
+    )
+
+def compile_case(case):
+    """
+    Compile a case's facts and insertion terms (see compile_terms), once for all the outputs scored against it.
+
+    Returns:
+    - tuple: The fact matcher and the insertion-term matcher.
+    """
+    return (
+        compile_terms(case["facts"]),
+        compile_terms(term for terms in case["insertions"] for term in terms),
+    )
+
+def score_output(
+    case,
+    text,
+    error_index,
+    profanity_index,
+    min_recall=0.8,
+    leak_fraction=0.5,
+    case_indexes=None
+):
+    """
+    Score one model output for one adversarial variant.
+
+    Parameters:
+    - case (dict): The variant's checklist (see build_case).
+    - text (str): The model output, e.g. a summary of the variant.
+    - error_index, profanity_index (dict): Compiled lexicons (see compile_terms).
+    - min_recall (float): Share of facts to recover for a masking or diarization case to pass (default: 0.8).
+    - leak_fraction (float): Share of an insertion's terms that must appear for it to count as leaked (default: 0.5).
+    - case_indexes (tuple, optional): The case's matchers from compile_case (default: compiled for this call).
+
+    Returns:
+    - dict: One row of COLUMNS (without "model"). "passed" is None when the case has nothing to check.
+    """
+    tokens = tokenize(text)
+    errors, profanity, facts, leaks = scan(tokens, error_index, profanity_index, *(case_indexes or compile_case(case)))
+    recovered = sum(1 for fact in case["facts"] if facts[fact])
+    leaked = sum(
+        1 for terms in case["insertions"]
+        if sum(1 for term in terms if leaks[term]) >= max(1, math.ceil(leak_fraction * len(terms)))
+    )
+    flags = sum(errors.values())
+    recall = recovered / len(case["facts"]) if case["facts"] else None
+    test = case["test"]
+    if test == "unrealistic_lab_values":
+        passed = flags > 0
+    elif test == "irrelevant_content":
+        passed = leaked == 0 if case["insertions"] else None
+    elif test == "inappropriate_language":
+        passed = sum(profanity.values()) == 0
+    else:
+        passed = recall >= min_recall if recall is not None else None
+    return {
+        "variant_id": case["variant_id"],
+        "test": test,
+        "source": case["source"],
+        "passed": passed,
+        "error_flags": flags,
+        "flagged": flags > 0,
+        "facts_total": len(case["facts"]),
+        "facts_recovered": recovered,
+        "fact_recall": recall,
+        "insertions_total": len(case["insertions"]),
+        "insertions_leaked": leaked,
+        "profanity": sum(profanity.values()),
+        "masks_remaining": tokens.count(MASK_TOKEN),
+    }
+
+def _score_variant(job):
+    record, variant_path, outputs, checklist = job
+    error_index, profanity_index, options = _worker_state
+    with open(variant_path, "r", encoding="utf-8") as file:
+        case = build_case(record, file.read(), checklist)
+    case_indexes = compile_case(case)
+    rows = []
+    # The case is built and compiled once, and every model's output for it is scanned against the same checklist
+    for model, output_path in outputs:
+        with open(output_path, "r", encoding="utf-8") as file:
+            text = file.read()
+        rows.append({
+            "model": model,
+            **score_output(case, text, error_index, profanity_index, case_indexes=case_indexes, **options),
+        })
+    return rows
+
+def iter_scores(
+    variants_folder,
+    outputs_folder,
+    models=None,
+    lexicons=None,
+    checklists=None,
+    min_recall=0.8,
+    leak_fraction=0.5,
+    num_workers=1
+):
+    """
+    Score every model's output for every adversarial variant, yielding the rows in ground-truth order.
+
+    Parameters:
+    - variants_folder (str): The generator's output folder, with the variants and ground_truth.jsonl.
+    - outputs_folder (str): One subfolder per model, holding its output for each variant as "<variant_id>.txt".
+    - models (list of str, optional): The model subfolders to score (default: all of them).
+    - lexicons (dict, optional): "error_flags" and "profanity" phrase lists (default: load_lexicons()).
+    - checklists (dict, optional): Variant id -> {"present": [...], "absent": [...]} facts to add to its case.
+    - min_recall (float): Share of facts to recover for a masking or diarization case to pass (default: 0.8).
+    - leak_fraction (float): Share of an insertion's terms that must appear for it to leak (default: 0.5).
+    - num_workers (int): Processes scoring variants in parallel; 1 scores in this process (default: 1).
+
+    Yields:
+    - dict: One row of COLUMNS per model output. Variants a model has no output for are left out.
+    """
+    lexicons = lexicons or load_lexicons()
+    checklists = checklists or {}
+    if models is None:
+        models = sorted(
+            name for name in os.listdir(outputs_folder) if os.path.isdir(os.path.join(outputs_folder, name))
+        )
+    jobs = []
+    with open(os.path.join(variants_folder, "ground_truth.jsonl"), "r", encoding="utf-8") as ground_truth:
+        for line in ground_truth:
+            record = json.loads(line)
+            if record.get("skipped"):
+                continue
+            outputs = [
+                (model, os.path.join(outputs_folder, model, record["variant_id"] + ".txt")) for model in models
+            ]
+            outputs = [(model, path) for model, path in outputs if os.path.exists(path)]
+            if outputs:
+                jobs.append((
+                    record, os.path.join(variants_folder, record["output"]), outputs,
+                    checklists.get(record["variant_id"])
+                ))
+    options = {"min_recall": min_recall, "leak_fraction": leak_fraction}
+    if num_workers > 1 and len(jobs) > 1:
+        # Each worker compiles the lexicons once, when it starts
+        with ProcessPoolExecutor(
+            max_workers=num_workers, initializer=_init_worker, initargs=(lexicons, options)
+        ) as executor:
+            for rows in executor.map(_score_variant, jobs, chunksize=max(1, len(jobs) // (4 * num_workers))):
+                yield from rows
+    else:
+        _init_worker(lexicons, options)
+        for job in jobs:
+            yield from _score_variant(job)
+
+#################################### Aggregates ########################################
+def aggregate(rows):
+    """
+    Summarize scored rows per model and test, and per model over all tests.
+
+    Returns:
+    - dict: Model -> {"overall": summary, "tests": {test: summary}}. Each summary has the number of cases,
+      the pass rate over the cases with something to check, the flag rate, the mean fact recall, the share of
+      insertions leaked, and the profanity and mask counts left in the outputs.
+    """
+    totals = {}
+    for row in rows:
+        model = totals.setdefault(row["model"], {"overall": Counter(), "tests": {}})
+        for summary in (model["overall"], model["tests"].setdefault(row["test"], Counter())):
+            summary["cases"] += 1
+            summary["flagged"] += row["flagged"]
+            summary["profanity"] += row["profanity"]
+            summary["masks_remaining"] += row["masks_remaining"]
+            summary["insertions_total"] += row["insertions_total"]
+            summary["insertions_leaked"] += row["insertions_leaked"]
+            if row["passed"] is not None:
+                summary["checked"] += 1
+                summary["passed"] += row["passed"]
+            if row["fact_recall"] is not None:
+                summary["recall_cases"] += 1
+                summary["recall_sum"] += row["fact_recall"]
+
+    def finish(summary):
+        return {
+            "cases": summary["cases"],
+            "pass_rate": summary["passed"] / summary["checked"] if summary["checked"] else None,
+            "flag_rate": summary["flagged"] / summary["cases"],
+            "mean_fact_recall": summary["recall_sum"] / summary["recall_cases"] if summary["recall_cases"] else None,
+            "leak_rate": (
+                summary["insertions_leaked"] / summary["insertions_total"] if summary["insertions_total"] else None
+            ),
+            "profanity": summary["profanity"],
+            "masks_remaining": summary["masks_remaining"],
+        }
+
+    return {
+        model: {
+            "overall": finish(summary["overall"]),
+            "tests": {test: finish(counts) for test, counts in sorted(summary["tests"].items())},
+        }
+        for model, summary in sorted(totals.items())
+    }
+
+def score_run(variants_folder, outputs_folder, output_path=None, aggregates_path=None, **options):
+    """
+    Score a full adversarial run: every model output against its variant's ground truth.
+
+    Parameters:
+    - variants_folder (str): The generator's output folder, with the variants and ground_truth.jsonl.
+    - outputs_folder (str): One subfolder per model, holding its output for each variant as "<variant_id>.txt".
+    - output_path (str, optional): Stream the per-output rows to this CSV file as they are scored.
+    - aggregates_path (str, optional): Save the per-model and per-test aggregates to this JSON file.
+    - **options: Passed to iter_scores (models, lexicons, checklists, min_recall, leak_fraction, num_workers).
+
+    Returns:
+    - dict: The aggregates (see aggregate).
+    """
+    rows = iter_scores(variants_folder, outputs_folder, **options)
+    if output_path is not None:
+        def written(rows):
+            with open(output_path, "w", encoding="utf-8", newline="") as file:
+                writer = csv.DictWriter(file, fieldnames=COLUMNS)
+                writer.writeheader()
+                for row in rows:
+                    writer.writerow(row)
+                    yield row
+        rows = written(rows)
+    aggregates = aggregate(rows)
+    if aggregates_path is not None:
+        with open(aggregates_path, "w", encoding="utf-8") as file:
+            json.dump(aggregates, file, indent=2)
+    return aggregates
+
+def load_checklists(path):
+    """
+    Read extra fact checklists from a JSON Lines file of {"variant_id": ..., "present": [...], "absent": [...]}.
+    """
+    checklists = {}
+    with open(path, "r", encoding="utf-8") as file:
+        for line in file:
+            if line.strip():
+                entry = json.loads(line)
+                checklists[entry["variant_id"]] = entry
+    return checklists
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Score model outputs for the adversarial test variants.")
+    parser.add_argument("variants_folder", help="The generator's output folder, with ground_truth.jsonl.")
+    parser.add_argument("outputs_folder", help="One subfolder per model, with an output per variant as <variant_id>.txt.")
+    parser.add_argument("output_path", help="CSV file for the per-output scores.")
+    parser.add_argument("--aggregates", default=None, help="JSON file for the per-model and per-test aggregates.")
+    parser.add_argument("--models", nargs="+", default=None, help="Model subfolders to score (default: all).")
+    parser.add_argument("--lexicons", default=None, help="JSON file overriding the error-flag and profanity lexicons.")
+    parser.add_argument("--checklists", default=None, help="JSON Lines file of extra facts per variant.")
+    parser.add_argument("--min-recall", type=float, default=0.8, help="Fact recall needed to pass a masking case (default: 0.8).")
+    parser.add_argument("--workers", type=int, default=1, help="Parallel worker processes (default: 1).")
+    args = parser.parse_args()
+
+    aggregates = score_run(
+        args.variants_folder, args.outputs_folder, output_path=args.output_path, aggregates_path=args.aggregates,
+        models=args.models, lexicons=load_lexicons(args.lexicons),
+        checklists=load_checklists(args.checklists) if args.checklists else None,
+        min_recall=args.min_recall, num_workers=args.workers
+    )
+    for model, summary in aggregates.items():
+        overall = summary["overall"]
+        pass_rate = "n/a" if overall["pass_rate"] is None else f"{overall['pass_rate']:.1%}"
+        print(f"{model}: {overall['cases']} output(s) scored, pass rate {pass_rate}")
@@ -0,0 +1,339 @@
+import os
+import csv
+import json
+import stat
+import zlib
+import hashlib
+import argparse
+import tempfile
+import numpy as np
+from text_helpers import tokenize, load_pairs
+
+# os.umask can only be read by setting it, so it is read once at import
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+#################################### Helpers ########################################
+def _replacement_mode(path):
+    # Mode for a compacted file: that of the file it replaces (mkstemp alone would leave it at 0600)
+    try:
+        return stat.S_IMODE(os.stat(path).st_mode)
+    except FileNotFoundError:
+        return 0o666 & ~_UMASK
+
+#################################### Embedders ########################################
+class HashingEmbedder:
+    """
+    Offline embedding backend: signed feature hashing of word unigrams and bigrams with sublinear term
+    frequencies, L2-normalised. It needs no fitting or downloads, so the same text always gets the same
+    vector and stored vectors stay valid across runs.
+
+    Any object with a "name", a "dimension" and an embed(texts) method returning a (len(texts), dimension)
+    array can be used as a backend instead, e.g. SentenceTransformerEmbedder.
+
+    Parameters:
+    - dimension (int): Length of the vectors (default: 1024).
+    - bigrams (bool): Hash word bigrams as well as single words (default: True).
+    """
+    def __init__(self, dimension=1024, bigrams=True):
+        self.dimension = dimension
+        self.bigrams = bigrams
+        self.name = f"hashing-crc32-{dimension}{'-bigrams' if bigrams else ''}"
+
+    def embed(self, texts):
+        vectors = np.zeros((len(texts), self.dimension), dtype=np.float32)
+        for row, text in enumerate(texts):
+            tokens = tokenize(text)
+            features = tokens + [f"{first} {second}" for first, second in zip(tokens, tokens[1:])] if self.bigrams else tokens
+            if not features:
+                continue
+            hashes = np.fromiter(
+                (zlib.crc32(feature.encode("utf-8")) for feature in features), dtype=np.uint64, count=len(features)
+            )
+            # One hash bit picks the sign, so colliding features tend to cancel out instead of adding up
+            signs = np.where(hashes & (1 << 31), -1.0, 1.0)
+            counts = np.zeros(self.dimension)
+            np.add.at(counts, (hashes % self.dimension).astype(np.int64), signs)
+            vectors[row] = np.sign(counts) * np.log1p(np.abs(counts))
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return np.divide(vectors, norms, out=np.zeros_like(vectors), where=norms > 0)
+
+class SentenceTransformerEmbedder:
+    """
+    Local neural embedding backend using a sentence-transformers model (requires sentence-transformers).
+
+    Parameters:
+    - model_name (str): The model to load (default: "all-MiniLM-L6-v2").
+    """
+    def __init__(self, model_name="all-MiniLM-L6-v2"):
+        from sentence_transformers import SentenceTransformer
+        self.model = SentenceTransformer(model_name)
+        self.dimension = self.model.get_sentence_embedding_dimension()
+        self.name = f"sentence-transformers-{model_name}"
+
+    def embed(self, texts):
+        return self.model.encode(list(texts), normalize_embeddings=True, convert_to_numpy=True).astype(np.float32)
+
+#################################### Store ########################################
+def content_key(text):
+    """
+    The key a text's vector is stored under: the SHA-256 of its UTF-8 content.
+    """
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+class EmbeddingStore:
+    """
+    Persistent, content-addressed store of L2-normalised text embeddings.
+
+    Vectors are appended to a raw float32 file that is read through a NumPy memory map, so only the rows in
+    use are paged in and memory stays flat however large the store grows. A small JSON Lines index maps
+    each text's content hash to its row. Texts already in the store (e.g. the reference notes, evaluated
+    against every new model release) are never embedded again; only new texts are.
+
+    The store is append-only: vectors are written and synced before their index line, so a crash leaves at
+    most unindexed rows, which compact() reclaims along with removed entries.
+
+    Files in the folder: "vectors.f32", "index.jsonl" and "meta.json" (embedder name and dimension).
+
+    Parameters:
+    - folder (str): Folder holding the store; created if needed.
+    - embedder: The embedding backend (default: HashingEmbedder()). A store can only be reopened with
+      a backend of the same name and dimension.
+    - batch_size (int): Texts embedded, and pairs scored, per step (default: 256).
+    """
+    def __init__(self, folder, embedder=None, batch_size=256):
+        self.folder = folder
+        self.embedder = embedder or HashingEmbedder()
+        self.batch_size = batch_size
+        self.dimension = self.embedder.dimension
+        self.row_bytes = self.dimension * np.dtype(np.float32).itemsize
+        self.vectors_path = os.path.join(folder, "vectors.f32")
+        self.index_path = os.path.join(folder, "index.jsonl")
+        os.makedirs(folder, exist_ok=True)
+
+        meta_path = os.path.join(folder, "meta.json")
+        meta = {"embedder": self.embedder.name, "dimension": self.dimension}
+        if os.path.exists(meta_path):
+            with open(meta_path, "r", encoding="utf-8") as file:
+                stored = json.load(file)
+            if stored != meta:
+                raise ValueError(f"Store was built with {stored}, not {meta}")
+        else:
+            with open(meta_path, "w", encoding="utf-8") as file:
+                json.dump(meta, file)
+
+        # Drop a partly written last row left by a crash
+        if os.path.exists(self.vectors_path):
+            size = os.path.getsize(self.vectors_path)
+            if size % self.row_bytes:
+                with open(self.vectors_path, "r+b") as file:
+                    file.truncate(size - size % self.row_bytes)
+        else:
+            open(self.vectors_path, "wb").close()
+        self.rows = os.path.getsize(self.vectors_path) // self.row_bytes
+
+        self.index = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "r", encoding="utf-8") as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    if entry["row"] is None:
+                        self.index.pop(entry["key"], None)
+                    elif entry["row"] < self.rows:
+                        self.index[entry["key"]] = entry["row"]
+        self._map = None
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, text):
+        return content_key(text) in self.index
+
+    def _matrix(self):
+        # Reopen the memory map only when rows were appended since it was last opened
+        if self._map is None or len(self._map) != self.rows:
+            if self.rows:
+                self._map = np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(self.rows, self.dimension))
+            else:
+                # An empty file cannot be memory-mapped
+                self._map = np.zeros((0, self.dimension), dtype=np.float32)
+        return self._map
+
+    def _append(self, keys, vectors):
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        first_row = self.rows
+        with open(self.vectors_path, "ab") as file:
+            file.write(vectors.tobytes())
+            file.flush()
+            os.fsync(file.fileno())
+        with open(self.index_path, "a", encoding="utf-8") as file:
+            for offset, key in enumerate(keys):
+                file.write(json.dumps({"key": key, "row": first_row + offset}) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+        self.rows += len(keys)
+        for offset, key in enumerate(keys):
+            self.index[key] = first_row + offset
+
+    def add(self, texts):
+        """
+        Embed and store the texts that are not in the store yet.
+
+        Parameters:
+        - texts (iterable of str): The texts.
+
+        Returns:
+        - numpy.ndarray: The row of each text, in input order.
+        """
+        texts = list(texts)
+        keys = [content_key(text) for text in texts]
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in self.index:
+                missing.setdefault(key, text)
+        missing = list(missing.items())
+        for start in range(0, len(missing), self.batch_size):
+            batch = missing[start:start + self.batch_size]
+            self._append([key for key, _ in batch], self.embedder.embed([text for _, text in batch]))
+        return np.fromiter((self.index[key] for key in keys), dtype=np.int64, count=len(keys))
+
+    def remove(self, texts):
+        """
+        Forget texts. Their rows stay in the vector file until compact() is called.
+        """
+        with open(self.index_path, "a", encoding="utf-8") as file:
+            for text in texts:
+                key = content_key(text)
+                if self.index.pop(key, None) is not None:
+                    file.write(json.dumps({"key": key, "row": None}) + "\n")
+
+    def vectors(self, texts):
+        """
+        The stored vectors of the texts, embedding any that are missing.
+
+        Returns:
+        - numpy.ndarray: A (len(texts), dimension) array.
+        """
+        return self._matrix()[self.add(texts)]
+
+    #################################### Similarity ########################################
+    def iter_pair_similarity(self, hypotheses, references):
+        """
+        Cosine similarity of aligned hypothesis/reference pairs, yielded one batch at a time.
+        Each batch reads its rows from the memory map and is scored as one matrix product.
+
+        Yields:
+        - numpy.ndarray: The similarities of the next batch of pairs.
+        """
+        if len(hypotheses) != len(references):
+            raise ValueError("hypotheses and references must have the same length")
+        for start in range(0, len(hypotheses), self.batch_size):
+            hypothesis_rows = self.add(hypotheses[start:start + self.batch_size])
+            reference_rows = self.add(references[start:start + self.batch_size])
+            matrix = self._matrix()
+            # Row-wise dot products: the diagonal of H @ R.T without forming the full product
+            yield np.einsum("ij,ij->i", matrix[hypothesis_rows], matrix[reference_rows])
+
+    def pair_similarity(self, hypotheses, references):
+        """
+        Cosine similarity of aligned hypothesis/reference pairs.
+
+        Returns:
+        - numpy.ndarray: One similarity per pair.
+        """
+        batches = list(self.iter_pair_similarity(hypotheses, references))
+        return np.concatenate(batches) if batches else np.zeros(0, dtype=np.float32)
+
+    def similarity_matrix(self, hypotheses, references):
+        """
+        Cosine similarity of every hypothesis with every reference, as one matrix product.
+
+        Returns:
+        - numpy.ndarray: A (len(hypotheses), len(references)) array.
+        """
+        hypothesis_rows = self.add(hypotheses)
+        reference_rows = self.add(references)
+        matrix = self._matrix()
+        return matrix[hypothesis_rows] @ matrix[reference_rows].T
+
+    #################################### Maintenance ########################################
+    def stats(self):
+        """
+        Live entries, rows in the vector file, and rows that compact() would reclaim.
+        """
+        return {"entries": len(self.index), "rows": self.rows, "dead_rows": self.rows - len(set(self.index.values()))}
+
+    def compact(self, keep=None):
+        """
+        Rewrite the store without removed, unindexed or (optionally) unwanted rows. The new files are
+        written next to the old ones and swapped in with os.replace, copying rows in batches so memory
+        stays flat.
+
+        Parameters:
+        - keep (iterable of str, optional): If given, only these texts are kept.
+
+        Returns:
+        - int: The number of rows reclaimed.
+        """
+        entries = sorted(self.index.items(), key=lambda item: item[1])
+        if keep is not None:
+            wanted = {content_key(text) for text in keep}
+            entries = [(key, row) for key, row in entries if key in wanted]
+        matrix = self._matrix()
+        vectors_fd, vectors_temp = tempfile.mkstemp(dir=self.folder, prefix=".tmp-", suffix="vectors.f32")
+        index_fd, index_temp = tempfile.mkstemp(dir=self.folder, prefix=".tmp-", suffix="index.jsonl")
+        try:
+            with os.fdopen(vectors_fd, "wb") as vectors_file, os.fdopen(index_fd, "w", encoding="utf-8") as index_file:
+                for start in range(0, len(entries), self.batch_size):
+                    batch = entries[start:start + self.batch_size]
+                    vectors_file.write(np.ascontiguousarray(matrix[[row for _, row in batch]]).tobytes())
+                    for offset, (key, _) in enumerate(batch):
+                        index_file.write(json.dumps({"key": key, "row": start + offset}) + "\n")
+                for handle in (vectors_file, index_file):
+                    handle.flush()
+                    os.fsync(handle.fileno())
+            # Release the old memory map before replacing the file underneath it
+            self._map = None
+            del matrix
+            for temporary, target in ((vectors_temp, self.vectors_path), (index_temp, self.index_path)):
+                os.chmod(temporary, _replacement_mode(target))
+            os.replace(vectors_temp, self.vectors_path)
+            os.replace(index_temp, self.index_path)
+        except BaseException:
+            for path in (vectors_temp, index_temp):
+                if os.path.exists(path):
+                    os.remove(path)
+            raise
+        reclaimed = self.rows - len(entries)
+        self.rows = len(entries)
+        self.index = {key: row for row, (key, _) in enumerate(entries)}
+        return reclaimed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Score embedding cosine similarity of generated texts against references, reusing stored embeddings."
+    )
+    parser.add_argument("hypothesis_folder", help="Folder of model-generated .txt files.")
+    parser.add_argument("reference_folder", help="Folder of reference .txt files with the same names.")
+    parser.add_argument("output_path", help="CSV file for the scores.")
+    parser.add_argument("--store", default="embedding_store", help="Folder of the embedding store (default: embedding_store).")
+    parser.add_argument("--dimension", type=int, default=1024, help="Hashing embedder dimension (default: 1024).")
+    parser.add_argument("--compact", action="store_true", help="Compact the store after scoring.")
+    args = parser.parse_args()
+
+    ids, hypotheses, references = load_pairs(args.hypothesis_folder, args.reference_folder)
+    store = EmbeddingStore(args.store, HashingEmbedder(dimension=args.dimension))
+    known = sum(text in store for text in references)
+    with open(args.output_path, "w", encoding="utf-8", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(["id", "embedding_cosine_similarity"])
+        position = 0
+        for similarities in store.iter_pair_similarity(hypotheses, references):
+            writer.writerows(zip(ids[position:position + len(similarities)], similarities))
+            position += len(similarities)
+    print(f"Scored {position} pair(s); {known} of {len(references)} reference(s) were already embedded.")
+    if args.compact:
+        print(f"Compaction reclaimed {store.compact()} row(s).")
@@ -0,0 +1,441 @@
+import re
+import csv
+import math
+import argparse
+from collections import Counter, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from scipy import sparse
+from text_helpers import tokenize, load_pairs
+
+VOWEL_GROUPS = re.compile(r"[aeiouy]+")
+SENTENCE_PATTERN = re.compile(r"[^.!?]*\w[^.!?]*")
+
+ROUGE_ORDERS = (1, 2)
+BLEU_ORDER = 4
+COLUMNS = [
+    "id",
+    "cosine_similarity",
+    "flesch_hypothesis",
+    "flesch_reference",
+    *(f"rouge{n}_{part}" for n in ROUGE_ORDERS for part in ("precision", "recall", "f1")),
+    "bleu",
+]
+
+# Vocabulary, inverse document frequencies and syllable counts shared by every shard of a corpus
+CorpusStatistics = namedtuple("CorpusStatistics", ["vocabulary", "idf", "syllables"])
+
+#################################### Text Statistics ########################################
+def count_syllables(word):
+    """
+    Estimate the syllables in a word as its vowel groups, not counting a silent final "e".
+    """
+    groups = len(VOWEL_GROUPS.findall(word))
+    if word.endswith("e") and not word.endswith(("le", "ee")) and groups > 1:
+        groups -= 1
+    return max(1, groups)
+
+def count_sentences(text):
+    """
+    Count the sentences in a text: stretches ended by ".", "!" or "?" (or the end of the text) that contain a word.
+    """
+    return max(1, len(SENTENCE_PATTERN.findall(text)))
+
+def fit_corpus(hypotheses, references):
+    """
+    Build the vocabulary, smoothed inverse document frequencies and per-word syllable counts of a corpus.
+    Every hypothesis and every reference counts as one document, and all shards are scored with the
+    same statistics, so the scores do not depend on how the corpus is split.
+
+    Parameters:
+    - hypotheses (list of str): Model-generated texts.
+    - references (list of str): Human-written texts, aligned with hypotheses.
+
+    Returns:
+    - CorpusStatistics: The vocabulary (token -> column), idf array and syllable array.
+    """
+    vocabulary = {}
+    document_columns = []
+    for text in list(hypotheses) + list(references):
+        columns = {vocabulary.setdefault(token, len(vocabulary)) for token in tokenize(text)}
+        document_columns.append(np.fromiter(columns, dtype=np.int64, count=len(columns)))
+    documents = len(document_columns)
+    document_frequency = np.bincount(
+        np.concatenate(document_columns) if document_columns else np.zeros(0, dtype=np.int64),
+        minlength=len(vocabulary)
+    )
+    idf = np.log((1 + documents) / (1 + document_frequency)) + 1.0
+    syllables = np.zeros(len(vocabulary))
+    for token, column in vocabulary.items():
+        syllables[column] = count_syllables(token)
+    return CorpusStatistics(vocabulary, idf, syllables)
+
+#################################### Batch Scoring ########################################
+def encode(texts, vocabulary):
+    """
+    Turn a list of texts into flat arrays of token columns and the index of the text each token belongs to.
+
+    Returns:
+    - tuple: (tokens, documents, lengths) as NumPy arrays.
+    """
+    token_lists = [tokenize(text) for text in texts]
+    lengths = np.fromiter((len(tokens) for tokens in token_lists), dtype=np.int64, count=len(token_lists))
+    tokens = np.fromiter(
+        (vocabulary[token] for tokens in token_lists for token in tokens), dtype=np.int64, count=int(lengths.sum())
+    )
+    documents = np.repeat(np.arange(len(texts)), lengths)
+    return tokens, documents, lengths
+
+def tfidf_matrix(tokens, documents, rows, statistics):
+    # Count matrix with duplicates summed on conversion, weighted by idf and L2-normalised per row
+    counts = sparse.csr_matrix(
+        (np.ones(len(tokens)), (documents, tokens)), shape=(rows, len(statistics.vocabulary))
+    )
+    weighted = sparse.csr_matrix(counts.multiply(statistics.idf[np.newaxis, :]))
+    norms = np.sqrt(np.asarray(weighted.multiply(weighted).sum(axis=1)).ravel())
+    scale = np.divide(1.0, norms, out=np.zeros_like(norms), where=norms > 0)
+    return sparse.diags(scale) @ weighted
+
+def ngram_columns(grams, vocabulary_size):
+    # Number distinct n-grams by folding in one token position at a time and re-ranking with a 1-D unique,
+    # which keeps the keys small and is much faster than np.unique over rows
+    columns = grams[:, 0]
+    for k in range(1, grams.shape[1]):
+        columns = np.unique(columns * vocabulary_size + grams[:, k], return_inverse=True)[1].ravel()
+    return columns
+
+def ngram_matrices(hypothesis_encoding, reference_encoding, rows, n, vocabulary_size):
+    # Count matrices of the n-grams of the hypotheses and the references over one shared n-gram index
+    grams, owners = [], []
+    for tokens, documents, _ in (hypothesis_encoding, reference_encoding):
+        if len(tokens) < n:
+            grams.append(np.zeros((0, n), dtype=np.int64))
+            owners.append(np.zeros(0, dtype=np.int64))
+            continue
+        # A window is an n-gram only if it does not cross from one text into the next
+        valid = documents[: len(tokens) - n + 1] == documents[n - 1:]
+        window = np.stack([tokens[k: len(tokens) - n + 1 + k] for k in range(n)], axis=1)
+        grams.append(window[valid])
+        owners.append(documents[: len(tokens) - n + 1][valid])
+    combined = np.concatenate(grams)
+    if len(combined) == 0:
+        empty = sparse.csr_matrix((rows, 1))
+        return empty, empty
+    columns = ngram_columns(combined, vocabulary_size)
+    width = int(columns.max()) + 1
+    split = len(grams[0])
+    hypothesis = sparse.csr_matrix(
+        (np.ones(split), (owners[0], columns[:split])), shape=(rows, width)
+    )
+    reference = sparse.csr_matrix(
+        (np.ones(len(combined) - split), (owners[1], columns[split:])), shape=(rows, width)
+    )
+    return hypothesis, reference
+
+def row_sums(matrix):
+    return np.asarray(matrix.sum(axis=1)).ravel()
+
+def flesch_reading_ease(words, sentences, syllables):
+    """
+    Flesch reading ease from word, sentence and syllable counts (arrays or numbers); NaN for empty texts.
+    """
+    words = np.asarray(words, dtype=float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        score = 206.835 - 1.015 * (words / sentences) - 84.6 * (np.asarray(syllables, dtype=float) / words)
+    return np.where(words > 0, score, np.nan)
+
+def score_batch(hypotheses, references, statistics):
+    """
+    Score aligned hypothesis/reference pairs with sparse matrix operations instead of per-pair loops.
+
+    Parameters:
+    - hypotheses (list of str): Model-generated texts.
+    - references (list of str): Human-written texts, aligned with hypotheses.
+    - statistics (CorpusStatistics): The corpus statistics from fit_corpus.
+
+    Returns:
+    - dict: One NumPy array per metric column (all columns except "id").
+    """
+    rows = len(hypotheses)
+    hypothesis_encoding = encode(hypotheses, statistics.vocabulary)
+    reference_encoding = encode(references, statistics.vocabulary)
+    results = {}
+
+    # Cosine similarity: row-wise dot products of the normalised TF-IDF rows
+    hypothesis_tfidf = tfidf_matrix(hypothesis_encoding[0], hypothesis_encoding[1], rows, statistics)
+    reference_tfidf = tfidf_matrix(reference_encoding[0], reference_encoding[1], rows, statistics)
+    results["cosine_similarity"] = row_sums(hypothesis_tfidf.multiply(reference_tfidf))
+
+    # Flesch reading ease: per-text sums of the per-word syllable counts
+    for name, texts, (tokens, documents, lengths) in (
+        ("hypothesis", hypotheses, hypothesis_encoding),
+        ("reference", references, reference_encoding),
+    ):
+        syllables = np.bincount(documents, weights=statistics.syllables[tokens], minlength=rows)
+        sentences = np.fromiter((count_sentences(text) for text in texts), dtype=float, count=rows)
+        results[f"flesch_{name}"] = flesch_reading_ease(lengths, sentences, syllables)
+
+    # N-gram overlap: clipped matches are the element-wise minimum of the two count matrices
+    precisions = []
+    for n in sorted(set(ROUGE_ORDERS) | set(range(1, BLEU_ORDER + 1))):
+        hypothesis_counts, reference_counts = ngram_matrices(
+            hypothesis_encoding, reference_encoding, rows, n, len(statistics.vocabulary)
+        )
+        overlap = row_sums(hypothesis_counts.minimum(reference_counts))
+        hypothesis_total = row_sums(hypothesis_counts)
+        reference_total = row_sums(reference_counts)
+        if n in ROUGE_ORDERS:
+            precision = np.divide(overlap, hypothesis_total, out=np.zeros(rows), where=hypothesis_total > 0)
+            recall = np.divide(overlap, reference_total, out=np.zeros(rows), where=reference_total > 0)
+            f1 = np.divide(2 * precision * recall, precision + recall, out=np.zeros(rows), where=precision + recall > 0)
+            results[f"rouge{n}_precision"] = precision
+            results[f"rouge{n}_recall"] = recall
+            results[f"rouge{n}_f1"] = f1
+        if n <= BLEU_ORDER:
+            # Unigram precision is exact; higher orders use add-one smoothing (Lin and Och, 2004)
+            if n == 1:
+                precisions.append(np.divide(overlap, hypothesis_total, out=np.zeros(rows), where=hypothesis_total > 0))
+            else:
+                precisions.append((overlap + 1) / (hypothesis_total + 1))
+
+    # BLEU: geometric mean of the n-gram precisions times the brevity penalty
+    hypothesis_length = hypothesis_encoding[2].astype(float)
+    reference_length = reference_encoding[2].astype(float)
+    precisions = np.stack(precisions)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        geometric_mean = np.exp(np.log(precisions).mean(axis=0))
+        brevity_penalty = np.where(
+            hypothesis_length > reference_length, 1.0, np.exp(1 - reference_length / hypothesis_length)
+        )
+    results["bleu"] = np.where((hypothesis_length > 0) & (precisions[0] > 0), brevity_penalty * geometric_mean, 0.0)
+    return results
+
+#################################### Sharding ########################################
+_worker_statistics = None
+
+def _init_worker(statistics):
+    global _worker_statistics
+    _worker_statistics = statistics
+
+def _score_shard(shard):
+    ids, hypotheses, references = shard
+    return {"id": np.asarray(ids, dtype=object), **score_batch(hypotheses, references, _worker_statistics)}
+
+def iter_scores(hypotheses, references, ids=None, shard_size=1000, num_workers=1, statistics=None):
+    """
+    Score a corpus shard by shard, yielding each shard's results in corpus order as soon as it is ready.
+
+    Parameters:
+    - hypotheses (list of str): Model-generated texts.
+    - references (list of str): Human-written texts, aligned with hypotheses.
+    - ids (list, optional): An identifier per pair (default: the pair's position).
+    - shard_size (int): Pairs per shard (default: 1000).
+    - num_workers (int): Processes scoring shards in parallel; 1 scores in this process (default: 1).
+    - statistics (CorpusStatistics, optional): Precomputed corpus statistics; fitted on the corpus if omitted.
+
+    Yields:
+    - dict: The "id" column and one array per metric column for each shard.
+    """
+    if len(hypotheses) != len(references):
+        raise ValueError("hypotheses and references must have the same length")
+    ids = list(range(len(hypotheses))) if ids is None else list(ids)
+    statistics = statistics or fit_corpus(hypotheses, references)
+    shards = [
+        (ids[start:start + shard_size], hypotheses[start:start + shard_size], references[start:start + shard_size])
+        for start in range(0, len(hypotheses), shard_size)
+    ]
+    if num_workers > 1 and len(shards) > 1:
+        # Each worker receives the corpus statistics once, when it starts
+        with ProcessPoolExecutor(max_workers=num_workers, initializer=_init_worker, initargs=(statistics,)) as executor:
+            yield from executor.map(_score_shard, shards)
+    else:
+        for shard_ids, shard_hypotheses, shard_references in shards:
+            yield {
+                "id": np.asarray(shard_ids, dtype=object),
+                **score_batch(shard_hypotheses, shard_references, statistics),
+            }
+
+#################################### Output ########################################
+def write_scores(shards, output_path):
+    """
+    Stream shard results to a CSV file, or to a Parquet file (one row group per shard) if the path ends
+    in ".parquet". Parquet output needs pyarrow.
+
+    Parameters:
+    - shards (iterable of dict): The output of iter_scores.
+    - output_path (str): The file to write.
+
+    Returns:
+    - int: The number of rows written.
+    """
+    rows = 0
+    if output_path.lower().endswith(".parquet"):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError as error:
+            raise ImportError("Writing Parquet files requires pyarrow (pip install pyarrow)") from error
+        writer = None
+        try:
+            for shard in shards:
+                table = pa.table({
+                    column: [str(value) for value in shard[column]] if column == "id" else shard[column]
+                    for column in COLUMNS
+                })
+                writer = writer or pq.ParquetWriter(output_path, table.schema)
+                writer.write_table(table)
+                rows += table.num_rows
+        finally:
+            if writer is not None:
+                writer.close()
+        return rows
+    with open(output_path, "w", encoding="utf-8", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(COLUMNS)
+        for shard in shards:
+            writer.writerows(zip(*(shard[column] for column in COLUMNS)))
+            rows += len(shard["id"])
+    return rows
+
+def score_corpus(hypotheses, references, ids=None, output_path=None, shard_size=1000, num_workers=1):
+    """
+    Compute cosine similarity, Flesch reading ease, ROUGE-1/2 and BLEU for every hypothesis/reference pair.
+
+    Parameters:
+    - hypotheses (list of str): Model-generated texts.
+    - references (list of str): Human-written texts, aligned with hypotheses.
+    - ids (list, optional): An identifier per pair (default: the pair's position).
+    - output_path (str, optional): Stream the scores to this CSV or Parquet file instead of returning them.
+    - shard_size (int): Pairs per shard (default: 1000).
+    - num_workers (int): Processes scoring shards in parallel (default: 1).
+
+    Returns:
+    - dict or int: The columns as NumPy arrays, or the number of rows written if output_path is given.
+    """
+    shards = iter_scores(hypotheses, references, ids=ids, shard_size=shard_size, num_workers=num_workers)
+    if output_path is not None:
+        return write_scores(shards, output_path)
+    shards = list(shards)
+    if not shards:
+        return {column: np.zeros(0) for column in COLUMNS}
+    return {column: np.concatenate([shard[column] for shard in shards]) for column in COLUMNS}
+
+#################################### Reference Implementation ########################################
+def naive_scores(hypothesis, reference, statistics):
+    """
+    Score one pair with plain Python loops over Counters. It is slow, and exists to check score_batch against.
+
+    Parameters:
+    - hypothesis (str): A model-generated text.
+    - reference (str): The human-written text.
+    - statistics (CorpusStatistics): The corpus statistics from fit_corpus.
+
+    Returns:
+    - dict: The same metric columns as score_batch, as floats.
+    """
+    hypothesis_tokens, reference_tokens = tokenize(hypothesis), tokenize(reference)
+    idf = {token: statistics.idf[column] for token, column in statistics.vocabulary.items()}
+    scores = {}
+
+    def tfidf(tokens):
+        vector = {token: count * idf[token] for token, count in Counter(tokens).items()}
+        norm = math.sqrt(sum(value * value for value in vector.values()))
+        return {token: value / norm for token, value in vector.items()} if norm else {}
+
+    hypothesis_vector, reference_vector = tfidf(hypothesis_tokens), tfidf(reference_tokens)
+    scores["cosine_similarity"] = sum(value * reference_vector.get(token, 0.0) for token, value in hypothesis_vector.items())
+
+    for name, text, tokens in (("hypothesis", hypothesis, hypothesis_tokens), ("reference", reference, reference_tokens)):
+        if tokens:
+            syllables = sum(count_syllables(token) for token in tokens)
+            scores[f"flesch_{name}"] = (
+                206.835 - 1.015 * len(tokens) / count_sentences(text) - 84.6 * syllables / len(tokens)
+            )
+        else:
+            scores[f"flesch_{name}"] = float("nan")
+
+    def ngrams(tokens, n):
+        return Counter(tuple(tokens[i:i + n]) for i in range(len(tokens) - n + 1))
+
+    log_precisions = []
+    for n in range(1, max(max(ROUGE_ORDERS), BLEU_ORDER) + 1):
+        hypothesis_ngrams, reference_ngrams = ngrams(hypothesis_tokens, n), ngrams(reference_tokens, n)
+        overlap = sum((hypothesis_ngrams & reference_ngrams).values())
+        hypothesis_total, reference_total = sum(hypothesis_ngrams.values()), sum(reference_ngrams.values())
+        if n in ROUGE_ORDERS:
+            precision = overlap / hypothesis_total if hypothesis_total else 0.0
+            recall = overlap / reference_total if reference_total else 0.0
+            scores[f"rouge{n}_precision"] = precision
+            scores[f"rouge{n}_recall"] = recall
+            scores[f"rouge{n}_f1"] = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+        if n <= BLEU_ORDER:
+            if n == 1:
+                precision = overlap / hypothesis_total if hypothesis_total else 0.0
+            else:
+                precision = (overlap + 1) / (hypothesis_total + 1)
+            log_precisions.append(math.log(precision) if precision > 0 else None)
+
+    if not hypothesis_tokens or log_precisions[0] is None:
+        scores["bleu"] = 0.0
+    else:
+        if len(hypothesis_tokens) > len(reference_tokens):
+            brevity_penalty = 1.0
+        else:
+            brevity_penalty = math.exp(1 - len(reference_tokens) / len(hypothesis_tokens))
+        scores["bleu"] = brevity_penalty * math.exp(sum(log_precisions) / len(log_precisions))
+    return scores
+
+def check_against_naive(hypotheses, references, sample=None, tolerance=1e-9, seed=0):
+    """
+    Compare score_batch with naive_scores on a corpus (or a random sample of its pairs).
+
+    Parameters:
+    - hypotheses (list of str): Model-generated texts.
+    - references (list of str): Human-written texts, aligned with hypotheses.
+    - sample (int, optional): Number of pairs to check (default: all of them).
+    - tolerance (float): Largest absolute difference accepted (default: 1e-9).
+    - seed (int): Seed for drawing the sample (default: 0).
+
+    Returns:
+    - dict: The largest absolute difference per metric column; raises AssertionError if one exceeds tolerance.
+    """
+    statistics = fit_corpus(hypotheses, references)
+    batch = score_batch(hypotheses, references, statistics)
+    indices = np.arange(len(hypotheses))
+    if sample is not None and sample < len(indices):
+        indices = np.random.default_rng(seed).choice(indices, size=sample, replace=False)
+    differences = {column: 0.0 for column in COLUMNS[1:]}
+    for index in indices:
+        expected = naive_scores(hypotheses[index], references[index], statistics)
+        for column in differences:
+            actual, wanted = batch[column][index], expected[column]
+            if math.isnan(actual) and math.isnan(wanted):
+                continue
+            differences[column] = max(differences[column], abs(actual - wanted))
+    worst = max(differences, key=differences.get)
+    if differences[worst] > tolerance:
+        raise AssertionError(f"{worst} differs from the reference implementation by {differences[worst]:.3g}")
+    return differences
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Score model-generated texts against references with cosine similarity, Flesch reading ease, ROUGE and BLEU."
+    )
+    parser.add_argument("hypothesis_folder", help="Folder of model-generated .txt files.")
+    parser.add_argument("reference_folder", help="Folder of reference .txt files with the same names.")
+    parser.add_argument("output_path", help="CSV file, or Parquet file if it ends in .parquet.")
+    parser.add_argument("--shard-size", type=int, default=1000, help="Pairs per shard (default: 1000).")
+    parser.add_argument("--workers", type=int, default=1, help="Processes scoring shards in parallel (default: 1).")
+    parser.add_argument("--check", type=int, default=0, metavar="N",
+                        help="First check N random pairs against the reference implementation.")
+    args = parser.parse_args()
+
+    ids, hypotheses, references = load_pairs(args.hypothesis_folder, args.reference_folder)
+    if args.check:
+        check_against_naive(hypotheses, references, sample=args.check)
+        print(f"Checked {min(args.check, len(ids))} pair(s) against the reference implementation.")
+    rows = score_corpus(
+        hypotheses, references, ids=ids, output_path=args.output_path,
+        shard_size=args.shard_size, num_workers=args.workers
+    )
+    print(f"Scored {rows} pair(s) and saved the results to {args.output_path}")
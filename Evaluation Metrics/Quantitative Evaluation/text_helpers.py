@@ -0,0 +1,33 @@
+import os
+import re
+
+# Shared by quantitative_metrics.py and embedding_store.py; kept free of third-party imports so the
+# embedding store runs without scipy
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:'[a-z]+)?")
+
+#################################### Text ########################################
+def tokenize(text):
+    """
+    Split a text into lowercase word tokens (letters and digits, keeping contractions such as "don't").
+    """
+    return TOKEN_PATTERN.findall(text.lower())
+
+#################################### Input ########################################
+def load_pairs(hypothesis_folder, reference_folder):
+    """
+    Pair the .txt files of two folders by file name (e.g., generated and human-written summaries).
+
+    Returns:
+    - tuple: (ids, hypotheses, references) for the file names present in both folders, sorted by name.
+    """
+    names = sorted(
+        set(name for name in os.listdir(hypothesis_folder) if name.endswith(".txt"))
+        & set(name for name in os.listdir(reference_folder) if name.endswith(".txt"))
+    )
+    hypotheses, references = [], []
+    for name in names:
+        with open(os.path.join(hypothesis_folder, name), "r", encoding="utf-8") as file:
+            hypotheses.append(file.read())
+        with open(os.path.join(reference_folder, name), "r", encoding="utf-8") as file:
+            references.append(file.read())
+    return names, hypotheses, references
@@ -0,0 +1,450 @@
+import os
+import io
+import json
+import time
+import hashlib
+from chunking import iter_chunks
+from deidentification import (
+    IDENTIFY_FUNCTIONS,
+    names_request,
+    locations_request,
+    dates_request,
+    entities_request,
+    parse_entity_list,
+    parse_entity_response,
+    apply_entity_mappings
+)
+from speaker_annotation import annotation_request, annotate_speaker_roles
+from manifest import atomic_write, file_sha256
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+# Provider limit on the number of requests in one batch input file
+MAX_REQUESTS_PER_FILE = 50000
+
+# Request builder for each category when categories are extracted separately
+REQUEST_BUILDERS = {
+    "names": names_request,
+    "locations": locations_request,
+    "dates": dates_request,
+}
+
+#################################### Compile Requests ########################################
+def file_key(file_name):
+    """
+    Stable short key for a transcript file, used in custom IDs instead of the file name itself.
+    """
+    return hashlib.sha256(file_name.encode("utf-8")).hexdigest()[:16]
+
+def _list_transcripts(input_folder):
+    return sorted(
+        file_name for file_name in os.listdir(input_folder)
+        if os.path.isfile(os.path.join(input_folder, file_name)) and file_name.endswith(".txt")
+    )
+
+def _write_requests(work_dir, stage, requests, max_requests_per_file):
+    # Split the requests over as many JSONL input files as the provider limit requires
+    paths = []
+    for part, start in enumerate(range(0, len(requests), max_requests_per_file)):
+        path = os.path.join(work_dir, f"{stage}_requests_{part:03d}.jsonl")
+        atomic_write(path, "".join(
+            json.dumps({"custom_id": custom_id, "method": "POST", "url": BATCH_ENDPOINT, "body": body}) + "\n"
+            for custom_id, body in requests[start:start + max_requests_per_file]
+        ))
+        paths.append(path)
+    return paths
+
+def compile_deidentify_requests(
+    input_folder,
+    work_dir,
+    deidentify_name=True,
+    deidentify_location=False,
+    deidentify_date=False,
+    model="gpt-4",
+    single_pass=True,
+    max_tokens=1000,
+    count_tokens=None,
+    max_requests_per_file=MAX_REQUESTS_PER_FILE
+):
+    """
+    Compile every de-identification prompt for a folder into batch API request files.
+
+    Custom IDs have the form "deid-<category>-<file key>-<batch index>", where the category is "entities"
+    for single-pass requests. An index file records each transcript's key and batch offsets, so the
+    results can be merged back without re-chunking.
+
+    Parameters:
+    - input_folder (str): Path to the input folder containing transcript files.
+    - work_dir (str): Folder for the request, index and job files. It holds transcript text, so keep it
+      somewhere as protected as the input folder.
+    - deidentify_name, deidentify_location, deidentify_date (bool): The categories to de-identify.
+    - model (str): The model to use for processing (default: "gpt-4").
+    - single_pass (bool): One request per batch for all categories instead of one per category (default: True).
+    - max_tokens (int): The size of each batch, measured with count_tokens (default: 1000).
+    - count_tokens (callable, optional): Maps a text to its size. Defaults to counting words.
+    - max_requests_per_file (int): Maximum requests per JSONL file (default: 50000).
+
+    Returns:
+    - list of str: Paths of the request files.
+    """
+    os.makedirs(work_dir, exist_ok=True)
+    categories = [
+        category for category, enabled in
+        (("names", deidentify_name), ("locations", deidentify_location), ("dates", deidentify_date))
+        if enabled
+    ]
+    single_pass = single_pass and len(categories) > 1
+
+    index = {"stage": "deidentify", "model": model, "categories": categories, "single_pass": single_pass, "files": {}}
+    requests = []
+    for file_name in _list_transcripts(input_folder):
+        with open(os.path.join(input_folder, file_name), "r") as file:
+            transcript = file.read()
+        key = file_key(file_name)
+        chunks = list(iter_chunks(transcript, max_tokens=max_tokens, count_tokens=count_tokens))
+        index["files"][file_name] = {"key": key, "spans": [[chunk.start, chunk.end] for chunk in chunks]}
+        for batch_index, chunk in enumerate(chunks):
+            if single_pass:
+                body = entities_request(chunk.text, model=model, categories=categories)
+                requests.append((f"deid-entities-{key}-{batch_index:05d}", body))
+            else:
+                for category in categories:
+                    body = REQUEST_BUILDERS[category](chunk.text, model=model)
+                    requests.append((f"deid-{category}-{key}-{batch_index:05d}", body))
+
+    atomic_write(os.path.join(work_dir, "deidentify_index.json"), json.dumps(index))
+    return _write_requests(work_dir, "deidentify", requests, max_requests_per_file)
+
+def compile_annotation_requests(
+    input_folder,
+    work_dir,
+    openai_chat_model="gpt-4",
+    max_tokens=1000,
+    count_tokens=None,
+    max_requests_per_file=MAX_REQUESTS_PER_FILE
+):
+    """
+    Compile every speaker annotation prompt for a folder into batch API request files.
+    Custom IDs have the form "annotate-<file key>-<batch index>".
+
+    Args:
+        input_folder (str): Path to the folder containing transcript files.
+        work_dir (str): Folder for the request, index and job files.
+        openai_chat_model (str): The model name to be used for OpenAI chat completion.
+        max_tokens (int): The size of each batch, measured with count_tokens (default: 1000).
+        count_tokens (callable, optional): Maps a text to its size. Defaults to counting words.
+        max_requests_per_file (int): Maximum requests per JSONL file (default: 50000).
+
+    Returns:
+        list of str: Paths of the request files.
+    """
+    os.makedirs(work_dir, exist_ok=True)
+    index = {"stage": "annotate", "model": openai_chat_model, "files": {}}
+    requests = []
+    for file_name in _list_transcripts(input_folder):
+        with open(os.path.join(input_folder, file_name), "r") as file:
+            transcript = file.read()
+        key = file_key(file_name)
+        chunks = list(iter_chunks(transcript, max_tokens=max_tokens, count_tokens=count_tokens))
+        index["files"][file_name] = {"key": key, "spans": [[chunk.start, chunk.end] for chunk in chunks]}
+        for batch_index, chunk in enumerate(chunks):
+            requests.append((f"annotate-{key}-{batch_index:05d}", annotation_request(chunk.text, openai_chat_model)))
+
+    atomic_write(os.path.join(work_dir, "annotate_index.json"), json.dumps(index))
+    return _write_requests(work_dir, "annotate", requests, max_requests_per_file)
+
+#################################### Submit, Poll, Download ########################################
+def submit_batches(client, request_paths, work_dir, stage, completion_window="24h"):
+    """
+    Upload the request files and create one batch job per file. The job IDs are saved in the work
+    folder, so an interrupted run can resume polling instead of submitting (and paying) again.
+
+    Parameters:
+    - client: The OpenAI API client instance.
+    - request_paths (list of str): The request files to submit.
+    - work_dir (str): The work folder.
+    - stage (str): "deidentify" or "annotate".
+    - completion_window (str): The batch completion window (default: "24h").
+
+    Returns:
+    - list of str: The batch job IDs.
+    """
+    jobs_path = os.path.join(work_dir, f"{stage}_jobs.json")
+    # Jobs are only resumed if the request files are exactly the ones that were submitted
+    request_hashes = [file_sha256(path) for path in request_paths]
+    if os.path.exists(jobs_path):
+        with open(jobs_path, "r") as file:
+            jobs = json.load(file)
+        if jobs["request_hashes"] == request_hashes:
+            print(f"Resuming {len(jobs['batch_ids'])} submitted batch job(s)")
+            return jobs["batch_ids"]
+
+    batch_ids = []
+    for path in request_paths:
+        with open(path, "rb") as file:
+            uploaded = client.files.create(file=file, purpose="batch")
+        batch = client.batches.create(
+            input_file_id=uploaded.id,
+            endpoint=BATCH_ENDPOINT,
+            completion_window=completion_window
+        )
+        batch_ids.append(batch.id)
+        print(f"Submitted {os.path.basename(path)} as batch {batch.id}")
+    atomic_write(jobs_path, json.dumps({"request_hashes": request_hashes, "batch_ids": batch_ids}))
+    return batch_ids
+
+def wait_for_batches(client, batch_ids, poll_interval=60, timeout=None, sleep=time.sleep):
+    """
+    Poll batch jobs until all of them have finished.
+
+    Parameters:
+    - client: The OpenAI API client instance.
+    - batch_ids (list of str): The batch job IDs.
+    - poll_interval (float): Seconds between polls (default: 60).
+    - timeout (float, optional): Give up after this many seconds.
+    - sleep (callable): Sleep function, replaceable for testing (default: time.sleep).
+
+    Returns:
+    - list: The finished batch objects. Failed, expired or cancelled jobs are included; any requests they
+      did not complete are retried synchronously when the results are merged.
+
+    Raises:
+    - TimeoutError: If the jobs have not finished within the timeout.
+    """
+    finished_statuses = {"completed", "failed", "expired", "cancelled"}
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    finished = {}
+    while True:
+        for batch_id in batch_ids:
+            if batch_id not in finished:
+                batch = client.batches.retrieve(batch_id)
+                if batch.status in finished_statuses:
+                    finished[batch_id] = batch
+                    print(f"Batch {batch_id} {batch.status}")
+        if len(finished) == len(batch_ids):
+            return [finished[batch_id] for batch_id in batch_ids]
+        if deadline is not None and time.monotonic() > deadline:
+            raise TimeoutError(f"{len(batch_ids) - len(finished)} batch job(s) still running")
+        sleep(poll_interval)
+
+def _file_text(client, file_id):
+    content = client.files.content(file_id)
+    if hasattr(content, "text"):
+        return content.text
+    return content.read().decode("utf-8")
+
+def download_results(client, batches):
+    """
+    Download the output files of finished batch jobs.
+
+    Parameters:
+    - client: The OpenAI API client instance.
+    - batches (list): The finished batch objects.
+
+    Returns:
+    - dict: A mapping of custom ID to the response message content, for every request that succeeded.
+    """
+    results = {}
+    for batch in batches:
+        if not getattr(batch, "output_file_id", None):
+            continue
+        for line in io.StringIO(_file_text(client, batch.output_file_id)):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            response = record.get("response") or {}
+            if record.get("error") or response.get("status_code") != 200:
+                continue
+            results[record["custom_id"]] = response["body"]["choices"][0]["message"]["content"]
+    return results
+
+#################################### Merge Results ########################################
+def _load_index(work_dir, stage):
+    with open(os.path.join(work_dir, f"{stage}_index.json"), "r") as file:
+        return json.load(file)
+
+def _batches(input_folder, file_name, spans):
+    with open(os.path.join(input_folder, file_name), "r") as file:
+        transcript = file.read()
+    return [transcript[start:end] for start, end in spans]
+
+def merge_deidentify_results(input_folder, output_folder, work_dir, results, client=None, return_mapping=False):
+    """
+    Turn downloaded batch results into the same de-identified files and mappings as deidentify_transcripts.
+    Requests without a usable result are retried synchronously with client.
+
+    Parameters:
+    - input_folder (str): Path to the input folder containing transcript files.
+    - output_folder (str): Path to the folder to save the de-identified transcripts.
+    - work_dir (str): The work folder holding the index file.
+    - results (dict): The downloaded results, from download_results.
+    - client: The OpenAI API client instance, used for retries (optional if every request succeeded).
+    - return_mapping (bool): Whether to return mappings for names, locations, and dates (default: False).
+
+    Returns:
+    - dict (optional): If return_mapping is True, returns a dictionary with mappings for names, locations, and dates.
+    """
+    index = _load_index(work_dir, "deidentify")
+    categories, model = index["categories"], index["model"]
+    os.makedirs(output_folder, exist_ok=True)
+    all_mappings = {"name_mappings": {}, "location_mappings": {}, "date_mappings": {}}
+    retried = 0
+
+    for file_name, entry in index["files"].items():
+        batches = _batches(input_folder, file_name, entry["spans"])
+        unique_entities = {category: set() for category in categories}
+        for batch_index, batch in enumerate(batches):
+            found = {}
+            if index["single_pass"]:
+                content = results.get(f"deid-entities-{entry['key']}-{batch_index:05d}")
+                try:
+                    found = parse_entity_response(content, categories) if content is not None else None
+                except ValueError:
+                    found = None
+            else:
+                for category in categories:
+                    content = results.get(f"deid-{category}-{entry['key']}-{batch_index:05d}")
+                    if content is not None:
+                        found[category] = parse_entity_list(content)
+            # Anything missing or invalid is asked for again, one category at a time
+            for category in categories:
+                if found is None or category not in found:
+                    if client is None:
+                        raise RuntimeError(f"No result for batch {batch_index} of {file_name} and no client to retry with")
+                    found = found or {}
+                    found[category] = IDENTIFY_FUNCTIONS[category](batch, client, model=model)
+                    retried += 1
+            for category in categories:
+                unique_entities[category].update(found[category])
+
+        batches, mappings = apply_entity_mappings(batches, unique_entities, categories)
+        atomic_write(os.path.join(output_folder, file_name), "".join(batch + "\n\n" for batch in batches))
+        print(f"De-identified transcript saved to {os.path.join(output_folder, file_name)}")
+        for category, prefix in (("names", "name"), ("locations", "location"), ("dates", "date")):
+            all_mappings[f"{prefix}_mappings"][file_name] = mappings.get(category, {})
+
+    if retried:
+        print(f"{retried} request(s) without a batch result were retried synchronously")
+    if return_mapping:
+        return all_mappings
+
+def merge_annotation_results(input_folder, output_folder, work_dir, results, client=None):
+    """
+    Turn downloaded batch results into the same annotated files as process_transcripts.
+    Requests without a result are retried synchronously with client.
+
+    Args:
+        input_folder (str): Path to the folder containing transcript files.
+        output_folder (str): Path to the folder where annotated files will be saved.
+        work_dir (str): The work folder holding the index file.
+        results (dict): The downloaded results, from download_results.
+        client: OpenAI client object, used for retries (optional if every request succeeded).
+    """
+    index = _load_index(work_dir, "annotate")
+    os.makedirs(output_folder, exist_ok=True)
+    for file_name, entry in index["files"].items():
+        annotated_batches = []
+        for batch_index, batch in enumerate(_batches(input_folder, file_name, entry["spans"])):
+            content = results.get(f"annotate-{entry['key']}-{batch_index:05d}")
+            if content is None:
+                if client is None:
+                    raise RuntimeError(f"No result for batch {batch_index} of {file_name} and no client to retry with")
+                content = annotate_speaker_roles(batch, client, index["model"])
+            annotated_batches.append(content)
+        atomic_write(os.path.join(output_folder, file_name), "\n".join(annotated_batches))
+        print(f"Processed and saved: {file_name}")
+
+#################################### Bulk Mode ########################################
+def bulk_deidentify_transcripts(
+    input_folder_path,
+    output_folder_path,
+    work_dir,
+    client,
+    deidentify_name=True,
+    deidentify_location=False,
+    deidentify_date=False,
+    model="gpt-4",
+    single_pass=True,
+    max_tokens=1000,
+    count_tokens=None,
+    poll_interval=60,
+    timeout=None,
+    return_mapping=False
+):
+    """
+    De-identify a folder through the provider's batch API instead of synchronous calls: compile the
+    prompts, submit them, wait for the jobs, download the results and write the same outputs as
+    deidentify_transcripts. Rerunning after an interruption resumes the already submitted jobs.
+
+    All categories are extracted from the original text of each batch (in the synchronous per-category
+    path, later categories see the earlier replacements).
+
+    Parameters:
+    - input_folder_path (str): Path to the input folder containing transcript files.
+    - output_folder_path (str): Path to the folder to save the de-identified transcripts.
+    - work_dir (str): Folder for the request, index and job files (contains transcript text).
+    - client: The OpenAI API client instance.
+    - deidentify_name, deidentify_location, deidentify_date (bool): The categories to de-identify.
+    - model (str): The model to use for processing (default: "gpt-4").
+    - single_pass (bool): One request per batch for all categories (default: True).
+    - max_tokens (int): The size of each batch (default: 1000).
+    - count_tokens (callable, optional): Maps a text to its size. Defaults to counting words.
+    - poll_interval (float): Seconds between status polls (default: 60).
+    - timeout (float, optional): Give up waiting after this many seconds.
+    - return_mapping (bool): Whether to return mappings for names, locations, and dates (default: False).
+
+    Returns:
+    - dict (optional): If return_mapping is True, returns a dictionary with mappings for names, locations, and dates.
+    """
+    request_paths = compile_deidentify_requests(
+        input_folder_path, work_dir,
+        deidentify_name=deidentify_name,
+        deidentify_location=deidentify_location,
+        deidentify_date=deidentify_date,
+        model=model,
+        single_pass=single_pass,
+        max_tokens=max_tokens,
+        count_tokens=count_tokens
+    )
+    batch_ids = submit_batches(client, request_paths, work_dir, "deidentify")
+    batches = wait_for_batches(client, batch_ids, poll_interval=poll_interval, timeout=timeout)
+    results = download_results(client, batches)
+    return merge_deidentify_results(
+        input_folder_path, output_folder_path, work_dir, results, client=client, return_mapping=return_mapping
+    )
+
+def bulk_process_transcripts(
+    input_folder,
+    output_folder,
+    work_dir,
+    client,
+    openai_chat_model="gpt-4",
+    max_tokens=1000,
+    count_tokens=None,
+    poll_interval=60,
+    timeout=None
+):
+    """
+    Annotate speaker roles for a folder through the provider's batch API, writing the same outputs as
+    process_transcripts. Rerunning after an interruption resumes the already submitted jobs.
+
+    Args:
+        input_folder (str): Path to the folder containing transcript files.
+        output_folder (str): Path to the folder where annotated files will be saved.
+        work_dir (str): Folder for the request, index and job files (contains transcript text).
+        client: OpenAI client object.
+        openai_chat_model (str): The model name to be used for OpenAI chat completion.
+        max_tokens (int): The size of each batch (default: 1000).
+        count_tokens (callable, optional): Maps a text to its size. Defaults to counting words.
+        poll_interval (float): Seconds between status polls (default: 60).
+        timeout (float, optional): Give up waiting after this many seconds.
+    """
+    request_paths = compile_annotation_requests(
+        input_folder, work_dir,
+        openai_chat_model=openai_chat_model,
+        max_tokens=max_tokens,
+        count_tokens=count_tokens
+    )
+    batch_ids = submit_batches(client, request_paths, work_dir, "annotate")
+    batches = wait_for_batches(client, batch_ids, poll_interval=poll_interval, timeout=timeout)
+    results = download_results(client, batches)
+    merge_annotation_results(input_folder, output_folder, work_dir, results, client=client)
@@ -0,0 +1,389 @@
+import os
+import io
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import contextlib
+import chunking
+from chunking import truncate_transcript
+from deidentification import substitute_entities, deidentify_transcripts
+from speaker_annotation import process_transcripts
+from llm_dispatch import LLMDispatcher
+from entity_prefilter import EntityPrefilter
+from fake_llm import FakeOpenAIClient
+from synthetic_transcripts import generate_corpus
+
+# Metrics where a higher value is better; for every other compared metric lower is better
+HIGHER_IS_BETTER = {"files_per_second", "batches_per_second"}
+COMPARED_METRICS = [
+    "files_per_second",
+    "batches_per_second",
+    "llm_calls_per_transcript",
+    "p50_latency_seconds",
+    "p95_latency_seconds",
+    "peak_rss_mb",
+]
+
+#################################### Measurements ########################################
+def percentile(values, q):
+    """
+    Linear-interpolated percentile of a list of numbers, or None if it is empty.
+
+    Parameters:
+    - values (list of float): The measurements.
+    - q (float): The percentile, between 0 and 100.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q / 100.0
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+def peak_rss_mb():
+    """
+    Peak resident set size of this process so far, in MiB, or None where the resource module is missing.
+    The operating system only reports the peak since the process started, so the figure for a stage
+    includes every stage that ran before it.
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024 * 1024) if platform.system() == "Darwin" else peak / 1024
+
+def summarize(wall_seconds, files, batches, latencies, client=None):
+    result = {
+        "files": files,
+        "batches": batches,
+        "wall_seconds": wall_seconds,
+        "files_per_second": files / wall_seconds if wall_seconds else None,
+        "batches_per_second": batches / wall_seconds if wall_seconds else None,
+        "p50_latency_seconds": percentile(latencies, 50),
+        "p95_latency_seconds": percentile(latencies, 95),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+    if client is not None:
+        result.update({
+            "llm_calls": client.calls,
+            "llm_calls_per_transcript": client.calls / files if files else None,
+            "llm_errors": client.errors,
+            "prompt_tokens": client.prompt_tokens,
+            "completion_tokens": client.completion_tokens,
+        })
+    return result
+
+def read_corpus(folder):
+    texts = {}
+    for file_name in sorted(os.listdir(folder)):
+        if file_name.endswith(".txt"):
+            with open(os.path.join(folder, file_name), "r", encoding="utf-8") as file:
+                texts[file_name] = file.read()
+    labels = {}
+    with open(os.path.join(folder, "labels.jsonl"), "r", encoding="utf-8") as file:
+        for line in file:
+            record = json.loads(line)
+            labels[record.pop("file")] = record
+    return texts, labels
+
+#################################### Benchmarks ########################################
+def benchmark_truncate(texts, max_tokens=1000):
+    """
+    Time truncate_transcript on each transcript, starting from an empty sentence cache every time
+    so repeated runs measure tokenisation rather than cache hits. Latencies are per transcript.
+    """
+    latencies = []
+    batches = 0
+    start = time.perf_counter()
+    for text in texts.values():
+        with chunking._SENTENCE_CACHE_LOCK:
+            chunking._SENTENCE_CACHE.clear()
+        call_start = time.perf_counter()
+        batches += len(truncate_transcript(text, max_words=max_tokens))
+        latencies.append(time.perf_counter() - call_start)
+    return summarize(time.perf_counter() - start, len(texts), batches, latencies)
+
+def benchmark_replacement(texts, labels, max_tokens=1000):
+    """
+    Time the entity replacement over each transcript's batches, using the ground-truth entities of the
+    synthetic corpus as the mapping. Latencies are per transcript.
+    """
+    work = []
+    for file_name, text in texts.items():
+        mapping = {}
+        for category, prefix in (("names", "NAME"), ("locations", "LOCATION"), ("dates", "DATE")):
+            for i, entity in enumerate(labels[file_name][category]):
+                mapping.setdefault(entity, f"{prefix}{i+1}")
+        work.append((truncate_transcript(text, max_words=max_tokens), mapping))
+    latencies = []
+    start = time.perf_counter()
+    for batches, mapping in work:
+        call_start = time.perf_counter()
+        substitute_entities(batches, mapping)
+        latencies.append(time.perf_counter() - call_start)
+    return summarize(time.perf_counter() - start, len(work), sum(len(batches) for batches, _ in work), latencies)
+
+def benchmark_deidentify(corpus_folder, output_folder, client, batches, dispatcher=None, max_file_workers=1,
+                         single_pass=True, max_tokens=1000):
+    """
+    Time deidentify_transcripts over the whole corpus (names, locations and dates) against the fake client.
+    Latencies are per API call, as seen by the client.
+    """
+    client.reset_stats()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        deidentify_transcripts(
+            corpus_folder, output_folder, deidentify_name=True, deidentify_location=True, deidentify_date=True,
+            client=client, dispatcher=dispatcher, max_file_workers=max_file_workers, single_pass=single_pass,
+            max_tokens=max_tokens, resume=False
+        )
+    wall_seconds = time.perf_counter() - start
+    files = len([name for name in os.listdir(corpus_folder) if name.endswith(".txt")])
+    return summarize(wall_seconds, files, batches, client.latencies, client)
+
+def benchmark_prefilter(corpus_folder, output_folder, client, batches, labels, dispatcher=None, max_file_workers=1,
+                        single_pass=True, max_tokens=1000):
+    """
+    Time deidentify_transcripts with the local pre-detector in front of the location and date lookups, on
+    the same path as benchmark_deidentify. Names are not pre-detected, so in single-pass mode every batch
+    still costs one call, narrowed to the categories the detector cannot resolve; with single_pass=False
+    the location and date calls are skipped outright. Also reports the calls and category lookups avoided
+    and the recall of each category against the corpus labels.
+    """
+    client.reset_stats()
+    prefilter = EntityPrefilter(categories=("locations", "dates"))
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        mappings = deidentify_transcripts(
+            corpus_folder, output_folder, deidentify_name=True, deidentify_location=True, deidentify_date=True,
+            client=client, dispatcher=dispatcher, max_file_workers=max_file_workers, single_pass=single_pass,
+            max_tokens=max_tokens, resume=False, return_mapping=True, prefilter=prefilter
+        )
+    wall_seconds = time.perf_counter() - start
+    files = len([name for name in os.listdir(corpus_folder) if name.endswith(".txt")])
+    result = summarize(wall_seconds, files, batches, client.latencies, client)
+    summary = prefilter.summary()
+    result["calls_avoided"] = summary["calls_avoided"]
+    result["categories_avoided"] = summary["categories_avoided"]
+    for category, key in (("locations", "location_mappings"), ("dates", "date_mappings")):
+        found = sum(len(set(labels[name][category]) & set(mappings[key][name])) for name in labels)
+        total = sum(len(labels[name][category]) for name in labels)
+        result[f"{category}_recall"] = found / total if total else 1.0
+    return result
+
+def benchmark_annotate(corpus_folder, output_folder, client, batches, max_tokens=1000, mode="rewrite"):
+    """
+    Time process_transcripts over the whole corpus against the fake client, in rewrite or labels mode.
+    Latencies are per API call.
+    """
+    client.reset_stats()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        process_transcripts(corpus_folder, output_folder, client, max_tokens=max_tokens, resume=False, mode=mode)
+    wall_seconds = time.perf_counter() - start
+    files = len([name for name in os.listdir(corpus_folder) if name.endswith(".txt")])
+    return summarize(wall_seconds, files, batches, client.latencies, client)
+
+def run_benchmarks(
+    work_folder,
+    count=20,
+    seed=0,
+    turns=(20, 80),
+    entity_density=0.3,
+    max_tokens=1000,
+    latency=("lognormal", 0.8, 0.5),
+    seconds_per_output_token=0.0,
+    error_rate=0.0,
+    time_scale=0.01,
+    max_concurrency=8,
+    max_file_workers=4
+):
+    """
+    Generate a synthetic corpus and benchmark chunking, entity replacement and the two folder runs.
+
+    Parameters:
+    - work_folder (str): Folder for the corpus and the outputs of the folder runs.
+    - count (int): Number of synthetic transcripts (default: 20).
+    - seed (int): Seed for the corpus and the fake client (default: 0).
+    - turns (tuple of int): Minimum and maximum speaker turns per transcript (default: (20, 80)).
+    - entity_density (float): Probability that a turn mentions entities (default: 0.3).
+    - max_tokens (int): Batch size sent to the model (default: 1000).
+    - latency (tuple): Fake API latency distribution, see fake_llm.sample_latency.
+    - seconds_per_output_token (float): Extra fake API latency per generated token (default: 0.0). Set it to
+      compare the rewrite and label annotation modes, whose difference is mostly in output length.
+    - error_rate (float): Share of fake API calls that fail with a retryable error (default: 0.0).
+    - time_scale (float): Multiplies the simulated API delays (default: 0.01, i.e. 100x faster than real time).
+    - max_concurrency (int): API calls in flight in the concurrent de-identification run (default: 8).
+    - max_file_workers (int): Files de-identified at the same time in the concurrent run (default: 4).
+
+    Returns:
+    - dict: The configuration and one result dict per benchmark.
+    """
+    corpus_folder = os.path.join(work_folder, "corpus")
+    generate_corpus(corpus_folder, count=count, seed=seed, turns=turns, entity_density=entity_density)
+    texts, labels = read_corpus(corpus_folder)
+    batches = sum(len(truncate_transcript(text, max_words=max_tokens)) for text in texts.values())
+
+    def make_client():
+        return FakeOpenAIClient(
+            latency=latency, seconds_per_output_token=seconds_per_output_token, error_rate=error_rate,
+            time_scale=time_scale, seed=seed
+        )
+
+    # Retries wait in simulated time too, so errors cost the same share of the run as they would for real
+    def make_dispatcher():
+        return LLMDispatcher(
+            max_concurrency=max_concurrency, base_delay=1.0 * time_scale, max_delay=60.0 * time_scale, seed=seed
+        )
+
+    results = {}
+    results["truncate_transcript"] = benchmark_truncate(texts, max_tokens=max_tokens)
+    results["replacement"] = benchmark_replacement(texts, labels, max_tokens=max_tokens)
+    results["deidentify_serial"] = benchmark_deidentify(
+        corpus_folder, os.path.join(work_folder, "deidentified_serial"), make_client(), batches,
+        dispatcher=make_dispatcher() if error_rate else None, max_file_workers=1, max_tokens=max_tokens
+    )
+    results["deidentify_concurrent"] = benchmark_deidentify(
+        corpus_folder, os.path.join(work_folder, "deidentified_concurrent"), make_client(), batches,
+        dispatcher=make_dispatcher(), max_file_workers=max_file_workers, max_tokens=max_tokens
+    )
+    results["deidentify_prefiltered"] = benchmark_prefilter(
+        corpus_folder, os.path.join(work_folder, "deidentified_prefiltered"), make_client(), batches, labels,
+        dispatcher=make_dispatcher(), max_file_workers=max_file_workers, max_tokens=max_tokens
+    )
+    if not error_rate:
+        # process_transcripts does not retry, so it only runs against an error-free backend
+        results["annotate"] = benchmark_annotate(
+            corpus_folder, os.path.join(work_folder, "annotated"), make_client(), batches, max_tokens=max_tokens
+        )
+        results["annotate_labels"] = benchmark_annotate(
+            corpus_folder, os.path.join(work_folder, "annotated_labels"), make_client(), batches,
+            max_tokens=max_tokens, mode="labels"
+        )
+    config = {
+        "count": count,
+        "seed": seed,
+        "turns": list(turns),
+        "entity_density": entity_density,
+        "max_tokens": max_tokens,
+        "latency": list(latency),
+        "error_rate": error_rate,
+        "time_scale": time_scale,
+        "max_concurrency": max_concurrency,
+        "max_file_workers": max_file_workers,
+        "seconds_per_output_token": seconds_per_output_token,
+    }
+    return {"config": config, "results": results}
+
+#################################### Baselines ########################################
+def save_results(results, path):
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump(results, file, indent=2)
+
+def compare_results(current, baseline, tolerance=0.1):
+    """
+    Compare a benchmark run against a saved baseline.
+
+    Parameters:
+    - current (dict): The result of run_benchmarks.
+    - baseline (dict): A previously saved result of run_benchmarks.
+    - tolerance (float): Relative change treated as noise (default: 0.1, i.e. 10%).
+
+    Returns:
+    - list of dict: One row per benchmark and metric with both values, the relative change, and a verdict
+      of "faster", "slower" or "same" ("better"/"worse" for non-time metrics).
+    """
+    if current.get("config") != baseline.get("config"):
+        print("Warning: the baseline was recorded with a different configuration.")
+    rows = []
+    for name, result in current["results"].items():
+        previous = baseline["results"].get(name)
+        if previous is None:
+            continue
+        for metric in COMPARED_METRICS:
+            new, old = result.get(metric), previous.get(metric)
+            if new is None or old is None:
+                continue
+            change = (new - old) / old if old else 0.0
+            improved = change > 0 if metric in HIGHER_IS_BETTER else change < 0
+            if abs(change) <= tolerance:
+                verdict = "same"
+            elif metric in ("peak_rss_mb", "llm_calls_per_transcript"):
+                verdict = "better" if improved else "worse"
+            else:
+                verdict = "faster" if improved else "slower"
+            rows.append({"benchmark": name, "metric": metric, "baseline": old, "current": new,
+                         "change": change, "verdict": verdict})
+    return rows
+
+def print_results(results):
+    for name, result in results["results"].items():
+        calls = result.get("llm_calls_per_transcript")
+        print(
+            f"{name:<24} {result['files_per_second']:10.2f} files/s {result['batches_per_second']:10.2f} batches/s"
+            f"  p50 {result['p50_latency_seconds'] * 1000:9.2f} ms  p95 {result['p95_latency_seconds'] * 1000:9.2f} ms"
+            + (f"  {calls:5.2f} calls/file" if calls is not None else "")
+            + (f"  peak RSS {result['peak_rss_mb']:.0f} MiB" if result["peak_rss_mb"] is not None else "")
+        )
+
+#################################### Command Line ########################################
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the de-identification and annotation stages against a simulated API."
+    )
+    parser.add_argument("--count", type=int, default=20, help="Synthetic transcripts to generate (default: 20).")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--min-turns", type=int, default=20)
+    parser.add_argument("--max-turns", type=int, default=80)
+    parser.add_argument("--entity-density", type=float, default=0.3)
+    parser.add_argument("--max-tokens", type=int, default=1000, help="Batch size sent to the model (default: 1000).")
+    parser.add_argument("--latency", nargs="+", default=["lognormal", "0.8", "0.5"],
+                        help="API latency distribution and parameters (default: lognormal 0.8 0.5).")
+    parser.add_argument("--seconds-per-output-token", type=float, default=0.0,
+                        help="Extra API latency per generated token (default: 0).")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of API calls that fail (default: 0).")
+    parser.add_argument("--time-scale", type=float, default=0.01,
+                        help="Multiplier for simulated delays (default: 0.01).")
+    parser.add_argument("--max-concurrency", type=int, default=8)
+    parser.add_argument("--max-file-workers", type=int, default=4)
+    parser.add_argument("--work-folder", default=None,
+                        help="Keep the corpus and outputs here instead of a temporary folder.")
+    parser.add_argument("--save", default=None, help="Save the results as a baseline JSON file.")
+    parser.add_argument("--compare", default=None, help="Compare against a saved baseline JSON file.")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Relative change treated as noise (default: 0.1).")
+    args = parser.parse_args(argv)
+
+    latency = (args.latency[0], *(float(value) for value in args.latency[1:]))
+    with contextlib.ExitStack() as stack:
+        work_folder = args.work_folder or stack.enter_context(tempfile.TemporaryDirectory())
+        results = run_benchmarks(
+            work_folder, count=args.count, seed=args.seed, turns=(args.min_turns, args.max_turns),
+            entity_density=args.entity_density, max_tokens=args.max_tokens, latency=latency,
+            seconds_per_output_token=args.seconds_per_output_token, error_rate=args.error_rate,
+            time_scale=args.time_scale, max_concurrency=args.max_concurrency, max_file_workers=args.max_file_workers
+        )
+    print_results(results)
+
+    if args.save:
+        save_results(results, args.save)
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as file:
+            baseline = json.load(file)
+        regressions = 0
+        for row in compare_results(results, baseline, tolerance=args.tolerance):
+            print(
+                f"{row['benchmark']:<24} {row['metric']:<26} {row['baseline']:12.4f} -> {row['current']:12.4f}"
+                f"  {row['change'] * 100:+7.1f}%  {row['verdict']}"
+            )
+            regressions += row["verdict"] in ("slower", "worse")
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,94 @@
+import re
+import random
+import time
+import argparse
+from entity_replacement import replace_entities
+
+#################################### Baseline ########################################
+def naive_replace(text, mapping):
+    # The original per-line, per-entity loop used by the replace_*_with_identifiers functions
+    updated_lines = []
+    for line in text.splitlines():
+        updated_line = line
+        for entity, identifier in mapping.items():
+            updated_line = re.sub(rf'\b{re.escape(entity)}\b', identifier, updated_line)
+        updated_lines.append(updated_line)
+    return "\n".join(updated_lines)
+
+#################################### Synthetic Data ########################################
+FIRST_NAMES = ["Ann", "Bob", "Carol", "David", "Elena", "Farid", "Grace", "Hiro", "Ines", "Jamal"]
+LAST_NAMES = ["Lee", "Smith", "Garcia", "Nguyen", "Okafor", "Patel", "Rossi", "Kim", "Novak", "Haddad"]
+FILLER = "the patient reports mild pain in the lower back since last week and asks about medication".split()
+
+def make_entities(count, rng):
+    # Each base name appears once, with or without a title, so no entity nests inside another
+    entities = {}
+    while len(entities) < count:
+        name = f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}{rng.randint(0, 999)}"
+        entities[name] = name if rng.random() < 0.7 else "Dr. " + name
+    return sorted(entities.values())
+
+def make_transcript(words, entities, rng, lines_every=40):
+    tokens = []
+    for i in range(words):
+        tokens.append(rng.choice(entities) if rng.random() < 0.02 else rng.choice(FILLER))
+        if i % lines_every == lines_every - 1:
+            tokens.append("\n")
+    return " ".join(tokens).strip()
+
+#################################### Benchmark ########################################
+def time_call(function, *args, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def run_benchmark(entity_counts=(10, 100, 500), word_counts=(1000, 10000, 50000), seed=0, repeat=3):
+    """
+    Time the compiled single-pass engine against the original per-line loop for growing numbers of
+    entities and transcript lengths, checking that both produce the same output.
+
+    Parameters:
+    - entity_counts (iterable of int): Mapping sizes to test.
+    - word_counts (iterable of int): Transcript lengths (in words) to test.
+    - seed (int): Seed for the synthetic data.
+    - repeat (int): Repetitions per measurement; the best time is reported.
+
+    Returns:
+    - list of dict: One row per (entities, words) combination with both timings and the speedup.
+    """
+    rng = random.Random(seed)
+    rows = []
+    for entity_count in entity_counts:
+        entities = make_entities(entity_count, rng)
+        mapping = {entity: f"NAME{i+1}" for i, entity in enumerate(entities)}
+        for word_count in word_counts:
+            text = make_transcript(word_count, entities, rng)
+            same_output = naive_replace(text, mapping) == replace_entities(text, mapping)
+            naive_seconds = time_call(naive_replace, text, mapping, repeat=repeat)
+            compiled_seconds = time_call(replace_entities, text, mapping, repeat=repeat)
+            rows.append({
+                "entities": entity_count,
+                "words": word_count,
+                "naive_seconds": naive_seconds,
+                "compiled_seconds": compiled_seconds,
+                "speedup": naive_seconds / compiled_seconds if compiled_seconds else float("inf"),
+                "same_output": same_output,
+            })
+            print(
+                f"{entity_count:>5} entities {word_count:>7} words: "
+                f"naive {naive_seconds:8.4f}s  compiled {compiled_seconds:8.4f}s  "
+                f"speedup {rows[-1]['speedup']:7.1f}x  same output: {same_output}"
+            )
+    return rows
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Micro-benchmark for entity replacement.")
+    parser.add_argument("--entities", type=int, nargs="+", default=[10, 100, 500])
+    parser.add_argument("--words", type=int, nargs="+", default=[1000, 10000, 50000])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    run_benchmark(args.entities, args.words, seed=args.seed, repeat=args.repeat)
@@ -0,0 +1,259 @@
+import re
+import hashlib
+import threading
+from collections import OrderedDict, namedtuple
+from nltk.tokenize import sent_tokenize
+
+# A chunk of a transcript together with its character offsets into the original text
+Chunk = namedtuple("Chunk", ["text", "start", "end"])
+
+#################################### Token Counting ########################################
+def count_words(text):
+    """
+    Count whitespace-separated words, the budget unit used by the original word-based batching.
+
+    Parameters:
+    - text (str): The text to measure.
+
+    Returns:
+    - int: The number of words.
+    """
+    return len(text.split())
+
+def tiktoken_counter(model="gpt-4"):
+    """
+    Build a token counter that measures text in the model's own tokens. Requires the tiktoken package.
+
+    Parameters:
+    - model (str): The model whose tokenizer to use (default: "gpt-4").
+
+    Returns:
+    - callable: A function mapping a text to its token count.
+    """
+    import tiktoken
+    try:
+        encoding = tiktoken.encoding_for_model(model)
+    except KeyError:
+        encoding = tiktoken.get_encoding("cl100k_base")
+
+    def count_tokens(text):
+        return len(encoding.encode(text, disallowed_special=()))
+    count_tokens.__name__ = f"tiktoken:{encoding.name}"
+    return count_tokens
+
+#################################### Sentence Segmentation ########################################
+_SENTENCE_CACHE = OrderedDict()
+_SENTENCE_CACHE_SIZE = 128
+_SENTENCE_CACHE_LOCK = threading.Lock()
+
+def _locate(text, sentence, position):
+    # sent_tokenize returns slices of the text, so a plain search from the previous end finds them
+    start = text.find(sentence, position)
+    if start != -1:
+        return start, start + len(sentence)
+    # Fall back to matching the sentence's words with any whitespace in between
+    pattern = r"\s+".join(re.escape(word) for word in sentence.split())
+    match = re.compile(pattern).search(text, position)
+    if match is None:
+        return None
+    return match.start(), match.end()
+
+def _segment(text, language="english"):
+    spans = []
+    position = 0
+    for sentence in sent_tokenize(text, language=language):
+        span = _locate(text, sentence, position)
+        if span is not None:
+            spans.append(span)
+            position = span[1]
+    return tuple(spans)
+
+def sentence_spans(text, language="english"):
+    """
+    Split a text into sentences and return their character offsets. Results are cached per document
+    (keyed on a hash of its content), so several stages chunking the same transcript segment it once.
+
+    Parameters:
+    - text (str): The text to segment.
+    - language (str): The language passed to sent_tokenize (default: "english").
+
+    Returns:
+    - tuple of (int, int): The (start, end) offset of each sentence.
+    """
+    key = (hashlib.sha1(text.encode("utf-8")).hexdigest(), language)
+    with _SENTENCE_CACHE_LOCK:
+        if key in _SENTENCE_CACHE:
+            _SENTENCE_CACHE.move_to_end(key)
+            return _SENTENCE_CACHE[key]
+
+    spans = _segment(text, language=language)
+
+    with _SENTENCE_CACHE_LOCK:
+        _SENTENCE_CACHE[key] = spans
+        if len(_SENTENCE_CACHE) > _SENTENCE_CACHE_SIZE:
+            _SENTENCE_CACHE.popitem(last=False)
+    return spans
+
+#################################### Chunking ########################################
+_WORD = re.compile(r"\S+")
+
+def _split_words(text, start, end, max_tokens, count_tokens):
+    # Cut text[start:end] at whitespace into pieces of at most max_tokens (a longer single word is a piece of
+    # its own). Returns the spans of the full pieces and the start of the last, still growing one.
+    pieces = []
+    piece_start = piece_end = None
+    total = 0
+    for match in _WORD.finditer(text, start, end):
+        size = count_tokens(match.group())
+        if piece_start is not None and total + size > max_tokens:
+            pieces.append((piece_start, piece_end))
+            piece_start = None
+        if piece_start is None:
+            piece_start, total = match.start(), 0
+        piece_end = match.end()
+        total += size
+    return pieces, piece_start if piece_start is not None else end
+
+def _units(text, spans, max_tokens, count_tokens):
+    # The units chunks are built from: the sentences, with each one over the budget cut at whitespace into
+    # full pieces, which become chunks of their own, and a last piece, which can share a chunk with the
+    # sentences after it. Returns the unit spans, their sizes and the indices of the full pieces.
+    units, sizes, cut = [], [], set()
+    for start, end in spans:
+        size = count_tokens(text[start:end])
+        if size > max_tokens:
+            pieces, start = _split_words(text, start, end, max_tokens, count_tokens)
+            for piece in pieces:
+                cut.add(len(units))
+                units.append(piece)
+                sizes.append(count_tokens(text[piece[0]:piece[1]]))
+            if start == end:
+                continue
+            size = count_tokens(text[start:end])
+        units.append((start, end))
+        sizes.append(size)
+    return units, sizes, cut
+
+def _chunk_end(first, sizes, cut, max_tokens):
+    # Grow a chunk unit by unit until the next one would exceed the budget or is a piece of its own
+    last = first
+    total = sizes[first]
+    while (last + 1 < len(sizes) and last not in cut and last + 1 not in cut
+           and total + sizes[last + 1] <= max_tokens):
+        last += 1
+        total += sizes[last]
+    return last
+
+def iter_chunks(text, max_tokens=1000, count_tokens=None, overlap_sentences=0, language="english"):
+    """
+    Lazily split a transcript into chunks of whole sentences that fit a token budget.
+
+    Each chunk is a slice of the original text, so whitespace and line breaks inside it are kept.
+    A single sentence longer than the budget is cut at whitespace: every full piece of max_tokens becomes
+    a chunk of its own, and the rest of the sentence starts the next chunk.
+
+    Parameters:
+    - text (str): The transcript to split.
+    - max_tokens (int): The budget per chunk, measured with count_tokens (default: 1000).
+    - count_tokens (callable, optional): Maps a text to its size in tokens. Defaults to counting words;
+      use tiktoken_counter(model) to budget in model tokens.
+    - overlap_sentences (int): Number of sentences from the end of each chunk repeated at the start
+      of the next one, for context (default: 0).
+    - language (str): The language passed to sent_tokenize (default: "english").
+
+    Yields:
+    - Chunk: The chunk text and its (start, end) character offsets into text.
+    """
+    count_tokens = count_tokens or count_words
+    spans, sizes, cut = _units(text, sentence_spans(text, language=language), max_tokens, count_tokens)
+
+    first = 0
+    while first < len(spans):
+        last = _chunk_end(first, sizes, cut, max_tokens)
+        yield Chunk(text[spans[first][0]:spans[last][1]], spans[first][0], spans[last][1])
+
+        # Start the next chunk with up to overlap_sentences of context, as long as they leave room
+        # for at least one new sentence and do not restart the chunk just emitted
+        next_first = last + 1
+        room = max_tokens - sizes[next_first] if next_first < len(spans) and next_first not in cut else 0
+        back = 0
+        while (back < overlap_sentences and next_first - back - 1 > first
+               and next_first - back - 1 not in cut and sizes[next_first - back - 1] <= room):
+            room -= sizes[next_first - back - 1]
+            back += 1
+        first = next_first - back
+
+def truncate_transcript(text, max_words=1000, count_tokens=None):
+    """
+    Split a transcript into batches of whole sentences that fit a budget.
+
+    Parameters:
+    - text (str): The transcript to split.
+    - max_words (int): The budget per batch, measured with count_tokens (default: 1000).
+    - count_tokens (callable, optional): Maps a text to its size. Defaults to counting words.
+
+    Returns:
+    - list of str: The batches, each a slice of the original text.
+    """
+    return [chunk.text for chunk in iter_chunks(text, max_tokens=max_words, count_tokens=count_tokens)]
+
+def iter_file_chunks(path, max_tokens=1000, count_tokens=None, language="english", block_size=1 << 16, encoding="utf-8"):
+    """
+    Split a transcript file into chunks of whole sentences that fit a token budget, reading it block by
+    block instead of all at once. Memory use depends on the budget and block size, not the file size.
+
+    Only the text not yet emitted is kept and segmented: the last sentence of the text read so far may be
+    cut off by the block boundary, so it waits for the next block. Chunks are formed as by iter_chunks
+    (without overlap), including its rule for sentences over the budget, so they usually match iter_chunks
+    on the whole file; sentence boundaries near a block boundary can differ slightly where the tokenizer
+    needed more context. An unfinished sentence that grows past the budget, such as an unpunctuated
+    transcript with no sentence boundary at all, is cut as soon as its full pieces are known, so it never
+    has to be held whole.
+
+    Parameters:
+    - path (str): Path of the transcript file.
+    - max_tokens (int): The budget per chunk, measured with count_tokens (default: 1000).
+    - count_tokens (callable, optional): Maps a text to its size in tokens. Defaults to counting words.
+    - language (str): The language passed to sent_tokenize (default: "english").
+    - block_size (int): Characters read per step (default: 65536).
+    - encoding (str): The file encoding (default: "utf-8").
+
+    Yields:
+    - Chunk: The chunk text and its (start, end) character offsets into the file's text.
+    """
+    count_tokens = count_tokens or count_words
+    pending = ""
+    offset = 0  # Position of pending in the file's text
+    with open(path, "r", encoding=encoding) as file:
+        finished = False
+        while not finished:
+            block = file.read(block_size)
+            finished = not block
+            pending += block
+            spans = _segment(pending, language=language)
+            # Every sentence but the last is complete; at the end of the file, the last one is too
+            units, sizes, cut = _units(pending, spans if finished else spans[:-1], max_tokens, count_tokens)
+
+            first = 0
+            consumed = 0
+            while first < len(units):
+                last = _chunk_end(first, sizes, cut, max_tokens)
+                # A chunk that could still grow waits for the next block, unless the file has ended
+                if last + 1 == len(units) and last not in cut and not finished:
+                    break
+                start, end = units[first][0], units[last][1]
+                yield Chunk(pending[start:end], offset + start, offset + end)
+                consumed = end
+                first = last + 1
+
+            # An unfinished sentence over the budget cannot join the waiting chunk, so emit that chunk
+            # and the sentence's full pieces, keeping only its last piece for the next block
+            if not finished and spans and count_tokens(pending[spans[-1][0]:]) > max_tokens:
+                if first < len(units):
+                    start, end = units[first][0], units[-1][1]
+                    yield Chunk(pending[start:end], offset + start, offset + end)
+                pieces, consumed = _split_words(pending, spans[-1][0], len(pending), max_tokens, count_tokens)
+                for start, end in pieces:
+                    yield Chunk(pending[start:end], offset + start, offset + end)
+            pending = pending[consumed:]
+            offset += consumed
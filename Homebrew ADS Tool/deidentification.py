@@ -1,55 +1,92 @@
-import re
 import os
+import json
+import itertools
+from concurrent.futures import ThreadPoolExecutor
 from openai import OpenAI
 from dotenv import load_dotenv
-from nltk.tokenize import sent_tokenize
+from chunking import truncate_transcript, iter_file_chunks
+from entity_replacement import replace_entities
+from llm_cache import with_cache
+from manifest import StageManifest, atomic_open, atomic_write, file_sha256, params_fingerprint, tokenizer_name
+from telemetry import instrument, track
+from mapping_store import MappingStore
 
 load_dotenv()
 client = OpenAI(
     api_key = 'Your Key',
 )
 
-#################################### Truncate Text ########################################
-def truncate_transcript(text, max_words=1000):
-    sentences = sent_tokenize(text)
-    current_count = 0
-    batch = []
-    batches = []
-    for sentence in sentences:
-        sentence_words = sentence.split()
-        sentence_length = len(sentence_words)
-        # If adding this sentence exceeds the limit, store the current batch and start a new one
-        if current_count + sentence_length > max_words:
-            if batch:
-                batches.append(' '.join(batch))
-                batch = []
-                current_count = 0
-        batch.extend(sentence_words)
-        current_count += sentence_length
-    # Add the last batch if there's any remaining
-    if batch:
-        batches.append(' '.join(batch))
-    return batches
+#################################### Batch Helpers ########################################
+def collect_entities(identify_function, batches, client, model="gpt-4", dispatcher=None, prefilter=None, **kwargs):
+    """
+    Run an identify_* function over every batch, serially or through a dispatcher.
+
+    Parameters:
+    - identify_function (callable): One of identify_names, identify_locations or identify_dates.
+    - batches (list of str): A list of text batches.
+    - client: The OpenAI API client instance.
+    - model (str): The model to use for processing (default: "gpt-4").
+    - dispatcher (LLMDispatcher, optional): Runs the calls concurrently with rate-limit backoff.
+    - prefilter (EntityPrefilter, optional): Resolves batches without candidate entities locally, so only
+      the others are sent to the model.
+    - **kwargs: Extra keyword arguments passed to identify_function.
+
+    Returns:
+    - list: The result for each batch, in the same order as batches.
+    """
+    if prefilter is not None:
+        return prefilter.collect(
+            identify_function, batches, client, model=model, dispatcher=dispatcher,
+            category=FUNCTION_CATEGORIES.get(identify_function), **kwargs
+        )
+    if dispatcher is None:
+        return [identify_function(batch, client, model=model, **kwargs) for batch in batches]
+    return dispatcher.map(identify_function, batches, client, model=model, **kwargs)
+
+def parse_entity_list(response):
+    """
+    Parse a comma-separated list of entities returned by the model, ignoring the word "None".
+
+    Parameters:
+    - response (str): The raw model response.
+
+    Returns:
+    - set: The extracted entities.
+    """
+    return {entity.strip() for entity in response.split(',') if entity.strip() and entity.strip() != "None"}
+
+def substitute_entities(batches, mapping):
+    """
+    Replace every occurrence of the mapped entities in the batches with their identifiers.
+    All batches share one compiled matcher and each batch is rewritten in a single pass.
+
+    Parameters:
+    - batches (list of str): A list of text batches.
+    - mapping (dict): A mapping of original entities to their identifiers.
+
+    Returns:
+    - list of str: The updated batches, with line breaks and formatting preserved.
+    """
+    return [replace_entities(batch, mapping) for batch in batches]
 
 
 #################################### Deidentify Names ########################################
-def identify_names(transcript_batch, client, model="gpt-4"):
+def names_request(transcript_batch, model="gpt-4"):
     """
-    Extracts all the possible names from the text. Uses the specified model to process the text.
+    Build the chat completion request that asks the model for the names in a transcript batch.
 
     Parameters:
     - transcript_batch (str): The text batch to analyze.
-    - client: The OpenAI API client instance.
     - model (str): The model to use for processing (default: "gpt-4").
 
     Returns:
-    - set: A set of extracted names. If no names are found, returns an empty set.
+    - dict: The keyword arguments for client.chat.completions.create.
     """
     instructions = """
     Extract all the possible names from the text. Return all names mentioned in the text as it is separated by commas. If there are no names, return the word None. Note some names are in lower case. 
     """
     user_content = instructions + '\n\n' + transcript_batch
-    chat_completion = client.chat.completions.create(
+    return dict(
         model=model,
         messages=[
             {
@@ -62,12 +99,25 @@ def identify_names(transcript_batch, client, model="gpt-4"):
             }
         ]
     )
+
+def identify_names(transcript_batch, client, model="gpt-4"):
+    """
+    Extracts all the possible names from the text. Uses the specified model to process the text.
+
+    Parameters:
+    - transcript_batch (str): The text batch to analyze.
+    - client: The OpenAI API client instance.
+    - model (str): The model to use for processing (default: "gpt-4").
+
+    Returns:
+    - set: A set of extracted names. If no names are found, returns an empty set.
+    """
+    chat_completion = client.chat.completions.create(**names_request(transcript_batch, model=model))
     # Extract the response content, assuming it returns names as a comma-separated list
     response = chat_completion.choices[0].message.content
-    names = {name.strip() for name in response.split(',') if name.strip() != "None"}
-    return names
+    return parse_entity_list(response)
 
-def replace_names_with_identifiers(batches, client, model="gpt-4"):
+def replace_names_with_identifiers(batches, client, model="gpt-4", dispatcher=None, prefilter=None):
     """
     Replace names in text batches with unique identifiers.
 
@@ -75,6 +125,8 @@ def replace_names_with_identifiers(batches, client, model="gpt-4"):
     - batches (list of str): A list of text batches.
     - client: The OpenAI API client instance.
     - model (str): The model to use for processing (default: "gpt-4").
+    - dispatcher (LLMDispatcher, optional): Runs the per-batch API calls concurrently. If None, batches are processed one at a time.
+    - prefilter (EntityPrefilter, optional): Skips the API call for batches it can resolve locally.
 
     Returns:
     - updated_batches (list of str): The text batches with names replaced by unique identifiers.
@@ -83,50 +135,34 @@ def replace_names_with_identifiers(batches, client, model="gpt-4"):
     unique_names = set()
     
     # Step 1: Collect all unique names from all batches using OpenAI API
-    for batch in batches:
-        unique_names.update(identify_names(batch, client, model=model))
+    for names in collect_entities(identify_names, batches, client, model, dispatcher, prefilter):
+        unique_names.update(names)
 
     # Step 2: Assign unique identifiers to each name
     name_mapping = {name: f"NAME{i+1}" for i, name in enumerate(sorted(unique_names))}
 
     # Step 3: Replace names in each batch with their respective identifier while preserving formatting
-    updated_batches = []
-    for batch in batches:
-        # Preserve the line breaks and separators within each batch by splitting and re-joining
-        lines = batch.splitlines()  # Split into lines to preserve structure
-        updated_lines = []
-        
-        for line in lines:
-            # Replace names in each line while preserving the line structure
-            updated_line = line
-            for name, identifier in name_mapping.items():
-                updated_line = re.sub(rf'\b{name}\b', identifier, updated_line)
-            updated_lines.append(updated_line)
-        
-        # Join the updated lines back into the batch with line breaks
-        updated_batch = "\n".join(updated_lines)
-        updated_batches.append(updated_batch)
-    
+    updated_batches = substitute_entities(batches, name_mapping)
+
     return updated_batches, name_mapping
 
 #################################### Deidentify Locations ########################################
-def identify_locations(transcript_batch, client, model="gpt-4"):
+def locations_request(transcript_batch, model="gpt-4"):
     """
-    Identify all addresses and locations in a transcript batch.
+    Build the chat completion request that asks the model for the addresses and locations in a transcript batch.
 
     Args:
         transcript_batch (str): The transcript text to process.
-        client (object): The client object for interacting with the API.
         model (str, optional): The model to use for processing. Defaults to "gpt-4".
 
     Returns:
-        set: A set of unique locations identified in the transcript. If no locations are found, returns an empty set.
+        dict: The keyword arguments for client.chat.completions.create.
     """
     instructions = """
     Below is a transcript of a conversation between a doctor and a patient. Identify all the addresses and locations in the conversation. Return the addresses and locations as a comma-separated list. If there are no addresses, only return the word None.
     """
     user_content = instructions + '\n\n' + transcript_batch
-    chat_completion = client.chat.completions.create(
+    return dict(
         model=model,  # Allow dynamic specification of the model
         messages=[
             {
@@ -139,12 +175,25 @@ def identify_locations(transcript_batch, client, model="gpt-4"):
             }
         ]
     )
+
+def identify_locations(transcript_batch, client, model="gpt-4"):
+    """
+    Identify all addresses and locations in a transcript batch.
+
+    Args:
+        transcript_batch (str): The transcript text to process.
+        client (object): The client object for interacting with the API.
+        model (str, optional): The model to use for processing. Defaults to "gpt-4".
+
+    Returns:
+        set: A set of unique locations identified in the transcript. If no locations are found, returns an empty set.
+    """
+    chat_completion = client.chat.completions.create(**locations_request(transcript_batch, model=model))
     # Extract the response content, assuming it returns locations as a comma-separated list
     response = chat_completion.choices[0].message.content
-    locations = {location.strip() for location in response.split(',') if location.strip() != "None"}
-    return locations
+    return parse_entity_list(response)
 
-def replace_locations_with_identifiers(batches, client, model="gpt-4"):
+def replace_locations_with_identifiers(batches, client, model="gpt-4", dispatcher=None, prefilter=None):
     """
     Replace all locations in the given text batches with unique identifiers.
 
@@ -152,6 +201,8 @@ def replace_locations_with_identifiers(batches, client, model="gpt-4"):
         batches (list): A list of transcript text batches.
         client (object): The client object for interacting with the API.
         model (str, optional): The model to use for identifying locations. Defaults to "gpt-4".
+        dispatcher (LLMDispatcher, optional): Runs the per-batch API calls concurrently. Defaults to None (one batch at a time).
+        prefilter (EntityPrefilter, optional): Skips the API call for batches it can resolve locally. Defaults to None.
 
     Returns:
         tuple: A tuple containing:
@@ -161,44 +212,28 @@ def replace_locations_with_identifiers(batches, client, model="gpt-4"):
     unique_locations = set()
     
     # Step 1: Collect all unique locations from all batches using the identify_locations function
-    for batch in batches:
-        unique_locations.update(identify_locations(batch, client, model=model))
+    for locations in collect_entities(identify_locations, batches, client, model, dispatcher, prefilter):
+        unique_locations.update(locations)
 
     # Step 2: Assign unique identifiers to each location
     location_mapping = {location: f"LOCATION{i+1}" for i, location in enumerate(unique_locations)}
 
     # Step 3: Replace locations in each batch with their respective identifier while preserving formatting
-    updated_batches = []
-    for batch in batches:
-        # Preserve the line breaks and separators within each batch by splitting and re-joining
-        lines = batch.splitlines()  # Split into lines to preserve structure
-        updated_lines = []
-        
-        for line in lines:
-            # Replace locations in each line while preserving the line structure
-            updated_line = line
-            for location, identifier in location_mapping.items():
-                updated_line = re.sub(rf'\b{re.escape(location)}\b', identifier, updated_line)
-            updated_lines.append(updated_line)
-        
-        # Join the updated lines back into the batch with line breaks
-        updated_batch = "\n".join(updated_lines)
-        updated_batches.append(updated_batch)
-    
+    updated_batches = substitute_entities(batches, location_mapping)
+
     return updated_batches, location_mapping
 
 #################################### Deidentify Dates ########################################
-def identify_dates(transcript_batch, client, model="gpt-4"):
+def dates_request(transcript_batch, model="gpt-4"):
     """
-    Identifies all dates mentioned in a transcript of a conversation between a doctor and a patient.
+    Build the chat completion request that asks the model for the dates in a transcript batch.
 
     Args:
-        transcript_batch (str): The transcript text to analyze for dates.
-        client (object): The client object for interacting with the language model API.
-        model (str, optional): The language model to use for processing. Defaults to "gpt-4".
+        transcript_batch (str): The transcript text to process.
+        model (str, optional): The model to use for processing. Defaults to "gpt-4".
 
     Returns:
-        set: A set of identified dates from the transcript. If no dates are found, returns an empty set.
+        dict: The keyword arguments for client.chat.completions.create.
     """
     # Define the instructions for the model to extract dates from the transcript
     instructions = """
@@ -209,8 +244,8 @@ def identify_dates(transcript_batch, client, model="gpt-4"):
     # Combine the instructions and transcript into a single input for the model
     user_content = instructions + '\n\n' + transcript_batch
 
-    # Send the input to the language model API for processing
-    chat_completion = client.chat.completions.create(
+    # Build the input for the language model API
+    return dict(
         model=model,  # Use the specified model (default is "gpt-4")
         messages=[
             {
@@ -224,15 +259,28 @@ def identify_dates(transcript_batch, client, model="gpt-4"):
         ]
     )
 
+def identify_dates(transcript_batch, client, model="gpt-4"):
+    """
+    Identifies all dates mentioned in a transcript of a conversation between a doctor and a patient.
+
+    Args:
+        transcript_batch (str): The transcript text to analyze for dates.
+        client (object): The client object for interacting with the language model API.
+        model (str, optional): The language model to use for processing. Defaults to "gpt-4".
+
+    Returns:
+        set: A set of identified dates from the transcript. If no dates are found, returns an empty set.
+    """
+    # Send the input to the language model API for processing
+    chat_completion = client.chat.completions.create(**dates_request(transcript_batch, model=model))
+
     # Extract the model's response, expected as a comma-separated list of dates or "None"
     response = chat_completion.choices[0].message.content
 
     # Parse the response to extract dates, ignoring the word "None"
-    dates = {date.strip() for date in response.split(',') if date.strip() != "None"}
+    return parse_entity_list(response)
 
-    return dates  # Return the set of unique dates
-
-def replace_dates_with_identifiers(batches, client, model="gpt-4"):
+def replace_dates_with_identifiers(batches, client, model="gpt-4", dispatcher=None, prefilter=None):
     """
     Replaces all dates in text batches with unique identifiers while preserving formatting.
 
@@ -240,6 +288,8 @@ def replace_dates_with_identifiers(batches, client, model="gpt-4"):
         batches (list of str): List of text batches (e.g., transcripts) to process.
         client (object): Client object for interacting with the language model API.
         model (str, optional): The language model to use for processing. Defaults to "gpt-4".
+        dispatcher (LLMDispatcher, optional): Runs the per-batch API calls concurrently. Defaults to None (one batch at a time).
+        prefilter (EntityPrefilter, optional): Skips the API call for batches it can resolve locally. Defaults to None.
 
     Returns:
         tuple:
@@ -249,123 +299,588 @@ def replace_dates_with_identifiers(batches, client, model="gpt-4"):
     unique_dates = set()
 
     # Step 1: Collect all unique dates from all batches using the language model
-    for batch in batches:
-        # Use the specified model for identifying dates
-        unique_dates.update(identify_dates(batch, client, model=model))
+    for dates in collect_entities(identify_dates, batches, client, model, dispatcher, prefilter):
+        # Results come back in batch order, so the mapping matches the serial path
+        unique_dates.update(dates)
 
     # Step 2: Assign unique identifiers to each date
     date_mapping = {date: f"DATE{i+1}" for i, date in enumerate(unique_dates)}
 
     # Step 3: Replace dates in each batch with their respective identifier while preserving formatting
-    updated_batches = []
-    for batch in batches:
-        # Split batch into lines to preserve its original structure
-        lines = batch.splitlines()
-        updated_lines = []
-
-        for line in lines:
-            # Replace dates in the current line with their unique identifiers
-            updated_line = line
-            for date, identifier in date_mapping.items():
-                # Use regex to replace only exact matches of the date
-                updated_line = re.sub(rf'\b{re.escape(date)}\b', identifier, updated_line)
-            updated_lines.append(updated_line)
-
-        # Join updated lines back into a single string
-        updated_batch = "\n".join(updated_lines)
-        updated_batches.append(updated_batch)
+    updated_batches = substitute_entities(batches, date_mapping)
 
     return updated_batches, date_mapping
 
+#################################### Deidentify All Entities ########################################
+# Entity categories handled by the single-pass extractor, with the prefix used for their identifiers
+ENTITY_CATEGORIES = {
+    "names": "NAME",
+    "locations": "LOCATION",
+    "dates": "DATE",
+}
+
+def parse_entity_response(response, categories):
+    """
+    Parse a JSON entity response into one set per category, tolerating code fences,
+    surrounding prose, singular/capitalised keys, and comma-separated strings instead of lists.
+
+    Parameters:
+    - response (str): The raw model response.
+    - categories (list of str): The categories that were requested (e.g., ["names", "dates"]).
+
+    Returns:
+    - dict: A mapping of category to a set of entities.
+
+    Raises:
+    - ValueError: If the response does not contain a JSON object.
+    """
+    start, end = response.find("{"), response.rfind("}")
+    if start == -1 or end <= start:
+        raise ValueError("Response does not contain a JSON object")
+    data = json.loads(response[start:end + 1])
+    if not isinstance(data, dict):
+        raise ValueError("Response JSON is not an object")
+
+    # Normalise keys so "Names", "name" and "names" all match the "names" category
+    normalised = {str(key).strip().lower().rstrip("s"): value for key, value in data.items()}
+    entities = {}
+    for category in categories:
+        value = normalised.get(category.rstrip("s"))
+        if value is None:
+            values = []
+        elif isinstance(value, str):
+            values = value.split(",")
+        elif isinstance(value, (list, tuple)):
+            values = [str(item) for item in value if item is not None]
+        else:
+            raise ValueError(f"Unexpected value for {category}: {value!r}")
+        entities[category] = {item.strip() for item in values if item.strip() and item.strip() != "None"}
+    return entities
+
+def entities_request(transcript_batch, model="gpt-4", categories=("names", "locations", "dates")):
+    """
+    Build the chat completion request that asks the model for every requested entity category as JSON.
+
+    Parameters:
+    - transcript_batch (str): The text batch to analyze.
+    - model (str): The model to use for processing (default: "gpt-4").
+    - categories (iterable of str): The categories to extract, any of "names", "locations" and "dates".
+
+    Returns:
+    - dict: The keyword arguments for client.chat.completions.create.
+    """
+    descriptions = {
+        "names": "all the possible names of people (note some names are in lower case)",
+        "locations": "all the addresses and locations",
+        "dates": "all the dates",
+    }
+    requested = "\n".join(f'- "{category}": {descriptions[category]}' for category in categories)
+    instructions = f"""
+    Below is a transcript of a conversation between a doctor and a patient. Identify the following in the conversation:
+    {requested}
+    Return only a JSON object with exactly these keys, each mapped to a list of the strings as they appear in the text. Use an empty list if there are none.
+    """
+    user_content = instructions + '\n\n' + transcript_batch
+    return dict(
+        model=model,
+        messages=[
+            {
+                "role": "system",
+                "content": "You are an AI assistant tasked with identifying names, locations and dates in the transcript. You always answer in JSON."
+            },
+            {
+                "role": "user",
+                "content": user_content
+            }
+        ]
+    )
+
+# The single-category identify_* function for each category, used when a combined response does not validate
+IDENTIFY_FUNCTIONS = {
+    "names": identify_names,
+    "locations": identify_locations,
+    "dates": identify_dates,
+}
+FUNCTION_CATEGORIES = {function: category for category, function in IDENTIFY_FUNCTIONS.items()}
+
+def identify_entities(transcript_batch, client, model="gpt-4", categories=("names", "locations", "dates")):
+    """
+    Extracts names, locations and dates from a transcript batch in a single API call.
+    Falls back to the per-category identify_* functions if the response is not valid JSON.
+
+    Parameters:
+    - transcript_batch (str): The text batch to analyze.
+    - client: The OpenAI API client instance.
+    - model (str): The model to use for processing (default: "gpt-4").
+    - categories (iterable of str): The categories to extract, any of "names", "locations" and "dates".
+
+    Returns:
+    - dict: A mapping of category to a set of extracted entities (empty sets if none are found).
+    """
+    categories = list(categories)
+    chat_completion = client.chat.completions.create(**entities_request(transcript_batch, model=model, categories=categories))
+    response = chat_completion.choices[0].message.content
+    try:
+        return parse_entity_response(response, categories)
+    except ValueError:
+        # The structured response did not validate; ask for each category separately instead
+        return {
+            category: IDENTIFY_FUNCTIONS[category](transcript_batch, client, model=model)
+            for category in categories
+        }
+
+def number_entities(unique_entities, categories):
+    """
+    Number the entities found in each category and merge the categories into one replacement mapping.
+
+    Parameters:
+    - unique_entities (dict): A mapping of category to the set of entities found in the batches.
+    - categories (list of str): The categories in replacement priority order.
+
+    Returns:
+    - mappings (dict): A mapping of category to its {original: identifier} dictionary.
+    - combined_mapping (dict): All categories' entries; an entity found in several categories keeps the first one.
+    """
+    mappings = {}
+    for category in categories:
+        # Names are numbered in sorted order, as in replace_names_with_identifiers
+        entities = sorted(unique_entities[category]) if category == "names" else unique_entities[category]
+        mappings[category] = {entity: f"{ENTITY_CATEGORIES[category]}{i+1}" for i, entity in enumerate(entities)}
+
+    combined_mapping = {}
+    for category in reversed(categories):
+        combined_mapping.update(mappings[category])
+    return mappings, combined_mapping
+
+def apply_entity_mappings(batches, unique_entities, categories):
+    """
+    Number the entities found in each category and replace them all in one pass over each batch.
+
+    Parameters:
+    - batches (list of str): A list of text batches.
+    - unique_entities (dict): A mapping of category to the set of entities found in the batches.
+    - categories (list of str): The categories in replacement priority order.
+
+    Returns:
+    - updated_batches (list of str): The text batches with entities replaced by unique identifiers.
+    - mappings (dict): A mapping of category to its {original: identifier} dictionary.
+    """
+    mappings, combined_mapping = number_entities(unique_entities, categories)
+    return substitute_entities(batches, combined_mapping), mappings
+
+def replace_entities_with_identifiers(batches, client, model="gpt-4", categories=("names", "locations", "dates"), dispatcher=None, prefilter=None):
+    """
+    Replace names, locations and dates in text batches with unique identifiers, extracting
+    all requested categories with one API call per batch.
+
+    Parameters:
+    - batches (list of str): A list of text batches.
+    - client: The OpenAI API client instance.
+    - model (str): The model to use for processing (default: "gpt-4").
+    - categories (iterable of str): The categories to de-identify, any of "names", "locations" and "dates".
+    - dispatcher (LLMDispatcher, optional): Runs the per-batch API calls concurrently.
+    - prefilter (EntityPrefilter, optional): Skips the API call for batches it can resolve locally.
+
+    Returns:
+    - updated_batches (list of str): The text batches with entities replaced by unique identifiers.
+    - mappings (dict): A mapping of category to its {original: identifier} dictionary.
+    """
+    categories = [category for category in ENTITY_CATEGORIES if category in set(categories)]
+
+    # Step 1: Collect all unique entities of every category from all batches in one pass
+    unique_entities = {category: set() for category in categories}
+    for entities in collect_entities(identify_entities, batches, client, model, dispatcher, prefilter, categories=categories):
+        for category in categories:
+            unique_entities[category].update(entities.get(category, set()))
+
+    # Step 2 and 3: Assign unique identifiers and replace all categories at once
+    return apply_entity_mappings(batches, unique_entities, categories)
+
 #################################### One Function ########################################
-def deidentify_transcripts(
-    input_folder_path,
-    output_folder_path,
+def deidentify_text(
+    transcript,
     deidentify_name=True,
     deidentify_location=False,
     deidentify_date=False,
     model="gpt-4",
     client=None,
-    return_mapping=False
+    dispatcher=None,
+    single_pass=True,
+    max_tokens=1000,
+    count_tokens=None,
+    file_name="transcript",
+    record=None,
+    prefilter=None
 ):
     """
-    De-identify all transcript files in a folder by replacing sensitive information such as names, locations, and dates.
+    De-identify a transcript held in memory.
 
     Parameters:
-    - input_folder_path (str): Path to the input folder containing transcript files.
-    - output_folder_path (str): Path to the folder to save the de-identified transcripts.
+    - transcript (str): The transcript text.
     - deidentify_name (bool): Whether to de-identify names (default: True).
     - deidentify_location (bool): Whether to de-identify locations (default: False).
     - deidentify_date (bool): Whether to de-identify dates (default: False).
     - model (str): The model to use for processing (default: "gpt-4").
     - client: The OpenAI API client instance.
-    - return_mapping (bool): Whether to return mappings for names, locations, and dates (default: False).
+    - dispatcher (LLMDispatcher, optional): Runs the per-batch API calls concurrently.
+    - single_pass (bool): When more than one category is enabled, extract them all with one API call
+      per batch instead of one call per category (default: True).
+    - max_tokens (int): The size of each batch sent to the model, measured with count_tokens (default: 1000).
+    - count_tokens (callable, optional): Maps a text to its size. Defaults to counting words.
+    - file_name (str): Name used in progress messages (default: "transcript").
+    - record (StageRecord, optional): Telemetry record that the chunk count is added to.
+    - prefilter (EntityPrefilter, optional): Local candidate detector that skips the API call for batches
+      without new candidate entities. Share one instance across files so confirmed entities carry over.
 
     Returns:
-    - dict (optional): If return_mapping is True, returns a dictionary with mappings for names, locations, and dates.
+    - tuple: The de-identified text, followed by the name, location and date mappings.
     """
-    # Create the output folder if it doesn't exist
-    os.makedirs(output_folder_path, exist_ok=True)
+    # Step 1: Split the transcript into manageable batches
+    batches = truncate_transcript(transcript, max_words=max_tokens, count_tokens=count_tokens)
+    if record is not None:
+        record.add(chunks=len(batches))
+
+    # Initialize mappings for this file
+    name_mapping = {}
+    location_mapping = {}
+    date_mapping = {}
+
+    enabled = [
+        category for category, enabled in
+        (("names", deidentify_name), ("locations", deidentify_location), ("dates", deidentify_date))
+        if enabled
+    ]
+
+    if single_pass and len(enabled) > 1:
+        # Steps 2-4 in one pass: extract every enabled category with a single call per batch
+        batches, mappings = replace_entities_with_identifiers(batches, client, model=model, categories=enabled, dispatcher=dispatcher, prefilter=prefilter)
+        name_mapping = mappings.get("names", {})
+        location_mapping = mappings.get("locations", {})
+        date_mapping = mappings.get("dates", {})
+        for category, mapping in mappings.items():
+            print(f"{category.capitalize()} de-identified in {file_name}: {len(mapping)} unique.")
+    else:
+        # Step 2: Perform de-identification on names, if specified
+        if deidentify_name:
+            batches, name_mapping = replace_names_with_identifiers(batches, client, model=model, dispatcher=dispatcher, prefilter=prefilter)
+            print(f"Names de-identified in {file_name}: {len(name_mapping)} unique.")
 
-    # Initialize mappings
-    all_name_mappings = {}
-    all_location_mappings = {}
-    all_date_mappings = {}
+        # Step 3: Perform de-identification on locations, if specified
+        if deidentify_location:
+            batches, location_mapping = replace_locations_with_identifiers(batches, client, model=model, dispatcher=dispatcher, prefilter=prefilter)
+            print(f"Locations de-identified in {file_name}: {len(location_mapping)} unique.")
 
-    # Iterate over all files in the input folder
-    for file_name in os.listdir(input_folder_path):
-        input_file_path = os.path.join(input_folder_path, file_name)
-        
-        # Skip directories and non-text files
-        if not os.path.isfile(input_file_path) or not file_name.endswith(".txt"):
-            continue
+        # Step 4: Perform de-identification on dates, if specified
+        if deidentify_date:
+            batches, date_mapping = replace_dates_with_identifiers(batches, client, model=model, dispatcher=dispatcher, prefilter=prefilter)
+            print(f"Dates de-identified in {file_name}: {len(date_mapping)} unique.")
 
-        output_file_path = os.path.join(output_folder_path, file_name)
+    return "".join(batch + "\n\n" for batch in batches), name_mapping, location_mapping, date_mapping
 
-        # Read the input transcript
-        with open(input_file_path, "r") as file:
-            transcript = file.read()
+def deidentify_file(
+    input_file_path,
+    output_file_path,
+    deidentify_name=True,
+    deidentify_location=False,
+    deidentify_date=False,
+    model="gpt-4",
+    client=None,
+    dispatcher=None,
+    single_pass=True,
+    max_tokens=1000,
+    count_tokens=None,
+    record=None,
+    prefilter=None
+):
+    """
+    De-identify a single transcript file and save the result.
 
-        # Step 1: Split the transcript into manageable batches
-        batches = truncate_transcript(transcript, max_words=1000)
+    Parameters:
+    - input_file_path (str): Path to the transcript file.
+    - output_file_path (str): Path to save the de-identified transcript.
+    - Other parameters: As for deidentify_text.
 
-        # Initialize mappings for this file
-        name_mapping = {}
-        location_mapping = {}
-        date_mapping = {}
+    Returns:
+    - tuple: The name, location and date mappings for this file.
+    """
+    # Read the input transcript
+    with open(input_file_path, "r") as file:
+        transcript = file.read()
+
+    deidentified, name_mapping, location_mapping, date_mapping = deidentify_text(
+        transcript,
+        deidentify_name=deidentify_name,
+        deidentify_location=deidentify_location,
+        deidentify_date=deidentify_date,
+        model=model,
+        client=client,
+        dispatcher=dispatcher,
+        single_pass=single_pass,
+        max_tokens=max_tokens,
+        count_tokens=count_tokens,
+        file_name=os.path.basename(input_file_path),
+        record=record,
+        prefilter=prefilter
+    )
 
-        # Step 2: Perform de-identification on names, if specified
-        if deidentify_name:
-            batches, name_mapping = replace_names_with_identifiers(batches, client, model=model)
-            print(f"Names de-identified in {file_name}. Mapping: {name_mapping}")
+    # Step 5: Save the de-identified transcript to the output file (atomically, so a crash never leaves a partial file)
+    atomic_write(output_file_path, deidentified)
 
-        # Step 3: Perform de-identification on locations, if specified
-        if deidentify_location:
-            batches, location_mapping = replace_locations_with_identifiers(batches, client, model=model)
-            print(f"Locations de-identified in {file_name}. Mapping: {location_mapping}")
+    print(f"De-identified transcript saved to {output_file_path}")
+    return name_mapping, location_mapping, date_mapping
 
-        # Step 4: Perform de-identification on dates, if specified
-        if deidentify_date:
-            batches, date_mapping = replace_dates_with_identifiers(batches, client, model=model)
-            print(f"Dates de-identified in {file_name}. Mapping: {date_mapping}")
+#################################### Streaming ########################################
+def identify_chunk_entities(chunks, client, model, categories, single_pass=True, dispatcher=None, prefilter=None):
+    """
+    Find the entities of every requested category in each chunk, with one call per chunk in single-pass
+    mode or one call per chunk and category otherwise.
+
+    Returns:
+    - list of dict: A mapping of category to the set of entities found, for each chunk.
+    """
+    if single_pass and len(categories) > 1:
+        return collect_entities(identify_entities, chunks, client, model, dispatcher, prefilter, categories=categories)
+    results = [{} for _ in chunks]
+    for category in categories:
+        found = collect_entities(IDENTIFY_FUNCTIONS[category], chunks, client, model, dispatcher, prefilter)
+        for result, entities in zip(results, found):
+            result[category] = entities
+    return results
+
+def deidentify_file_streaming(
+    input_file_path,
+    output_file_path,
+    deidentify_name=True,
+    deidentify_location=False,
+    deidentify_date=False,
+    model="gpt-4",
+    client=None,
+    dispatcher=None,
+    single_pass=True,
+    max_tokens=1000,
+    count_tokens=None,
+    record=None,
+    prefilter=None,
+    mapping_store=None,
+    window=8
+):
+    """
+    De-identify a transcript file chunk by chunk, reading and writing it incrementally so memory use does
+    not grow with the length of the recording.
+
+    The file is read twice. The first pass reads it in windows of chunks and identifies each window's
+    entities (concurrently, with a dispatcher), keeping only the entities found. They are then numbered as
+    in deidentify_file, and the second pass reads the chunks again, replaces every entity with the final
+    mapping and appends them to the output, so an entity first found late in the file is still replaced
+    where it appears earlier. Unlike deidentify_file, with single_pass=False every category is identified
+    on the original text rather than on the text with the previous categories already replaced.
+
+    Parameters:
+    - input_file_path (str): Path to the transcript file.
+    - output_file_path (str): Path to save the de-identified transcript (written atomically).
+    - mapping_store (MappingStore, optional): Receives the file's mappings once they are assigned. They
+      become the file's current mappings once the output is in place.
+    - window (int): Chunks read and identified together; at least the dispatcher's concurrency keeps it busy (default: 8).
+    - Other parameters: As for deidentify_text.
+
+    Returns:
+    - dict: A mapping of category to this file's {original: identifier} dictionary.
+    """
+    file_name = os.path.basename(input_file_path)
+    enabled = [
+        category for category, enabled in
+        (("names", deidentify_name), ("locations", deidentify_location), ("dates", deidentify_date))
+        if enabled
+    ]
+    # First pass: identify the entities window by window, keeping only the entities themselves
+    unique_entities = {category: set() for category in enabled}
+    chunks = iter_file_chunks(input_file_path, max_tokens=max_tokens, count_tokens=count_tokens)
+    while True:
+        batches = [chunk.text for chunk in itertools.islice(chunks, window)]
+        if not batches:
+            break
+        if record is not None:
+            record.add(chunks=len(batches))
+        found = identify_chunk_entities(
+            batches, client, model, enabled, single_pass=single_pass, dispatcher=dispatcher, prefilter=prefilter
+        )
+        for result in found:
+            for category in enabled:
+                unique_entities[category].update(result.get(category, set()))
+
+    mappings, combined_mapping = number_entities(unique_entities, enabled)
+    if mapping_store is not None:
+        generation = mapping_store.begin_file(file_name)
+        for category, mapping in mappings.items():
+            mapping_store.add(file_name, generation, category, mapping)
+
+    # Second pass: replace with the final mapping, so no window is written before all entities are known
+    with atomic_open(output_file_path) as output:
+        chunks = iter_file_chunks(input_file_path, max_tokens=max_tokens, count_tokens=count_tokens)
+        while True:
+            batches = [chunk.text for chunk in itertools.islice(chunks, window)]
+            if not batches:
+                break
+            for batch in substitute_entities(batches, combined_mapping):
+                output.write(batch + "\n\n")
+    if mapping_store is not None:
+        mapping_store.complete_file(file_name, generation)
+
+    for category, mapping in mappings.items():
+        print(f"{category.capitalize()} de-identified in {file_name}: {len(mapping)} unique.")
+    print(f"De-identified transcript saved to {output_file_path}")
+    return mappings
 
-        # Step 5: Save the de-identified transcript to the output file
-        with open(output_file_path, "w") as file:
-            for batch in batches:
-                file.write(batch + "\n\n")
+def deidentify_transcripts(
+    input_folder_path,
+    output_folder_path,
+    deidentify_name=True,
+    deidentify_location=False,
+    deidentify_date=False,
+    model="gpt-4",
+    client=None,
+    return_mapping=False,
+    dispatcher=None,
+    max_file_workers=1,
+    single_pass=True,
+    cache=None,
+    max_tokens=1000,
+    count_tokens=None,
+    resume=True,
+    telemetry=None,
+    prefilter=None,
+    streaming=False,
+    mapping_store=None
+):
+    """
+    De-identify all transcript files in a folder by replacing sensitive information such as names, locations, and dates.
 
-        print(f"De-identified transcript saved to {output_file_path}")
+    Parameters:
+    - input_folder_path (str): Path to the input folder containing transcript files.
+    - output_folder_path (str): Path to the folder to save the de-identified transcripts.
+    - deidentify_name (bool): Whether to de-identify names (default: True).
+    - deidentify_location (bool): Whether to de-identify locations (default: False).
+    - deidentify_date (bool): Whether to de-identify dates (default: False).
+    - model (str): The model to use for processing (default: "gpt-4").
+    - client: The OpenAI API client instance.
+    - return_mapping (bool): Whether to return mappings for names, locations, and dates (default: False).
+    - dispatcher (LLMDispatcher, optional): Runs API calls concurrently. Its concurrency limit and token
+      budget are shared by all batches of all files.
+    - max_file_workers (int): Number of files processed at the same time (default: 1).
+    - single_pass (bool): When more than one category is enabled, extract them all with one API call
+      per batch instead of one call per category (default: True).
+    - cache (ResponseCache or str, optional): Serve repeated API requests from a local response cache
+      (or the path of a cache file), so unchanged batches are not sent again on reruns.
+    - max_tokens (int): The size of each batch sent to the model, measured with count_tokens (default: 1000).
+    - count_tokens (callable, optional): Maps a text to its size, e.g. chunking.tiktoken_counter(model).
+      Defaults to counting words.
+    - resume (bool): Skip files whose content and parameters match a finished entry in the output folder's
+      manifest, so an interrupted or repeated run only processes what is left (default: True). The manifest
+      holds no entities: the mappings of skipped files are only returned from a mapping store, otherwise
+      the returned mappings cover the files processed in this run.
+    - telemetry (Telemetry, optional): Records wall time, API time, tokens, errors, retries and chunk counts per file.
+    - prefilter (EntityPrefilter, optional): Local candidate detector shared by all files; batches without new
+      candidate entities are resolved without an API call. See prefilter.summary() for the calls avoided.
+    - streaming (bool): Read, de-identify and write each file chunk by chunk (see deidentify_file_streaming)
+      instead of holding it in memory, for very long recordings (default: False).
+    - mapping_store (MappingStore or str, optional): Append the mappings to this on-disk store (or a store at
+      this path) instead of keeping them in memory, so memory use stays constant in the size of the corpus.
+      It is also where the mappings of files skipped on resume come from. It holds the original entities,
+      so keep it outside the output folder and open it with a key to encrypt them.
 
-        # Aggregate mappings if return_mapping is True
-        if return_mapping:
-            all_name_mappings[file_name] = name_mapping
-            all_location_mappings[file_name] = location_mapping
-            all_date_mappings[file_name] = date_mapping
+    Returns:
+    - dict (optional): If return_mapping is True, returns a dictionary with mappings for names, locations, and dates.
+      With a mapping store, these are lazy read-only views of the store, which cover every file in it.
+    """
+    # Create the output folder if it doesn't exist
+    os.makedirs(output_folder_path, exist_ok=True)
 
-    # Step 6: Optionally return the mappings
+    # Answer repeated requests from the response cache, if one is given
+    client = with_cache(client, cache)
+    if isinstance(mapping_store, str):
+        mapping_store = MappingStore(mapping_store)
+
+    # Collect the text files in the input folder, skipping directories and non-text files
+    file_names = [
+        file_name for file_name in os.listdir(input_folder_path)
+        if os.path.isfile(os.path.join(input_folder_path, file_name)) and file_name.endswith(".txt")
+    ]
+
+    # Every parameter that changes the output is part of the manifest fingerprint
+    manifest = StageManifest(output_folder_path, "deidentify")
+    params = {
+        "deidentify_name": deidentify_name,
+        "deidentify_location": deidentify_location,
+        "deidentify_date": deidentify_date,
+        "model": model,
+        "single_pass": single_pass,
+        "max_tokens": max_tokens,
+        "tokenizer": tokenizer_name(count_tokens),
+    }
+    if prefilter is not None:
+        # Only added when used, so runs without a prefilter keep their earlier fingerprint
+        params["prefilter"] = prefilter.fingerprint()
+    if streaming:
+        params["streaming"] = True
+    params_hash = params_fingerprint(params)
+
+    def process(file_name):
+        input_file_path = os.path.join(input_folder_path, file_name)
+        output_file_path = os.path.join(output_folder_path, file_name)
+        with track(telemetry, "deidentify", file_name) as record:
+            input_hash = file_sha256(input_file_path)
+            if resume and manifest.is_complete(file_name, input_hash, params_hash):
+                print(f"Skipping {file_name}: already de-identified with the same parameters")
+                if record is not None:
+                    record.status = "skipped"
+                return None
+            options = dict(
+                deidentify_name=deidentify_name,
+                deidentify_location=deidentify_location,
+                deidentify_date=deidentify_date,
+                model=model,
+                client=instrument(client, record),
+                dispatcher=dispatcher,
+                single_pass=single_pass,
+                max_tokens=max_tokens,
+                count_tokens=count_tokens,
+                record=record,
+                prefilter=prefilter
+            )
+            if streaming:
+                mappings = deidentify_file_streaming(
+                    input_file_path, output_file_path, mapping_store=mapping_store, **options
+                )
+                mappings = tuple(mappings.get(category, {}) for category in ENTITY_CATEGORIES)
+            else:
+                mappings = deidentify_file(input_file_path, output_file_path, **options)
+                if mapping_store is not None:
+                    generation = mapping_store.begin_file(file_name)
+                    for category, mapping in zip(ENTITY_CATEGORIES, mappings):
+                        mapping_store.add(file_name, generation, category, mapping)
+                    mapping_store.complete_file(file_name, generation)
+            manifest.record(file_name, input_hash, params_hash, output_file_path)
+        # With a store, the mappings are already on disk and are not kept until the end of the run
+        return True if mapping_store is not None else mappings
+
+    # Process the files, several at a time if requested; results keep the folder order
+    if max_file_workers > 1:
+        with ThreadPoolExecutor(max_workers=max_file_workers) as executor:
+            results = list(executor.map(process, file_names))
+    else:
+        results = [process(file_name) for file_name in file_names]
+
+    # Optionally return the mappings: from the store, which also covers skipped files, or of this run's files
+    if return_mapping and mapping_store is not None:
+        return {
+            "name_mappings": mapping_store.view("names"),
+            "location_mappings": mapping_store.view("locations"),
+            "date_mappings": mapping_store.view("dates"),
+        }
     if return_mapping:
+        processed = [(file_name, result) for file_name, result in zip(file_names, results) if result is not None]
         return {
-            "name_mappings": all_name_mappings,
-            "location_mappings": all_location_mappings,
-            "date_mappings": all_date_mappings,
-        }
\ No newline at end of file
+            "name_mappings": {file_name: result[0] for file_name, result in processed},
+            "location_mappings": {file_name: result[1] for file_name, result in processed},
+            "date_mappings": {file_name: result[2] for file_name, result in processed},
+        }
@@ -0,0 +1,23 @@
+#################################### Encryption ########################################
+def fernet_class():
+    """
+    The Fernet cipher used to encrypt the mapping store and the response cache at rest. It comes from the
+    optional cryptography package, which is only imported when encryption is asked for.
+
+    Returns:
+    - type: cryptography.fernet.Fernet.
+    """
+    try:
+        from cryptography.fernet import Fernet
+    except ImportError as error:
+        raise ImportError("Encryption at rest requires cryptography (pip install cryptography)") from error
+    return Fernet
+
+def generate_key():
+    """
+    Generate a key for encrypting a mapping store or response cache at rest. Requires the cryptography package.
+
+    Returns:
+    - bytes: A url-safe base64-encoded Fernet key. Keep it outside the store, e.g. in an environment variable.
+    """
+    return fernet_class().generate_key()
@@ -0,0 +1,322 @@
+import re
+import json
+import hashlib
+import threading
+from entity_replacement import compile_entity_pattern
+
+MONTH_NAMES = [
+    "January", "February", "March", "April", "May", "June",
+    "July", "August", "September", "October", "November", "December",
+]
+MONTH_ABBREVIATIONS = ["Jan", "Feb", "Mar", "Apr", "Jun", "Jul", "Aug", "Sep", "Sept", "Oct", "Nov", "Dec"]
+WEEKDAYS = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+
+# Dates and times. Month names are matched capitalised only, so the verb "may" and "march" are not candidates
+DATE_PATTERN = re.compile(
+    r"\b(?:"
+    rf"(?:{'|'.join(MONTH_NAMES)})(?:\s+\d{{1,2}}(?:st|nd|rd|th)?)?(?:,?\s+\d{{4}})?"
+    rf"|(?:{'|'.join(MONTH_ABBREVIATIONS)})\.?\s+\d{{1,2}}(?:st|nd|rd|th)?(?:,?\s+\d{{4}})?"
+    r"|\d{1,2}(?:st|nd|rd|th)?\s+of\s+(?:" + "|".join(MONTH_NAMES) + r")"
+    rf"|(?:{'|'.join(WEEKDAYS)})"
+    r"|\d{1,4}[/.-]\d{1,2}[/.-]\d{1,4}"
+    r"|\d{1,2}/\d{1,2}"
+    r"|(?:19|20)\d{2}"
+    r"|\d{1,2}:\d{2}(?:\s*[ap]\.?m\.?)?"
+    r"|\d{1,2}\s*[ap]\.?m\.?"
+    r")(?!\w)",
+)
+
+# Street addresses and named places ending in a place word ("12 Oak Avenue", "Riverside Clinic")
+PLACE_WORDS = [
+    "Street", "St", "Avenue", "Ave", "Road", "Rd", "Lane", "Ln", "Drive", "Dr", "Boulevard", "Blvd",
+    "Way", "Court", "Place", "Square", "Park", "Highway", "Parkway", "Terrace", "Hospital", "Clinic",
+    "Pharmacy", "Center", "Centre", "Medical", "Health", "County", "City", "Town", "Village", "Heights",
+]
+ADDRESS_PATTERN = re.compile(
+    r"(?:\b\d{1,5}\s+)?(?:\b[A-Z][\w'.-]*\s+){1,3}(?:" + "|".join(PLACE_WORDS) + r")\b\.?"
+)
+# A capitalised word or run of capitalised words (with "St." and "of" allowed inside, as in "St. Mary's")
+CAPITALIZED_PATTERN = re.compile(r"\b[A-Z][\w'-]*(?:\.?\s+(?:of\s+)?[A-Z][\w'-]*)*")
+# Words after which a capitalised span is likely a place
+LOCATION_CUES = re.compile(r"\b(?:in|at|to|from|near|into|around|outside|moved|live|lives|living)\s+$", re.IGNORECASE)
+
+# Capitalised words that are not entities on their own
+COMMON_WORDS = {
+    "I", "I'm", "I'll", "I've", "I'd", "OK", "Okay", "Doctor", "Patient", "Dr", "Mr", "Mrs", "Ms",
+    "Yes", "No", "So", "Well", "And", "But", "The", "A", "An", "It", "We", "You", "He", "She", "They",
+    "COVID", "MRI", "CT", "ER", "ICU", "BP", "EKG", "ECG",
+}
+
+# Default gazetteer: US states and large US cities. Extend it with load_gazetteer for a local catchment area
+DEFAULT_GAZETTEER = [
+    "Alabama", "Alaska", "Arizona", "Arkansas", "California", "Colorado", "Connecticut", "Delaware", "Florida",
+    "Georgia", "Hawaii", "Idaho", "Illinois", "Indiana", "Iowa", "Kansas", "Kentucky", "Louisiana", "Maine",
+    "Maryland", "Massachusetts", "Michigan", "Minnesota", "Mississippi", "Missouri", "Montana", "Nebraska",
+    "Nevada", "New Hampshire", "New Jersey", "New Mexico", "New York", "North Carolina", "North Dakota", "Ohio",
+    "Oklahoma", "Oregon", "Pennsylvania", "Rhode Island", "South Carolina", "South Dakota", "Tennessee", "Texas",
+    "Utah", "Vermont", "Virginia", "Washington", "West Virginia", "Wisconsin", "Wyoming",
+    "Atlanta", "Austin", "Baltimore", "Boston", "Charlotte", "Chicago", "Cleveland", "Columbus", "Dallas",
+    "Denver", "Detroit", "El Paso", "Houston", "Indianapolis", "Jacksonville", "Las Vegas", "Los Angeles",
+    "Memphis", "Miami", "Milwaukee", "Minneapolis", "Nashville", "New Orleans", "Oakland", "Philadelphia",
+    "Phoenix", "Pittsburgh", "Portland", "Sacramento", "San Antonio", "San Diego", "San Francisco", "San Jose",
+    "Seattle", "St. Louis", "Tampa", "Tucson",
+]
+
+#################################### Candidate Detectors ########################################
+def _sentence_starts(text):
+    # Positions where a sentence begins, whose capital letter says nothing about the word
+    return {0} | {match.end() for match in re.finditer(r"[.!?:\n]\s*", text)}
+
+def capitalized_spans(text):
+    """
+    Find runs of capitalised words that are not at the start of a sentence and not common words.
+
+    Returns:
+    - list of tuple: The (start, end) of each span.
+    """
+    starts = _sentence_starts(text)
+    spans = []
+    for match in CAPITALIZED_PATTERN.finditer(text):
+        start, words = match.start(), match.group().split()
+        # A span that starts a sentence only counts from its second word
+        if start in starts:
+            if len(words) == 1:
+                continue
+            start = match.start() + match.group().index(words[1], len(words[0]))
+        if text[start:match.end()].rstrip(".") not in COMMON_WORDS:
+            spans.append((start, match.end()))
+    return spans
+
+def detect_dates(text, prefilter):
+    return [match.span() for match in DATE_PATTERN.finditer(text)]
+
+def detect_locations(text, prefilter):
+    spans = [match.span() for match in ADDRESS_PATTERN.finditer(text)]
+    if prefilter.gazetteer_pattern is not None:
+        spans.extend(match.span() for match in prefilter.gazetteer_pattern.finditer(text))
+    spans.extend(
+        (start, end) for start, end in capitalized_spans(text) if LOCATION_CUES.search(text, 0, start)
+    )
+    return spans
+
+def detect_names(text, prefilter):
+    # Names are often transcribed in lower case, so this detector is not enabled by default
+    return capitalized_spans(text)
+
+DETECTORS = {
+    "names": detect_names,
+    "locations": detect_locations,
+    "dates": detect_dates,
+}
+
+def load_gazetteer(path):
+    """
+    Read a gazetteer file: one place name per line, or a JSON list of place names.
+    """
+    with open(path, "r", encoding="utf-8") as file:
+        content = file.read()
+    if content.lstrip().startswith("["):
+        return json.loads(content)
+    return [line.strip() for line in content.splitlines() if line.strip()]
+
+#################################### Pre-Detector ########################################
+class EntityPrefilter:
+    """
+    Local candidate detector run before the identify_* functions, so that batches with nothing to find
+    are not sent to the model.
+
+    For each batch and enabled category, the detector looks for candidates: date and time patterns for
+    dates; addresses, gazetteer places and capitalised words after "in", "at", "to"... for locations.
+    - No candidates: the batch is not sent; the category's result is the already confirmed entities
+      found in the batch (usually none).
+    - Every candidate lies within an entity of the same category that the model already confirmed for an
+      earlier call, such as an earlier file: the batch is resolved locally with the confirmed entities it
+      contains. A candidate that only overlaps a known entity ("Springfield Heights" when "Springfield" is
+      known) may be a new one, so it goes to the model.
+    - Otherwise the batch goes to the model as before, and the entities it returns are added to the
+      confirmed dictionary for later batches and files.
+    Categories that are not enabled always go to the model. A batch is skipped only when every category
+    requested for it can be resolved locally; otherwise a single-pass call (identify_entities) asks only
+    for the categories that still need the model. With names enabled but not pre-detected, as by default,
+    every batch therefore still costs one call, and the saving is in the narrower prompts and replies.
+
+    One instance is meant to be shared by every file of a run, so the dictionary grows across the corpus.
+    It is safe to use from several threads.
+
+    Parameters:
+    - categories (iterable of str): The categories to pre-detect (default: ("locations", "dates")).
+    - gazetteer (iterable of str, optional): Place names for the location detector (default: DEFAULT_GAZETTEER).
+    - known_entities (dict, optional): Category -> entities to start the confirmed dictionary with.
+    """
+    def __init__(self, categories=("locations", "dates"), gazetteer=None, known_entities=None):
+        unknown = set(categories) - set(DETECTORS)
+        if unknown:
+            raise ValueError(f"Unknown categories: {', '.join(sorted(unknown))}")
+        self.categories = tuple(category for category in DETECTORS if category in set(categories))
+        self.gazetteer = sorted(set(DEFAULT_GAZETTEER if gazetteer is None else gazetteer))
+        self.gazetteer_pattern = compile_entity_pattern(self.gazetteer)
+        self.lock = threading.Lock()
+        self.known = {category: set() for category in DETECTORS}
+        for category, entities in (known_entities or {}).items():
+            self.known[category].update(entities)
+        self.stats = {
+            "batches": 0, "llm_calls": 0, "calls_avoided": 0, "no_candidates": 0, "resolved_locally": 0,
+            "categories_avoided": 0,
+        }
+
+    def fingerprint(self):
+        """
+        A short hash of the settings that can change the output, for the stage manifest.
+        """
+        settings = json.dumps({"categories": self.categories, "gazetteer": self.gazetteer})
+        return hashlib.sha256(settings.encode("utf-8")).hexdigest()[:16]
+
+    def confirm(self, category, entities):
+        """
+        Add entities returned by the model to the confirmed dictionary.
+        """
+        with self.lock:
+            self.known[category].update(entities)
+
+    def resolve(self, batch, category):
+        """
+        Try to answer a batch for one category without the model.
+
+        Returns:
+        - tuple: ("no_candidates" or "resolved_locally", the set of entities), or ("llm", None) if the
+          batch has to go to the model.
+        """
+        if category not in self.categories:
+            return "llm", None
+        with self.lock:
+            known = set(self.known[category])
+        pattern = compile_entity_pattern(known) if known else None
+        matches = [match.span() for match in pattern.finditer(batch)] if pattern is not None else []
+        found = {batch[start:end] for start, end in matches}
+        candidates = DETECTORS[category](batch, self)
+        if not candidates:
+            return "no_candidates", found
+        # A trailing period ("Oak St.") belongs to the sentence as much as to the candidate
+        covered = all(
+            any(match_start <= start and end - batch[start:end].endswith(".") <= match_end
+                for match_start, match_end in matches)
+            for start, end in candidates
+        )
+        return ("resolved_locally", found) if covered else ("llm", None)
+
+    def collect(self, identify_function, batches, client, model="gpt-4", dispatcher=None, category=None, **kwargs):
+        """
+        Run identify_function over the batches that need the model and resolve the others locally.
+
+        Parameters:
+        - identify_function (callable): identify_entities, or a single-category identify_* function.
+        - batches (list of str): A list of text batches.
+        - client: The OpenAI API client instance.
+        - model (str): The model to use for processing (default: "gpt-4").
+        - dispatcher (LLMDispatcher, optional): Runs the calls concurrently with rate-limit backoff.
+        - category (str, optional): The category a single-category function extracts.
+        - **kwargs: Extra keyword arguments passed to identify_function. With identify_entities, these
+          include the "categories" to extract; each call is then narrowed to the categories not resolved locally.
+
+        Returns:
+        - list: The result for each batch, in the same order as batches: a dict of category -> set when
+          "categories" is passed on to the function, otherwise a set.
+        """
+        combined = "categories" in kwargs
+        categories = list(kwargs.pop("categories")) if combined else [category]
+        local, pending, remaining = [], [], {}
+        for index, batch in enumerate(batches):
+            resolutions = {category: self.resolve(batch, category) for category in categories}
+            needed = [category for category, (outcome, _) in resolutions.items() if outcome == "llm"]
+            local.append({category: found for category, (outcome, found) in resolutions.items() if outcome != "llm"})
+            if needed:
+                pending.append(index)
+                # Resolution depends only on the text, so identical batches need the same categories
+                remaining[batch] = needed
+            with self.lock:
+                self.stats["batches"] += 1
+                self.stats["categories_avoided"] += len(categories) - len(needed)
+                if not needed:
+                    self.stats["calls_avoided"] += 1
+                    outcomes = {outcome for outcome, _ in resolutions.values()}
+                    self.stats["resolved_locally" if "resolved_locally" in outcomes else "no_candidates"] += 1
+
+        def identify(batch, client, model="gpt-4", **kwargs):
+            if combined:
+                return identify_function(batch, client, model=model, categories=remaining[batch], **kwargs)
+            return {categories[0]: identify_function(batch, client, model=model, **kwargs)}
+
+        pending_batches = [batches[index] for index in pending]
+        if dispatcher is None:
+            responses = [identify(batch, client, model=model, **kwargs) for batch in pending_batches]
+        else:
+            responses = dispatcher.map(identify, pending_batches, client, model=model, **kwargs)
+        with self.lock:
+            self.stats["llm_calls"] += len(pending_batches)
+
+        for index, response in zip(pending, responses):
+            for category, entities in response.items():
+                self.confirm(category, entities)
+            local[index].update(response)
+        return local if combined else [entities[categories[0]] for entities in local]
+
+    def summary(self):
+        """
+        The counts so far: batches seen, model calls made and avoided, and how the avoided ones were resolved.
+        """
+        with self.lock:
+            summary = dict(self.stats)
+        summary["avoided_share"] = summary["calls_avoided"] / summary["batches"] if summary["batches"] else 0.0
+        return summary
+
+#################################### Recall ########################################
+def measure_recall(prefilter, identify_function, batches, client, model="gpt-4", category=None, labels=None, **kwargs):
+    """
+    Compare the pre-filtered path with the LLM-only path on a labelled sample.
+
+    Every batch is sent to the model once (the LLM-only answer) and once through the prefilter, which
+    reuses those answers for the batches it forwards; the prefilter's own counts are not changed.
+
+    Parameters:
+    - prefilter (EntityPrefilter): The settings to evaluate. Its confirmed dictionary is copied, not updated.
+    - identify_function (callable): As for EntityPrefilter.collect.
+    - batches (list of str): The sample.
+    - client: The OpenAI API client instance.
+    - model (str): The model to use for processing (default: "gpt-4").
+    - category (str, optional): The category a single-category function extracts.
+    - labels (dict, optional): Category -> the true entities of the sample, to also score both paths against.
+    - **kwargs: Extra keyword arguments passed to identify_function.
+
+    Returns:
+    - dict: Per category, the entities found by each path and the prefilter's recall against the LLM-only
+      path (and against the labels, if given), plus the share of calls the prefilter avoided.
+    """
+    combined = "categories" in kwargs
+    categories = list(kwargs["categories"]) if combined else [category]
+    llm_results = [identify_function(batch, client, model=model, **kwargs) for batch in batches]
+    answers = dict(zip(batches, llm_results))
+    trial = EntityPrefilter(prefilter.categories, prefilter.gazetteer, prefilter.known)
+
+    def answer(batch, client, categories=None, **_):
+        # A narrowed call only sees the categories it asked for
+        if categories is None:
+            return answers[batch]
+        return {category: answers[batch][category] for category in categories}
+
+    filtered = trial.collect(answer, batches, client, model=model, category=category, **kwargs)
+
+    report = {"calls_avoided": trial.stats["calls_avoided"], "batches": len(batches)}
+    for category in categories:
+        def union(results):
+            return set().union(*((result[category] if combined else result) for result in results))
+        reference, found = union(llm_results), union(filtered)
+        report[category] = {
+            "llm_only": len(reference),
+            "prefiltered": len(found),
+            "recall_vs_llm": len(found & reference) / len(reference) if reference else 1.0,
+        }
+        if labels is not None:
+            truth = set(labels.get(category, ()))
+            report[category]["recall_vs_labels"] = len(found & truth) / len(truth) if truth else 1.0
+            report[category]["llm_recall_vs_labels"] = len(reference & truth) / len(truth) if truth else 1.0
+    return report
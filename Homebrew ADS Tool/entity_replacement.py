@@ -0,0 +1,71 @@
+import re
+from functools import lru_cache
+
+#################################### Build Matcher ########################################
+def _is_word_char(char):
+    return re.match(r"\w", char) is not None
+
+def _trie_pattern(node, last_char=None):
+    """
+    Turn a character trie into a regex fragment. Longer continuations are tried before ending
+    at a node, so the regex prefers the longest entity at each position.
+    """
+    alternatives = []
+    for char in sorted(key for key in node if key != ""):
+        # Entities that start with a word character must not start in the middle of a word
+        prefix = r"(?<!\w)" if last_char is None and _is_word_char(char) else ""
+        alternatives.append(prefix + re.escape(char) + _trie_pattern(node[char], char))
+    if "" in node:
+        # Entities that end with a word character must not end in the middle of a word
+        alternatives.append(r"(?!\w)" if _is_word_char(last_char) else "")
+    if len(alternatives) == 1:
+        return alternatives[0]
+    return "(?:" + "|".join(alternatives) + ")"
+
+@lru_cache(maxsize=256)
+def _compile_entities(entities):
+    trie = {}
+    for entity in entities:
+        node = trie
+        for char in entity:
+            node = node.setdefault(char, {})
+        node[""] = {}
+    return re.compile(_trie_pattern(trie))
+
+def compile_entity_pattern(entities):
+    """
+    Compile a set of entities into one regex that finds them all in a single pass over the text.
+
+    The entities are merged into a character trie, so matching at each position costs at most the
+    length of the longest entity rather than the number of entities. Overlaps resolve the same way
+    every time: the leftmost match wins, and among matches at the same position the longest wins
+    (so "Dr. Ann Lee" is replaced as a whole before "Ann" is considered). Entities are matched only
+    at word boundaries where they start or end with a word character.
+
+    Parameters:
+    - entities (iterable of str): The entities to match.
+
+    Returns:
+    - re.Pattern or None: The compiled pattern, or None if there are no entities.
+    """
+    entities = tuple(sorted({entity for entity in entities if entity}))
+    if not entities:
+        return None
+    return _compile_entities(entities)
+
+#################################### Replace ########################################
+def replace_entities(text, mapping):
+    """
+    Replace every occurrence of the mapped entities in a text with their identifiers in one linear pass.
+
+    Parameters:
+    - text (str): The text to rewrite.
+    - mapping (dict): A mapping of original entities to their identifiers.
+
+    Returns:
+    - str: The rewritten text. Line breaks and all other formatting are preserved.
+    """
+    pattern = compile_entity_pattern(mapping)
+    if pattern is None:
+        return text
+    return pattern.sub(lambda match: mapping[match.group(0)], text)
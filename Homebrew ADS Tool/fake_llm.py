@@ -0,0 +1,200 @@
+import re
+import json
+import time
+import random
+import threading
+from types import SimpleNamespace
+from llm_dispatch import estimate_tokens
+from synthetic_transcripts import FIRST_NAMES, LAST_NAMES, LOCATIONS, MONTHS
+
+# Patterns for the entities synthetic_transcripts.py puts into the text
+NAME_PATTERN = re.compile(rf"\b(?:{'|'.join(FIRST_NAMES)}) (?:{'|'.join(LAST_NAMES)})\b")
+LOCATION_PATTERN = re.compile("|".join(re.escape(location) for location in sorted(LOCATIONS, key=len, reverse=True)))
+DATE_PATTERN = re.compile(rf"\b(?:(?:{'|'.join(MONTHS)}) \d{{1,2}}|\d{{1,2}}/\d{{1,2}}/\d{{4}})\b")
+
+#################################### Latency ########################################
+def sample_latency(distribution, rng):
+    """
+    Draw one simulated response time.
+
+    Parameters:
+    - distribution (tuple): A distribution name followed by its parameters:
+      ("constant", seconds), ("uniform", low, high), ("lognormal", median, sigma) or ("exponential", mean).
+    - rng (random.Random): The random generator to draw from.
+
+    Returns:
+    - float: The latency in seconds.
+    """
+    kind, *params = distribution
+    if kind == "constant":
+        return params[0]
+    if kind == "uniform":
+        return rng.uniform(params[0], params[1])
+    if kind == "lognormal":
+        # Parameterised by the median, which is easier to read off a dashboard than mu
+        return params[0] * rng.lognormvariate(0.0, params[1])
+    if kind == "exponential":
+        return rng.expovariate(1.0 / params[0])
+    raise ValueError(f"Unknown latency distribution: {kind}")
+
+#################################### Errors ########################################
+class FakeAPIError(Exception):
+    """
+    Error raised by the fake client, shaped like the OpenAI client's errors so the dispatcher's
+    retry logic treats it the same way (status_code, and response.headers for Retry-After).
+    """
+    def __init__(self, message, status_code, retry_after=None):
+        super().__init__(message)
+        self.status_code = status_code
+        headers = {"retry-after": str(retry_after)} if retry_after is not None else {}
+        self.response = SimpleNamespace(status_code=status_code, headers=headers)
+
+class RateLimitError(FakeAPIError):
+    pass
+
+class InternalServerError(FakeAPIError):
+    pass
+
+#################################### Responses ########################################
+def find_entities(text):
+    """
+    Find the synthetic names, locations and dates in a text, in order of first appearance.
+
+    Returns:
+    - dict: A mapping of "names", "locations" and "dates" to lists of entities.
+    """
+    return {
+        category: list(dict.fromkeys(pattern.findall(text)))
+        for category, pattern in (("names", NAME_PATTERN), ("locations", LOCATION_PATTERN), ("dates", DATE_PATTERN))
+    }
+
+def annotate_sentences(text):
+    # Alternate doctor and patient turns sentence by sentence, like a plausible rewrite would
+    sentences = [sentence for sentence in re.split(r"(?<=[.!?])\s+", text.strip()) if sentence]
+    return "\n".join(
+        f"{'Doctor' if i % 2 == 0 else 'Patient'}: {sentence}" for i, sentence in enumerate(sentences)
+    )
+
+def label_sentences(numbered):
+    # The label-only counterpart of annotate_sentences: the same alternation, as {"1": "D", "2": "P", ...}
+    numbers = re.findall(r"^(\d+)\. ", numbered, flags=re.MULTILINE)
+    return json.dumps({number: "D" if i % 2 == 0 else "P" for i, number in enumerate(numbers)})
+
+def fake_reply(messages):
+    """
+    Produce the reply a model would give to one of this repo's prompts, recognised by its system message.
+
+    Parameters:
+    - messages (list of dict): The chat messages of the request.
+
+    Returns:
+    - str: The reply text.
+    """
+    system = messages[0]["content"]
+    user = messages[-1]["content"]
+    # The transcript follows the instructions after the first blank line
+    transcript = user.split("\n\n", 1)[-1]
+    if "labeling" in system:
+        return label_sentences(transcript)
+    entities = find_entities(transcript)
+    if "JSON" in system:
+        requested = re.findall(r'- "(\w+)":', user) or list(entities)
+        return json.dumps({category: entities[category] for category in requested})
+    for category in ("names", "locations", "dates"):
+        if f"identifying {category}" in system:
+            return ", ".join(entities[category]) or "None"
+    if "annotating" in system:
+        return annotate_sentences(transcript)
+    return "None"
+
+#################################### Client ########################################
+class FakeOpenAIClient:
+    """
+    Stand-in for an OpenAI client with simulated latency, errors and realistic replies, for measuring
+    throughput without API cost. It answers the names, locations, dates, single-pass JSON, speaker
+    annotation and speaker label prompts by matching the vocabulary of synthetic_transcripts.py.
+
+    Parameters:
+    - latency (tuple): The latency distribution per call, see sample_latency (default: ("lognormal", 0.8, 0.5)).
+    - seconds_per_output_token (float): Extra latency per generated token, as in real decoding (default: 0.0).
+    - error_rate (float): Probability that a call fails (default: 0.0).
+    - rate_limit_share (float): Share of failures that are 429 rate limits rather than 500 errors (default: 0.8).
+    - retry_after (float, optional): Retry-After value sent with rate-limit errors.
+    - malformed_rate (float): Probability that a JSON reply is cut off, to exercise fallbacks (default: 0.0).
+    - time_scale (float): Multiplies every simulated delay, e.g. 0.01 to run a benchmark 100x faster
+      while keeping the shape of the distribution (default: 1.0).
+    - seed (int, optional): Seed for the latency, error and malformation draws.
+    """
+    def __init__(
+        self,
+        latency=("lognormal", 0.8, 0.5),
+        seconds_per_output_token=0.0,
+        error_rate=0.0,
+        rate_limit_share=0.8,
+        retry_after=None,
+        malformed_rate=0.0,
+        time_scale=1.0,
+        seed=None
+    ):
+        self.latency = latency
+        self.seconds_per_output_token = seconds_per_output_token
+        self.error_rate = error_rate
+        self.rate_limit_share = rate_limit_share
+        self.retry_after = retry_after
+        self.malformed_rate = malformed_rate
+        self.time_scale = time_scale
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self.lock:
+            self.calls = 0
+            self.errors = 0
+            self.prompt_tokens = 0
+            self.completion_tokens = 0
+            self.latencies = []
+
+    def create(self, model, messages, **kwargs):
+        start = time.perf_counter()
+        reply = fake_reply(messages)
+        prompt_tokens = sum(estimate_tokens(message["content"]) for message in messages)
+        completion_tokens = estimate_tokens(reply)
+        with self.lock:
+            # Draw everything under the lock so a seeded run is reproducible across threads
+            delay = sample_latency(self.latency, self.rng)
+            fail = self.rng.random() < self.error_rate
+            rate_limited = self.rng.random() < self.rate_limit_share
+            malformed = self.rng.random() < self.malformed_rate
+            self.calls += 1
+        if not fail:
+            delay += self.seconds_per_output_token * completion_tokens
+        time.sleep(delay * self.time_scale)
+        with self.lock:
+            self.latencies.append(time.perf_counter() - start)
+            if fail:
+                self.errors += 1
+            else:
+                self.prompt_tokens += prompt_tokens
+                self.completion_tokens += completion_tokens
+        if fail:
+            if rate_limited:
+                raise RateLimitError("Rate limit reached", status_code=429, retry_after=self.retry_after)
+            raise InternalServerError("The server had an error", status_code=500)
+        if malformed and reply.startswith("{"):
+            reply = reply[: len(reply) // 2]
+        return SimpleNamespace(
+            id=f"chatcmpl-fake-{self.calls}",
+            model=model,
+            choices=[SimpleNamespace(
+                index=0,
+                message=SimpleNamespace(role="assistant", content=reply),
+                finish_reason="stop"
+            )],
+            usage=SimpleNamespace(
+                prompt_tokens=prompt_tokens,
+                completion_tokens=completion_tokens,
+                total_tokens=prompt_tokens + completion_tokens
+            )
+        )
@@ -0,0 +1,322 @@
+import hmac
+import json
+import hashlib
+import sqlite3
+import threading
+import time
+from types import SimpleNamespace
+from encryption import fernet_class
+
+# Prefix of stored responses encrypted with the cache key
+ENCRYPTED_PREFIX = "fernet:"
+
+#################################### Helpers ########################################
+def make_cache_key(request):
+    """
+    Hash a chat completion request into a cache key. The key covers the model, every message
+    (system prompt and user content) and all other parameters such as temperature.
+
+    Parameters:
+    - request (dict): The keyword arguments passed to client.chat.completions.create.
+
+    Returns:
+    - str: A hex SHA-256 digest.
+    """
+    canonical = json.dumps(request, sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+def response_to_dict(response):
+    """
+    Convert a chat completion response into a JSON-serialisable dictionary.
+
+    Parameters:
+    - response: The object returned by client.chat.completions.create.
+
+    Returns:
+    - dict: The response data, with at least the choices' message contents and the usage.
+    """
+    if hasattr(response, "model_dump"):
+        return response.model_dump(mode="json")
+    usage = getattr(response, "usage", None)
+    return {
+        "choices": [
+            {"message": {"role": "assistant", "content": choice.message.content}}
+            for choice in response.choices
+        ],
+        "usage": {
+            field: getattr(usage, field, None)
+            for field in ("prompt_tokens", "completion_tokens", "total_tokens")
+        } if usage is not None else None,
+    }
+
+def dict_to_response(data):
+    """
+    Rebuild an object with attribute access (response.choices[0].message.content) from a stored response.
+
+    Parameters:
+    - data: The stored response data.
+
+    Returns:
+    - The response as nested SimpleNamespace objects.
+    """
+    if isinstance(data, dict):
+        return SimpleNamespace(**{key: dict_to_response(value) for key, value in data.items()})
+    if isinstance(data, list):
+        return [dict_to_response(item) for item in data]
+    return data
+
+#################################### Response Cache ########################################
+class ResponseCache:
+    """
+    Persistent, content-addressed cache of LLM responses stored in a local SQLite file.
+
+    The responses of the de-identification and annotation prompts contain the entities found in the
+    transcripts, so the cache holds patient information. Keep it with the transcripts, not in a shared
+    working directory, and pass a key to encrypt it at rest: the responses are then encrypted (Fernet,
+    from the cryptography package, as in MappingStore) and the request hashes are keyed with HMAC, so the
+    file reveals neither the answers nor which texts were sent.
+
+    Parameters:
+    - path (str): Path of the SQLite file (default: ".llm_cache.sqlite").
+    - max_entries (int, optional): Maximum number of stored responses; least recently used ones are evicted.
+    - max_bytes (int, optional): Maximum total size of stored responses in bytes; least recently used ones are evicted.
+    - ttl (float, optional): Seconds after which a stored response expires. None keeps responses forever.
+    - key (bytes or str, optional): Fernet key for encrypting the stored responses (see encryption.generate_key).
+    """
+    def __init__(self, path=".llm_cache.sqlite", max_entries=None, max_bytes=None, ttl=None, key=None):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.fernet = fernet_class()(key) if key is not None else None
+        self.hmac_key = (key.encode("ascii") if isinstance(key, str) else key) if key is not None else None
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "writes": 0, "evictions": 0, "expired": 0}
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    model TEXT,
+                    response TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )
+                """
+            )
+            self.connection.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed_at)")
+
+    def get(self, key):
+        """
+        Look up a stored response.
+
+        Parameters:
+        - key (str): The cache key.
+
+        Returns:
+        - dict or None: The stored response, or None on a miss or if the entry has expired.
+        """
+        key = self._storage_key(key)
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT response, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and self.ttl is not None and now - row[1] > self.ttl:
+                with self.connection:
+                    self.connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.stats["expired"] += 1
+                row = None
+            if row is None:
+                self.stats["misses"] += 1
+                return None
+            with self.connection:
+                self.connection.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+            self.stats["hits"] += 1
+        return json.loads(self._decrypt(row[0]))
+
+    def put(self, key, response, model=None):
+        """
+        Store a response and evict least recently used entries if the size cap is exceeded.
+
+        Parameters:
+        - key (str): The cache key.
+        - response (dict): The response data to store.
+        - model (str, optional): The model name, kept so entries can be invalidated per model.
+        """
+        key = self._storage_key(key)
+        payload = self._encrypt(json.dumps(response, ensure_ascii=False))
+        now = time.time()
+        with self.lock:
+            with self.connection:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                    (key, model, payload, len(payload.encode("utf-8")), now, now)
+                )
+                self.stats["writes"] += 1
+                self._evict()
+
+    def _storage_key(self, key):
+        # With a key, the stored hash is an HMAC, so it cannot be checked against guessed request texts
+        if self.hmac_key is None:
+            return key
+        return hmac.new(self.hmac_key, key.encode("utf-8"), hashlib.sha256).hexdigest()
+
+    def _encrypt(self, payload):
+        if self.fernet is None:
+            return payload
+        return ENCRYPTED_PREFIX + self.fernet.encrypt(payload.encode("utf-8")).decode("ascii")
+
+    def _decrypt(self, payload):
+        if not payload.startswith(ENCRYPTED_PREFIX):
+            return payload
+        if self.fernet is None:
+            raise ValueError("The response cache is encrypted; open it with its key to read it")
+        return self.fernet.decrypt(payload[len(ENCRYPTED_PREFIX):].encode("ascii")).decode("utf-8")
+
+    def _evict(self):
+        # Called with the lock held and inside a transaction
+        if self.max_entries is not None:
+            count = self.connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            if count > self.max_entries:
+                self._delete_oldest(count - self.max_entries)
+        if self.max_bytes is not None:
+            total = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if total > self.max_bytes:
+                excess = total - self.max_bytes
+                rows = self.connection.execute("SELECT size FROM responses ORDER BY accessed_at").fetchall()
+                count = 0
+                for (size,) in rows:
+                    if excess <= 0:
+                        break
+                    excess -= size
+                    count += 1
+                self._delete_oldest(count)
+
+    def _delete_oldest(self, count):
+        self.connection.execute(
+            "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY accessed_at LIMIT ?)",
+            (count,)
+        )
+        self.stats["evictions"] += count
+
+    def invalidate(self, key=None, model=None):
+        """
+        Remove entries explicitly: one key, every entry for a model, or everything if neither is given.
+
+        Parameters:
+        - key (str, optional): The cache key to remove.
+        - model (str, optional): Remove every entry produced by this model.
+
+        Returns:
+        - int: The number of removed entries.
+        """
+        with self.lock:
+            with self.connection:
+                if key is not None:
+                    cursor = self.connection.execute(
+                        "DELETE FROM responses WHERE key = ?", (self._storage_key(key),)
+                    )
+                elif model is not None:
+                    cursor = self.connection.execute("DELETE FROM responses WHERE model = ?", (model,))
+                else:
+                    cursor = self.connection.execute("DELETE FROM responses")
+            return cursor.rowcount
+
+    def purge_expired(self):
+        """
+        Remove every entry older than the TTL.
+
+        Returns:
+        - int: The number of removed entries.
+        """
+        if self.ttl is None:
+            return 0
+        with self.lock:
+            with self.connection:
+                cursor = self.connection.execute(
+                    "DELETE FROM responses WHERE created_at < ?", (time.time() - self.ttl,)
+                )
+            self.stats["expired"] += cursor.rowcount
+            return cursor.rowcount
+
+    def summary(self):
+        """
+        Report hit/miss statistics together with the current size of the cache.
+
+        Returns:
+        - dict: Counters, hit rate, number of entries and total bytes stored.
+        """
+        with self.lock:
+            entries, size = self.connection.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()
+            lookups = self.stats["hits"] + self.stats["misses"]
+            return dict(
+                self.stats,
+                hit_rate=self.stats["hits"] / lookups if lookups else 0.0,
+                entries=entries,
+                bytes=size
+            )
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+#################################### Cached Client ########################################
+class CachedClient:
+    """
+    Wraps an OpenAI client so that client.chat.completions.create is served from a ResponseCache
+    when an identical request has been made before. Every other attribute is passed through.
+
+    Parameters:
+    - client: The OpenAI API client instance to wrap.
+    - cache (ResponseCache): The cache to read from and write to.
+    """
+    def __init__(self, client, cache):
+        self.client = client
+        self.cache = cache
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, **kwargs):
+        # Streaming responses cannot be replayed, so they bypass the cache
+        if kwargs.get("stream"):
+            return self.client.chat.completions.create(**kwargs)
+        key = make_cache_key(kwargs)
+        stored = self.cache.get(key)
+        if stored is not None:
+            response = dict_to_response(stored)
+            # Lets callers that count usage tell replayed responses from ones that were paid for
+            response.from_cache = True
+            return response
+        response = self.client.chat.completions.create(**kwargs)
+        self.cache.put(key, response_to_dict(response), model=kwargs.get("model"))
+        return response
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+def with_cache(client, cache):
+    """
+    Wrap a client with a response cache, or return it unchanged if no cache is given. A client that is
+    already cached with another cache is rewrapped around its inner client, so the requested cache is used.
+
+    Parameters:
+    - client: The OpenAI API client instance.
+    - cache (ResponseCache or str, optional): A cache, or the path of a cache file to open (unencrypted;
+      open a ResponseCache with a key to encrypt it).
+
+    Returns:
+    - The client to use for API calls.
+    """
+    if cache is None:
+        return client
+    if isinstance(client, CachedClient):
+        if cache is client.cache or cache == client.cache.path:
+            return client
+        client = client.client
+    if isinstance(cache, str):
+        cache = ResponseCache(cache)
+    return CachedClient(client, cache)
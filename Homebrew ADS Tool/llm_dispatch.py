@@ -0,0 +1,195 @@
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Errors worth retrying: rate limits, timeouts and transient server failures
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+RETRYABLE_ERROR_NAMES = {
+    "RateLimitError",
+    "APITimeoutError",
+    "APIConnectionError",
+    "InternalServerError",
+    "TimeoutError",
+    "ConnectionError",
+}
+
+#################################### Helpers ########################################
+def estimate_tokens(text):
+    """
+    Roughly estimate the number of model tokens in a piece of text (about 4 characters per token).
+
+    Parameters:
+    - text (str): The text to measure.
+
+    Returns:
+    - int: The estimated token count (at least 1).
+    """
+    return max(1, len(text) // 4)
+
+def is_retryable_error(error):
+    """
+    Decide whether an exception raised by the API client is a rate-limit or transient error.
+
+    Parameters:
+    - error (Exception): The exception raised by the client call.
+
+    Returns:
+    - bool: True if the call should be retried.
+    """
+    status_code = getattr(error, "status_code", None)
+    if status_code in RETRYABLE_STATUS_CODES:
+        return True
+    return any(cls.__name__ in RETRYABLE_ERROR_NAMES for cls in type(error).__mro__)
+
+def retry_after_seconds(error):
+    """
+    Read the server-suggested wait time from an error's Retry-After header, if there is one.
+
+    Parameters:
+    - error (Exception): The exception raised by the client call.
+
+    Returns:
+    - float or None: Seconds to wait, or None if the error does not carry a hint.
+    """
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    value = headers.get("retry-after") if hasattr(headers, "get") else None
+    try:
+        return float(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+#################################### Token Budget ########################################
+class TokenBudget:
+    """
+    Token bucket enforcing a tokens-per-minute budget shared by all threads.
+
+    Parameters:
+    - tokens_per_minute (int): The number of tokens that may be spent per minute.
+    - clock (callable): Monotonic clock, replaceable for testing (default: time.monotonic).
+    - sleep (callable): Sleep function, replaceable for testing (default: time.sleep).
+    """
+    def __init__(self, tokens_per_minute, clock=time.monotonic, sleep=time.sleep):
+        self.capacity = float(tokens_per_minute)
+        self.rate = self.capacity / 60.0
+        self.available = self.capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens):
+        # A request larger than the whole budget waits for a full bucket instead of blocking forever
+        tokens = min(float(tokens), self.capacity)
+        while True:
+            with self.lock:
+                now = self.clock()
+                self.available = min(self.capacity, self.available + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.available >= tokens:
+                    self.available -= tokens
+                    return
+                wait = (tokens - self.available) / self.rate
+            self.sleep(wait)
+
+#################################### Dispatcher ########################################
+class LLMDispatcher:
+    """
+    Runs blocking LLM calls concurrently with a shared concurrency limit, a tokens-per-minute
+    budget, and exponential backoff with full jitter on rate-limit and transient errors.
+
+    One dispatcher can be shared by every batch of every file, so the limits hold across a whole run.
+
+    Parameters:
+    - max_concurrency (int): Maximum number of calls in flight at once (default: 4).
+    - tokens_per_minute (int, optional): Token budget per minute; None disables the budget.
+    - max_retries (int): Retries per call before the error is raised (default: 6).
+    - base_delay (float): First backoff delay in seconds (default: 1.0).
+    - max_delay (float): Upper bound for a single backoff delay in seconds (default: 60.0).
+    - sleep (callable): Sleep function, replaceable for testing (default: time.sleep).
+    - seed (int, optional): Seed for the jitter random generator.
+    """
+    def __init__(
+        self,
+        max_concurrency=4,
+        tokens_per_minute=None,
+        max_retries=6,
+        base_delay=1.0,
+        max_delay=60.0,
+        sleep=time.sleep,
+        seed=None
+    ):
+        self.max_concurrency = max_concurrency
+        self.semaphore = threading.BoundedSemaphore(max_concurrency)
+        self.budget = TokenBudget(tokens_per_minute, sleep=sleep) if tokens_per_minute else None
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.sleep = sleep
+        self.random = random.Random(seed)
+        self.random_lock = threading.Lock()
+
+    def backoff_delay(self, attempt, error=None):
+        # Full jitter: uniform between 0 and the capped exponential delay, never below a server hint
+        cap = min(self.max_delay, self.base_delay * (2 ** attempt))
+        with self.random_lock:
+            delay = self.random.uniform(0, cap)
+        hint = retry_after_seconds(error) if error is not None else None
+        return max(delay, hint) if hint is not None else delay
+
+    def call(self, func, *args, tokens=0, **kwargs):
+        """
+        Call func(*args, **kwargs) under the concurrency limit and token budget, retrying transient errors.
+        An error carrying an on_retry callable (as set by telemetry.InstrumentedClient) has it called for
+        each retry, so retries are counted where they happen.
+
+        Parameters:
+        - func (callable): The blocking function to call.
+        - tokens (int): Estimated tokens the call will consume (default: 0).
+
+        Returns:
+        - The return value of func.
+        """
+        attempt = 0
+        while True:
+            if self.budget is not None and tokens:
+                self.budget.acquire(tokens)
+            with self.semaphore:
+                try:
+                    return func(*args, **kwargs)
+                except Exception as error:
+                    if attempt >= self.max_retries or not is_retryable_error(error):
+                        raise
+                    delay = self.backoff_delay(attempt, error)
+                    on_retry = getattr(error, "on_retry", None)
+                    if callable(on_retry):
+                        on_retry()
+            # Sleep outside the semaphore so a backing-off call does not hold a slot
+            attempt += 1
+            self.sleep(delay)
+
+    def map(self, func, items, *args, **kwargs):
+        """
+        Apply func(item, *args, **kwargs) to every item concurrently and return results in input order.
+
+        Parameters:
+        - func (callable): The blocking function to call for each item.
+        - items (iterable): The items to process (e.g., transcript batches).
+
+        Returns:
+        - list: The results, in the same order as items.
+        """
+        items = list(items)
+        if not items:
+            return []
+        with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(items))) as executor:
+            futures = [
+                executor.submit(
+                    self.call, func, item, *args,
+                    tokens=estimate_tokens(item) if isinstance(item, str) else 0,
+                    **kwargs
+                )
+                for item in items
+            ]
+            return [future.result() for future in futures]
@@ -0,0 +1,220 @@
+import json
+import time
+import uuid
+import threading
+from email.parser import BytesParser
+from email.policy import default as default_policy
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+#################################### Stand-in Server ########################################
+class LocalBatchServer:
+    """
+    Local stand-in for the provider's files and batches endpoints, for running bulk mode end to end
+    without network access or cost. Point an OpenAI client at it with
+    OpenAI(base_url=server.base_url, api_key="local").
+
+    Supported endpoints: POST /v1/files, GET /v1/files/{id}, GET /v1/files/{id}/content,
+    POST /v1/batches, GET /v1/batches/{id}, POST /v1/batches/{id}/cancel, and POST /v1/chat/completions
+    for the synchronous retries of requests a batch did not complete.
+
+    Parameters:
+    - respond (callable): Maps a request body (dict with "model" and "messages") to the reply text. If it
+      raises, the request is reported in the batch's error file instead.
+    - polls_until_complete (int): Number of status polls a batch stays "in_progress" before it completes
+      (default: 1).
+    - host (str): Interface to listen on (default: "127.0.0.1").
+    - port (int): Port to listen on; 0 picks a free port (default: 0).
+    """
+    def __init__(self, respond, polls_until_complete=1, host="127.0.0.1", port=0):
+        self.respond = respond
+        self.polls_until_complete = polls_until_complete
+        self.files = {}
+        self.batches = {}
+        self.polls = {}
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self._handler_class())
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    #################################### State ########################################
+    def _store_file(self, data, filename, purpose):
+        file_id = f"file-{uuid.uuid4().hex[:24]}"
+        self.files[file_id] = {
+            "data": data,
+            "object": {
+                "id": file_id,
+                "object": "file",
+                "bytes": len(data),
+                "created_at": int(time.time()),
+                "filename": filename,
+                "purpose": purpose,
+                "status": "processed",
+            },
+        }
+        return self.files[file_id]["object"]
+
+    def _completion(self, body):
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex[:16]}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": self.respond(body)},
+                "finish_reason": "stop",
+            }],
+            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+        }
+
+    def _run_batch(self, batch):
+        # Answer every request in the input file, writing successes and errors to separate files
+        outputs, errors = [], []
+        for line in self.files[batch["input_file_id"]]["data"].decode("utf-8").splitlines():
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            try:
+                completion = self._completion(request["body"])
+            except Exception as error:
+                errors.append({
+                    "id": f"batch_req_{uuid.uuid4().hex[:16]}",
+                    "custom_id": request["custom_id"],
+                    "response": None,
+                    "error": {"code": "server_error", "message": str(error)},
+                })
+                continue
+            outputs.append({
+                "id": f"batch_req_{uuid.uuid4().hex[:16]}",
+                "custom_id": request["custom_id"],
+                "response": {
+                    "status_code": 200,
+                    "request_id": uuid.uuid4().hex,
+                    "body": completion,
+                },
+                "error": None,
+            })
+        if outputs:
+            data = "".join(json.dumps(record) + "\n" for record in outputs).encode("utf-8")
+            batch["output_file_id"] = self._store_file(data, "batch_output.jsonl", "batch_output")["id"]
+        if errors:
+            data = "".join(json.dumps(record) + "\n" for record in errors).encode("utf-8")
+            batch["error_file_id"] = self._store_file(data, "batch_errors.jsonl", "batch_output")["id"]
+        batch["status"] = "completed"
+        batch["completed_at"] = int(time.time())
+        batch["request_counts"] = {
+            "total": len(outputs) + len(errors),
+            "completed": len(outputs),
+            "failed": len(errors),
+        }
+
+    #################################### HTTP ########################################
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def _send(self, status, payload, content_type="application/json"):
+                body = payload if isinstance(payload, bytes) else json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _not_found(self):
+                self._send(404, {"error": {"message": f"Unknown path {self.path}", "type": "invalid_request_error"}})
+
+            def _body(self):
+                return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+            def do_POST(self):
+                parts = self.path.split("?")[0].strip("/").split("/")
+                with server.lock:
+                    if parts == ["v1", "files"]:
+                        # Parse the multipart upload with the standard library's MIME parser
+                        message = BytesParser(policy=default_policy).parsebytes(
+                            b"Content-Type: " + self.headers["Content-Type"].encode("latin-1") + b"\r\n\r\n" + self._body()
+                        )
+                        fields, data, filename = {}, b"", "upload.jsonl"
+                        for part in message.iter_parts():
+                            name = part.get_param("name", header="content-disposition")
+                            if name == "file":
+                                data = part.get_payload(decode=True)
+                                filename = part.get_filename() or filename
+                            else:
+                                fields[name] = part.get_content().strip()
+                        self._send(200, server._store_file(data, filename, fields.get("purpose", "batch")))
+                    elif parts == ["v1", "batches"]:
+                        request = json.loads(self._body() or b"{}")
+                        if request.get("input_file_id") not in server.files:
+                            self._send(400, {"error": {"message": "Unknown input_file_id", "type": "invalid_request_error"}})
+                            return
+                        batch_id = f"batch_{uuid.uuid4().hex[:24]}"
+                        server.batches[batch_id] = {
+                            "id": batch_id,
+                            "object": "batch",
+                            "endpoint": request.get("endpoint"),
+                            "input_file_id": request["input_file_id"],
+                            "completion_window": request.get("completion_window", "24h"),
+                            "status": "validating",
+                            "output_file_id": None,
+                            "error_file_id": None,
+                            "created_at": int(time.time()),
+                            "request_counts": {"total": 0, "completed": 0, "failed": 0},
+                            "metadata": request.get("metadata"),
+                        }
+                        server.polls[batch_id] = 0
+                        self._send(200, server.batches[batch_id])
+                    elif parts == ["v1", "chat", "completions"]:
+                        try:
+                            self._send(200, server._completion(json.loads(self._body())))
+                        except Exception as error:
+                            self._send(500, {"error": {"message": str(error), "type": "server_error"}})
+                    elif len(parts) == 4 and parts[:2] == ["v1", "batches"] and parts[3] == "cancel" and parts[2] in server.batches:
+                        server.batches[parts[2]]["status"] = "cancelled"
+                        self._send(200, server.batches[parts[2]])
+                    else:
+                        self._not_found()
+
+            def do_GET(self):
+                parts = self.path.split("?")[0].strip("/").split("/")
+                with server.lock:
+                    if len(parts) == 3 and parts[:2] == ["v1", "batches"] and parts[2] in server.batches:
+                        batch = server.batches[parts[2]]
+                        if batch["status"] in ("validating", "in_progress"):
+                            # Each poll moves the job along; it completes after the configured number of polls
+                            server.polls[parts[2]] += 1
+                            batch["status"] = "in_progress"
+                            if server.polls[parts[2]] > server.polls_until_complete:
+                                server._run_batch(batch)
+                        self._send(200, batch)
+                    elif len(parts) == 3 and parts[:2] == ["v1", "files"] and parts[2] in server.files:
+                        self._send(200, server.files[parts[2]]["object"])
+                    elif len(parts) == 4 and parts[:2] == ["v1", "files"] and parts[3] == "content" and parts[2] in server.files:
+                        self._send(200, server.files[parts[2]]["data"], content_type="application/octet-stream")
+                    else:
+                        self._not_found()
+
+        return Handler
@@ -0,0 +1,173 @@
+import os
+import json
+import stat
+import time
+import hashlib
+import tempfile
+import contextlib
+import threading
+
+# Read once at import: os.umask can only be queried by setting it, which is not safe once threads run
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+#################################### Helpers ########################################
+def _replacement_mode(path):
+    # mkstemp creates files readable by the owner only; give the replacement the mode of the file it
+    # replaces, or the one a plain open() would have created
+    try:
+        return stat.S_IMODE(os.stat(path).st_mode)
+    except FileNotFoundError:
+        return 0o666 & ~_UMASK
+
+def file_sha256(path, block_size=1 << 20):
+    """
+    Hash a file's content without reading it into memory at once.
+
+    Parameters:
+    - path (str): Path to the file.
+    - block_size (int): Bytes read per step (default: 1 MiB).
+
+    Returns:
+    - str: The hex SHA-256 digest of the file.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def params_fingerprint(params):
+    """
+    Hash a stage's parameters (model, flags, batch size, ...) so a change in any of them is detected.
+
+    Parameters:
+    - params (dict): JSON-serialisable stage parameters.
+
+    Returns:
+    - str: The hex SHA-256 digest of the parameters.
+    """
+    canonical = json.dumps(params, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+def tokenizer_name(count_tokens):
+    """
+    A stable name for a token counting function, for use in stage parameters.
+    """
+    if count_tokens is None:
+        return "words"
+    return getattr(count_tokens, "__name__", type(count_tokens).__name__)
+
+@contextlib.contextmanager
+def atomic_open(path, encoding="utf-8"):
+    """
+    Open a text file for writing atomically, so it can be written piece by piece. The content goes to
+    a temporary file in the same folder, which is renamed over the target when the block exits normally.
+    A crash or an exception mid-write leaves either the old file or no file, never a partial one.
+
+    Parameters:
+    - path (str): Path of the file to write.
+    - encoding (str): The text encoding (default: "utf-8").
+
+    Yields:
+    - file: The temporary file, open for writing.
+    """
+    folder = os.path.dirname(os.path.abspath(path))
+    descriptor, temporary_path = tempfile.mkstemp(dir=folder, prefix=".tmp-", suffix=os.path.basename(path))
+    try:
+        with os.fdopen(descriptor, "w", encoding=encoding) as file:
+            yield file
+            file.flush()
+            os.fsync(file.fileno())
+        os.chmod(temporary_path, _replacement_mode(path))
+        os.replace(temporary_path, path)
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+
+def atomic_write(path, text, encoding="utf-8"):
+    """
+    Write a text file atomically: the content goes to a temporary file in the same folder, which is then
+    renamed over the target. A crash mid-write leaves either the old file or no file, never a partial one.
+
+    Parameters:
+    - path (str): Path of the file to write.
+    - text (str): The content to write.
+    - encoding (str): The text encoding (default: "utf-8").
+    """
+    with atomic_open(path, encoding=encoding) as file:
+        file.write(text)
+
+#################################### Manifest ########################################
+class StageManifest:
+    """
+    Append-only JSONL record of the files a stage has finished, kept in the stage's output folder.
+
+    Each line records an input file's name and content hash, the fingerprint of the stage parameters,
+    and the output path. On a rerun, an input whose content and parameters match its latest record,
+    and whose output still exists, is skipped. A record is only appended after the output has been
+    written (atomically), so an interrupted run resumes exactly at the first unfinished file.
+
+    Parameters:
+    - output_folder (str): The stage's output folder, where the manifest file lives.
+    - stage (str): The stage name, e.g. "transcribe", "deidentify" or "annotate".
+    """
+    def __init__(self, output_folder, stage):
+        self.path = os.path.join(output_folder, f".manifest_{stage}.jsonl")
+        self.stage = stage
+        self.lock = threading.Lock()
+        self.records = {}
+        if os.path.exists(self.path):
+            with open(self.path, "r", encoding="utf-8") as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # A line cut off by a crash is ignored; its file will simply be redone
+                        continue
+                    self.records[record["input"]] = record
+
+    def is_complete(self, input_name, input_hash, params_hash):
+        """
+        Check whether an input was already processed with the same content and parameters.
+
+        Parameters:
+        - input_name (str): The input file name.
+        - input_hash (str): The input file's content hash.
+        - params_hash (str): The fingerprint of the stage parameters.
+
+        Returns:
+        - bool: True if the input can be skipped.
+        """
+        record = self.records.get(input_name)
+        return (
+            record is not None
+            and record["input_hash"] == input_hash
+            and record["params_hash"] == params_hash
+            and os.path.exists(record["output"])
+        )
+
+    def record(self, input_name, input_hash, params_hash, output_path):
+        """
+        Append a completion record for an input. Call this only after its output has been written.
+
+        Parameters:
+        - input_name (str): The input file name.
+        - input_hash (str): The input file's content hash.
+        - params_hash (str): The fingerprint of the stage parameters.
+        - output_path (str): Path of the finished output file.
+        """
+        record = {
+            "input": input_name,
+            "input_hash": input_hash,
+            "params_hash": params_hash,
+            "output": output_path,
+            "completed_at": time.time(),
+        }
+        with self.lock:
+            with open(self.path, "a", encoding="utf-8") as file:
+                file.write(json.dumps(record) + "\n")
+                file.flush()
+                os.fsync(file.fileno())
+            self.records[input_name] = record
@@ -0,0 +1,200 @@
+import time
+import sqlite3
+import threading
+from collections.abc import Mapping
+from encryption import fernet_class
+
+#################################### Mapping Store ########################################
+class MappingStore:
+    """
+    Append-only on-disk store of the entity mappings produced by de-identification, kept in a SQLite file.
+
+    Each de-identified file gets a new generation: its mappings are appended as rows of (file, generation,
+    category, identifier, original), and reading a file returns its latest completed generation only, so
+    rerunning a file replaces its mappings without rewriting earlier rows. A generation stays pending until
+    complete_file is called after the file's output is in place, so a run that crashes mid-file leaves the
+    previous mappings readable. Rows can be added while a file is being processed, so nothing has to be
+    held in memory for the whole corpus.
+
+    With a key, the original entities are encrypted at rest (Fernet, from the cryptography package); the
+    identifiers and file names are stored in clear so lookups do not need the key.
+
+    Parameters:
+    - path (str): Path of the SQLite file (default: "entity_mappings.sqlite").
+    - key (bytes or str, optional): Fernet key for encrypting the original entities (see encryption.generate_key).
+    """
+    def __init__(self, path="entity_mappings.sqlite", key=None):
+        self.path = path
+        self.fernet = fernet_class()(key) if key is not None else None
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS mappings (
+                    file TEXT NOT NULL,
+                    generation INTEGER NOT NULL,
+                    category TEXT NOT NULL,
+                    identifier TEXT NOT NULL,
+                    original BLOB NOT NULL,
+                    encrypted INTEGER NOT NULL,
+                    created_at REAL NOT NULL
+                )
+                """
+            )
+            self.connection.execute("CREATE INDEX IF NOT EXISTS mappings_file ON mappings (file, generation)")
+            self.connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS generations (
+                    file TEXT NOT NULL,
+                    generation INTEGER NOT NULL,
+                    completed_at REAL,
+                    PRIMARY KEY (file, generation)
+                )
+                """
+            )
+
+    def begin_file(self, file_name):
+        """
+        Start a new, pending generation for a file. Mappings added afterwards replace those of earlier runs
+        once complete_file is called.
+
+        Returns:
+        - int: The new generation number.
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT MAX(generation) FROM generations WHERE file = ?", (file_name,)
+            ).fetchone()
+            generation = (row[0] or 0) + 1
+            with self.connection:
+                self.connection.execute("INSERT INTO generations VALUES (?, ?, NULL)", (file_name, generation))
+        return generation
+
+    def complete_file(self, file_name, generation):
+        """
+        Mark a generation as complete, making it the one returned for the file. Call this only after the
+        file's output has been written.
+        """
+        with self.lock:
+            with self.connection:
+                self.connection.execute(
+                    "UPDATE generations SET completed_at = ? WHERE file = ? AND generation = ?",
+                    (time.time(), file_name, generation)
+                )
+
+    def add(self, file_name, generation, category, mapping):
+        """
+        Append entries of one category to a file's generation.
+
+        Parameters:
+        - file_name (str): The de-identified file.
+        - generation (int): The generation returned by begin_file.
+        - category (str): "names", "locations" or "dates".
+        - mapping (dict): The new {original: identifier} entries.
+        """
+        now = time.time()
+        rows = [
+            (file_name, generation, category, identifier, self._encrypt(original), self.fernet is not None, now)
+            for original, identifier in mapping.items()
+        ]
+        if not rows:
+            return
+        with self.lock:
+            with self.connection:
+                self.connection.executemany("INSERT INTO mappings VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def get(self, file_name, category=None):
+        """
+        Read a file's mappings from its latest completed generation.
+
+        Parameters:
+        - file_name (str): The de-identified file.
+        - category (str, optional): Only this category.
+
+        Returns:
+        - dict: Category -> {original: identifier}, or just {original: identifier} if category is given.
+          Empty if the file is not in the store.
+        """
+        query = (
+            "SELECT category, identifier, original, encrypted FROM mappings "
+            "WHERE file = ? AND generation = "
+            "(SELECT MAX(generation) FROM generations WHERE file = ? AND completed_at IS NOT NULL)"
+        )
+        parameters = [file_name, file_name]
+        if category is not None:
+            query += " AND category = ?"
+            parameters.append(category)
+        with self.lock:
+            rows = self.connection.execute(query, parameters).fetchall()
+        mappings = {}
+        for row_category, identifier, original, encrypted in rows:
+            mappings.setdefault(row_category, {})[self._decrypt(original, encrypted)] = identifier
+        return mappings.get(category, {}) if category is not None else mappings
+
+    def __contains__(self, file_name):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT 1 FROM generations WHERE file = ? AND completed_at IS NOT NULL LIMIT 1", (file_name,)
+            ).fetchone()
+        return row is not None
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute(
+                "SELECT COUNT(DISTINCT file) FROM generations WHERE completed_at IS NOT NULL"
+            ).fetchone()[0]
+
+    def files(self):
+        """
+        The names of the files with a completed generation in the store, in sorted order.
+        """
+        with self.lock:
+            return [row[0] for row in self.connection.execute(
+                "SELECT DISTINCT file FROM generations WHERE completed_at IS NOT NULL ORDER BY file"
+            )]
+
+    def view(self, category):
+        """
+        A read-only, lazy {file name: {original: identifier}} view of one category.
+        """
+        return MappingView(self, category)
+
+    def _encrypt(self, original):
+        if self.fernet is None:
+            return original
+        return self.fernet.encrypt(original.encode("utf-8"))
+
+    def _decrypt(self, original, encrypted):
+        if not encrypted:
+            return original
+        if self.fernet is None:
+            raise ValueError("The mapping store is encrypted; open it with its key to read the original entities")
+        return self.fernet.decrypt(original).decode("utf-8")
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+class MappingView(Mapping):
+    """
+    Lazy mapping of file names to one category's {original: identifier} dictionary, read from a
+    MappingStore on access. Shaped like the dictionaries deidentify_transcripts returns in memory.
+    """
+    def __init__(self, store, category):
+        self.store = store
+        self.category = category
+
+    def __getitem__(self, file_name):
+        if file_name not in self.store:
+            raise KeyError(file_name)
+        return self.store.get(file_name, self.category)
+
+    def __iter__(self):
+        return iter(self.store.files())
+
+    def __contains__(self, file_name):
+        return file_name in self.store
+
+    def __len__(self):
+        return len(self.store)
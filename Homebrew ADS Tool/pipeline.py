@@ -0,0 +1,372 @@
+import os
+import json
+import time
+import queue
+import argparse
+import threading
+import whisper
+from concurrent.futures import FIRST_COMPLETED, wait
+from deidentification import ENTITY_CATEGORIES, deidentify_text
+from mapping_store import MappingStore
+from speaker_annotation import annotate_transcript, turns_filename
+from llm_cache import ResponseCache, with_cache
+from manifest import StageManifest, atomic_write, file_sha256, params_fingerprint, tokenizer_name
+from transcribe_whisper import (
+    AUDIO_EXTENSIONS,
+    transcript_filename,
+    transcribe_audio,
+    transcribe_audio_in_worker,
+    start_worker_pool
+)
+
+# Placed on a queue to tell the next stage's workers that no more recordings are coming
+_DONE = object()
+
+#################################### Stage Workers ########################################
+def _transcription_stage(file_paths, output_queue, model_name, language, num_workers, threads_per_worker, failures):
+    # Hands each transcript to the next stage as soon as it is ready. Putting on the bounded queue blocks
+    # while de-identification is behind, which in turn stops new recordings from being decoded.
+    if num_workers > 1:
+        with start_worker_pool(model_name, num_workers, threads_per_worker) as executor:
+            pending = list(file_paths)
+            in_flight = {}
+            while pending or in_flight:
+                # Keep every worker busy, but never more recordings in flight than workers
+                while pending and len(in_flight) < num_workers:
+                    file_path = pending.pop(0)
+                    in_flight[executor.submit(transcribe_audio_in_worker, file_path, language)] = file_path
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    file_path = in_flight.pop(future)
+                    try:
+                        output_queue.put((file_path, future.result()))
+                    except Exception as error:
+                        failures[os.path.basename(file_path)] = f"transcribe: {type(error).__name__}: {error}"
+    elif file_paths:
+        model = whisper.load_model(model_name)
+        for file_path in file_paths:
+            try:
+                output_queue.put((file_path, transcribe_audio(model, file_path, language=language)))
+            except Exception as error:
+                failures[os.path.basename(file_path)] = f"transcribe: {type(error).__name__}: {error}"
+
+def _worker(stage, input_queue, output_queue, process, failures):
+    # Generic stage worker: take a recording, process it, pass it on; stop at the sentinel
+    while True:
+        item = input_queue.get()
+        if item is _DONE:
+            return
+        file_path, text = item
+        try:
+            result = process(file_path, text)
+        except Exception as error:
+            failures[os.path.basename(file_path)] = f"{stage}: {type(error).__name__}: {error}"
+        else:
+            if output_queue is not None:
+                output_queue.put((file_path, result))
+
+def _start_stage(stage, num_workers, input_queue, output_queue, process, failures):
+    threads = [
+        threading.Thread(target=_worker, args=(stage, input_queue, output_queue, process, failures), daemon=True)
+        for _ in range(num_workers)
+    ]
+    for thread in threads:
+        thread.start()
+    return threads
+
+def _stop_stage(threads, input_queue):
+    for _ in threads:
+        input_queue.put(_DONE)
+    for thread in threads:
+        thread.join()
+
+#################################### Pipeline ########################################
+def default_mapping_store_path(output_folder):
+    """
+    The mapping store used when none is given: next to the output folder rather than inside it, so
+    sharing the results does not share what re-identifies them ("results/" -> "results_entity_mappings.sqlite").
+    """
+    return os.path.normpath(os.path.abspath(output_folder)) + "_entity_mappings.sqlite"
+
+def run_pipeline(
+    input_folder,
+    output_folder,
+    client,
+    model_name="base",
+    language="en",
+    openai_chat_model="gpt-4",
+    deidentify_name=True,
+    deidentify_location=False,
+    deidentify_date=False,
+    transcribe_workers=1,
+    threads_per_worker=None,
+    deidentify_workers=4,
+    annotate_workers=4,
+    queue_size=4,
+    keep_intermediate=False,
+    dispatcher=None,
+    cache=None,
+    max_tokens=1000,
+    count_tokens=None,
+    resume=True,
+    prefilter=None,
+    annotation_mode="rewrite",
+    mapping_store=None
+):
+    """
+    Run transcription, de-identification and speaker annotation as one streaming pipeline.
+
+    Each recording flows through the three stages on its own: as soon as it is transcribed it is
+    de-identified, and as soon as that is done it is annotated, while other recordings are still being
+    decoded. The stages are connected by bounded queues, so a slow stage holds back the ones before it
+    instead of piling up transcripts in memory, and the total run time approaches that of the slowest stage.
+
+    Parameters:
+        input_folder (str): Folder containing the audio recordings.
+        output_folder (str): Folder for the results. Annotated transcripts go to "annotated/"; with
+            keep_intermediate, raw and de-identified transcripts also go to "transcripts/" and "deidentified/".
+        client: The OpenAI API client instance.
+        model_name (str): Whisper model to use (default: "base").
+        language (str): Language code for the transcription (default: "en").
+        openai_chat_model (str): The chat model for de-identification and annotation (default: "gpt-4").
+        deidentify_name (bool): Whether to de-identify names (default: True).
+        deidentify_location (bool): Whether to de-identify locations (default: False).
+        deidentify_date (bool): Whether to de-identify dates (default: False).
+        transcribe_workers (int): Whisper workers; more than one starts a process pool (default: 1).
+        threads_per_worker (int, optional): Intra-op threads per Whisper worker.
+        deidentify_workers (int): Threads de-identifying transcripts at the same time (default: 4).
+        annotate_workers (int): Threads annotating transcripts at the same time (default: 4).
+        queue_size (int): Capacity of each queue between stages (default: 4).
+        keep_intermediate (bool): Also write the raw and de-identified transcripts to disk (default: False;
+            they are handed from stage to stage in memory).
+        dispatcher (LLMDispatcher, optional): Shared concurrency limit and backoff for all API calls.
+        cache (ResponseCache or str, optional): Response cache for the API calls.
+        max_tokens (int): The size of each batch sent to the model (default: 1000).
+        count_tokens (callable, optional): Maps a text to its size. Defaults to counting words.
+        resume (bool): Skip recordings already completed with the same parameters (default: True).
+        prefilter (EntityPrefilter, optional): Local candidate detector that skips de-identification calls
+            for batches without new candidate entities.
+        annotation_mode (str): "rewrite" or "labels", see speaker_annotation.annotate_transcript (default: "rewrite").
+            In labels mode the speaker turns are also saved as JSON next to each annotated transcript.
+        mapping_store (MappingStore or str, optional): Where each recording's de-identification mappings are
+            saved, keyed by its transcript name, so the output can be audited or re-identified (default: an
+            unencrypted store beside the output folder, see default_mapping_store_path). It holds the original
+            entities: pass a MappingStore opened with a key to encrypt them. A warning is printed otherwise.
+
+    Returns:
+        dict: "completed" maps each finished recording to its end-to-end latency in seconds, and
+            "failures" maps each failed recording to the stage and error.
+    """
+    annotated_folder = os.path.join(output_folder, "annotated")
+    transcripts_folder = os.path.join(output_folder, "transcripts")
+    deidentified_folder = os.path.join(output_folder, "deidentified")
+    os.makedirs(annotated_folder, exist_ok=True)
+    if keep_intermediate:
+        os.makedirs(transcripts_folder, exist_ok=True)
+        os.makedirs(deidentified_folder, exist_ok=True)
+
+    client = with_cache(client, cache)
+    if mapping_store is None:
+        mapping_store = default_mapping_store_path(output_folder)
+    if isinstance(mapping_store, str):
+        mapping_store = MappingStore(mapping_store)
+    if mapping_store.fernet is None:
+        print(
+            f"Warning: the mapping store {mapping_store.path} holds the original entities unencrypted; "
+            "open it with a key (--mapping-key-env) and keep it apart from the shared results."
+        )
+
+    # Collect the recordings, skipping the ones finished by an earlier run with the same parameters
+    file_paths = sorted(
+        (os.path.join(input_folder, filename) for filename in os.listdir(input_folder)
+         if filename.lower().endswith(AUDIO_EXTENSIONS)),
+        key=os.path.getsize,
+        reverse=True
+    )
+    manifest = StageManifest(output_folder, "pipeline")
+    params = {
+        "model_name": model_name,
+        "language": language,
+        "openai_chat_model": openai_chat_model,
+        "deidentify_name": deidentify_name,
+        "deidentify_location": deidentify_location,
+        "deidentify_date": deidentify_date,
+        "max_tokens": max_tokens,
+        "tokenizer": tokenizer_name(count_tokens),
+    }
+    if prefilter is not None:
+        params["prefilter"] = prefilter.fingerprint()
+    if annotation_mode != "rewrite":
+        params["annotation_mode"] = annotation_mode
+    params_hash = params_fingerprint(params)
+    input_hashes = {file_path: file_sha256(file_path) for file_path in file_paths}
+    if resume:
+        file_paths = [
+            file_path for file_path in file_paths
+            if not manifest.is_complete(os.path.basename(file_path), input_hashes[file_path], params_hash)
+        ]
+
+    failures = {}
+    completed = {}
+    generations = {}
+    transcribed = queue.Queue(maxsize=queue_size)
+    deidentified = queue.Queue(maxsize=queue_size)
+    start = time.monotonic()
+
+    def deidentify(file_path, transcript):
+        name = transcript_filename(os.path.basename(file_path))
+        if keep_intermediate:
+            atomic_write(os.path.join(transcripts_folder, name), transcript)
+        text, *mappings = deidentify_text(
+            transcript,
+            deidentify_name=deidentify_name,
+            deidentify_location=deidentify_location,
+            deidentify_date=deidentify_date,
+            model=openai_chat_model,
+            client=client,
+            dispatcher=dispatcher,
+            max_tokens=max_tokens,
+            count_tokens=count_tokens,
+            file_name=name,
+            prefilter=prefilter
+        )
+        # The mappings become the recording's current ones once its annotated transcript is written
+        generation = mapping_store.begin_file(name)
+        for category, mapping in zip(ENTITY_CATEGORIES, mappings):
+            mapping_store.add(name, generation, category, mapping)
+        generations[file_path] = generation
+        if keep_intermediate:
+            atomic_write(os.path.join(deidentified_folder, name), text)
+        return text
+
+    def annotate(file_path, text):
+        name = transcript_filename(os.path.basename(file_path))
+        output_path = os.path.join(annotated_folder, name)
+        annotated, turns = annotate_transcript(
+            text, client, openai_chat_model, max_tokens=max_tokens, count_tokens=count_tokens,
+            mode=annotation_mode, return_turns=True
+        )
+        if annotation_mode == "labels":
+            atomic_write(os.path.join(annotated_folder, turns_filename(name)), json.dumps(turns))
+        atomic_write(output_path, annotated)
+        mapping_store.complete_file(name, generations.pop(file_path))
+        manifest.record(os.path.basename(file_path), input_hashes[file_path], params_hash, output_path)
+        completed[os.path.basename(file_path)] = time.monotonic() - start
+        print(f"Completed {os.path.basename(file_path)} after {completed[os.path.basename(file_path)]:.1f}s")
+        return output_path
+
+    # Start the downstream stages first so they are waiting when the first transcript arrives
+    deidentify_threads = _start_stage("deidentify", deidentify_workers, transcribed, deidentified, deidentify, failures)
+    annotate_threads = _start_stage("annotate", annotate_workers, deidentified, None, annotate, failures)
+
+    try:
+        _transcription_stage(
+            file_paths, transcribed, model_name, language, transcribe_workers, threads_per_worker, failures
+        )
+    finally:
+        # Shut the stages down in order once their input is exhausted, also when transcription raised,
+        # so the downstream workers finish what they hold instead of waiting on their queues forever
+        _stop_stage(deidentify_threads, transcribed)
+        _stop_stage(annotate_threads, deidentified)
+
+    print(f"Pipeline finished: {len(completed)} recording(s) completed, {len(failures)} failed.")
+    return {"completed": completed, "failures": failures}
+
+#################################### Command Line ########################################
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Transcribe, de-identify and annotate a folder of clinic recordings in one streaming run."
+    )
+    parser.add_argument("input_folder", help="Folder containing the audio recordings.")
+    parser.add_argument("output_folder", help="Folder for the results.")
+    parser.add_argument("--whisper-model", default="base", help="Whisper model (default: base).")
+    parser.add_argument("--language", default="en", help="Language code for transcription (default: en).")
+    parser.add_argument("--chat-model", default="gpt-4", help="Chat model for the LLM stages (default: gpt-4).")
+    parser.add_argument("--no-names", action="store_true", help="Do not de-identify names.")
+    parser.add_argument("--locations", action="store_true", help="De-identify locations.")
+    parser.add_argument("--dates", action="store_true", help="De-identify dates.")
+    parser.add_argument("--transcribe-workers", type=int, default=1, help="Whisper worker processes (default: 1).")
+    parser.add_argument("--threads-per-worker", type=int, default=None, help="Intra-op threads per Whisper worker.")
+    parser.add_argument("--deidentify-workers", type=int, default=4, help="De-identification threads (default: 4).")
+    parser.add_argument("--annotate-workers", type=int, default=4, help="Annotation threads (default: 4).")
+    parser.add_argument("--queue-size", type=int, default=4, help="Capacity of the queues between stages (default: 4).")
+    parser.add_argument("--max-concurrency", type=int, default=8, help="Maximum API calls in flight (default: 8).")
+    parser.add_argument("--tokens-per-minute", type=int, default=None, help="API token budget per minute.")
+    parser.add_argument("--cache", default=None,
+                        help="Path of a response cache file. It holds transcript content; see --cache-key-env.")
+    parser.add_argument("--cache-key-env", default=None,
+                        help="Environment variable holding a Fernet key to encrypt the response cache with.")
+    parser.add_argument("--max-tokens", type=int, default=1000, help="Batch size sent to the model (default: 1000).")
+    parser.add_argument("--keep-intermediate", action="store_true", help="Also write raw and de-identified transcripts.")
+    parser.add_argument("--no-resume", action="store_true", help="Redo recordings finished by an earlier run.")
+    parser.add_argument("--prefilter", nargs="*", default=None, choices=["names", "locations", "dates"],
+                        help="Skip de-identification calls for batches without candidate entities of these categories "
+                             "(default when given without categories: locations dates).")
+    parser.add_argument("--gazetteer", default=None, help="Place names for the location pre-detector (one per line).")
+    parser.add_argument("--mapping-store", default=None,
+                        help="Path of the de-identification mapping store, which holds the original entities "
+                             "(default: <output folder>_entity_mappings.sqlite, beside the output folder).")
+    parser.add_argument("--mapping-key-env", default=None,
+                        help="Environment variable holding a Fernet key to encrypt the mapping store with.")
+    parser.add_argument("--annotation-mode", default="rewrite", choices=["rewrite", "labels"],
+                        help="Have the model rewrite each batch with speaker labels, or return only the speaker "
+                             "turns of numbered sentences, which generates far fewer tokens (default: rewrite).")
+    args = parser.parse_args(argv)
+
+    from openai import OpenAI
+    from llm_dispatch import LLMDispatcher
+    from entity_prefilter import EntityPrefilter, load_gazetteer
+
+    prefilter = None
+    if args.prefilter is not None:
+        prefilter = EntityPrefilter(
+            categories=args.prefilter or ("locations", "dates"),
+            gazetteer=load_gazetteer(args.gazetteer) if args.gazetteer else None
+        )
+
+    cache = args.cache
+    if cache and args.cache_key_env:
+        cache = ResponseCache(cache, key=os.environ[args.cache_key_env])
+    mapping_store = args.mapping_store
+    if args.mapping_key_env:
+        mapping_store = MappingStore(
+            mapping_store or default_mapping_store_path(args.output_folder),
+            key=os.environ[args.mapping_key_env]
+        )
+
+    result = run_pipeline(
+        args.input_folder,
+        args.output_folder,
+        OpenAI(),
+        model_name=args.whisper_model,
+        language=args.language,
+        openai_chat_model=args.chat_model,
+        deidentify_name=not args.no_names,
+        deidentify_location=args.locations,
+        deidentify_date=args.dates,
+        transcribe_workers=args.transcribe_workers,
+        threads_per_worker=args.threads_per_worker,
+        deidentify_workers=args.deidentify_workers,
+        annotate_workers=args.annotate_workers,
+        queue_size=args.queue_size,
+        keep_intermediate=args.keep_intermediate,
+        dispatcher=LLMDispatcher(max_concurrency=args.max_concurrency, tokens_per_minute=args.tokens_per_minute),
+        cache=cache,
+        max_tokens=args.max_tokens,
+        resume=not args.no_resume,
+        prefilter=prefilter,
+        annotation_mode=args.annotation_mode,
+        mapping_store=mapping_store
+    )
+    if prefilter is not None:
+        summary = prefilter.summary()
+        print(
+            f"Pre-detector avoided {summary['calls_avoided']} of {summary['batches']} de-identification call(s) "
+            f"and {summary['categories_avoided']} category lookup(s)."
+        )
+    for filename, error in sorted(result["failures"].items()):
+        print(f"Failed: {filename}: {error}")
+    return 1 if result["failures"] else 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
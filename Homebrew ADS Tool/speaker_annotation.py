@@ -1,36 +1,28 @@
 import re
 import os
-from nltk.tokenize import sent_tokenize
-
-########################################## Truncate Text ###############################################
-def truncate_transcript(text, max_words=1000):
-    sentences = sent_tokenize(text)
-    current_count = 0
-    batch = []
-    batches = []
-    for sentence in sentences:
-        sentence_words = sentence.split()
-        sentence_length = len(sentence_words)
-        # If adding this sentence exceeds the limit, store the current batch and start a new one
-        if current_count + sentence_length > max_words:
-            if batch:
-                batches.append(' '.join(batch))
-                batch = []
-                current_count = 0
-        batch.extend(sentence_words)
-        current_count += sentence_length
-    # Add the last batch if there's any remaining
-    if batch:
-        batches.append(' '.join(batch))
-    return batches
+import json
+from chunking import truncate_transcript, sentence_spans
+from llm_cache import with_cache
+from manifest import StageManifest, atomic_write, file_sha256, params_fingerprint, tokenizer_name
+from telemetry import instrument, track
 
 ########################################## Main Function ###############################################
-def annotate_speaker_roles(transcript_batch, client,openai_chat_model):
+def annotation_request(transcript_batch, openai_chat_model="gpt-4"):
+    """
+    Build the chat completion request that asks the model to annotate the speaker roles of a batch.
+
+    Args:
+        transcript_batch (str): The transcript text to annotate.
+        openai_chat_model (str): The model name to be used for OpenAI chat completion.
+
+    Returns:
+        dict: The keyword arguments for client.chat.completions.create.
+    """
     additional_instructions = """
     Below is a transcript of a conversation between a doctor and a patient. Try to separate the sentences and annotate the roles of the speakers, either doctor or patient:
     """
     user_content = additional_instructions + '\n\n' + transcript_batch
-    chat_completion = client.chat.completions.create(
+    return dict(
         model=openai_chat_model,  # specify the correct model here
         messages=[
             {
@@ -43,10 +35,204 @@ def annotate_speaker_roles(transcript_batch, client,openai_chat_model):
             }
         ]
     )
+
+def annotate_speaker_roles(transcript_batch, client,openai_chat_model):
+    chat_completion = client.chat.completions.create(**annotation_request(transcript_batch, openai_chat_model))
     # Extract the response content
     return chat_completion.choices[0].message.content
 
-def process_transcripts(input_folder, output_folder, client, openai_chat_model="gpt-4"):
+########################################## Label-Only Annotation ###############################################
+SPEAKERS = {"D": "Doctor", "P": "Patient"}
+TURN_PATTERN = re.compile(r"^\s*\**\s*(doctor|patient)\s*\**\s*:\s*(.*)$", re.IGNORECASE)
+
+def label_request(sentences, openai_chat_model="gpt-4", previous_speaker=None):
+    """
+    Build the chat completion request that asks the model for the speaker turns of numbered sentences,
+    instead of a rewritten transcript. The reply lists only where each turn starts, so its length grows
+    with the number of turns rather than the length of the text.
+
+    Args:
+        sentences (list of str): The sentences of the batch, numbered from 1 in the prompt.
+        openai_chat_model (str): The model name to be used for OpenAI chat completion.
+        previous_speaker (str, optional): "Doctor" or "Patient", whoever spoke last in the previous batch.
+
+    Returns:
+        dict: The keyword arguments for client.chat.completions.create.
+    """
+    context = ""
+    if previous_speaker is not None:
+        context = f"The previous part of the conversation ended with the {previous_speaker.lower()} speaking. "
+    instructions = f"""
+    Below are the numbered sentences of a transcript of a conversation between a doctor and a patient. {context}Decide who says each sentence. Return only a JSON object that maps the number of the first sentence of each speaker turn to its speaker, "D" for the doctor or "P" for the patient, for example {{"1": "D", "3": "P", "4": "D"}}. A turn lasts until the next listed sentence.
+    """
+    numbered = "\n".join(f"{index}. {sentence}" for index, sentence in enumerate(sentences, start=1))
+    return dict(
+        model=openai_chat_model,
+        messages=[
+            {
+                "role": "system",
+                "content": "You are an AI assistant tasked with labeling the speakers of numbered transcript sentences. You always answer in JSON."
+            },
+            {
+                "role": "user",
+                "content": instructions + '\n\n' + numbered
+            }
+        ]
+    )
+
+def parse_turn_labels(response, count, previous_speaker=None):
+    """
+    Turn a label response into one speaker per sentence.
+
+    Args:
+        response (str): The raw model response, e.g. '{"1": "D", "3": "P"}'.
+        count (int): The number of sentences in the batch.
+        previous_speaker (str, optional): Speaker of any sentences before the first listed one.
+
+    Returns:
+        list of str: "Doctor" or "Patient" for each sentence.
+
+    Raises:
+        ValueError: If the response is not a JSON object of sentence numbers in range to "D"/"P" (or
+            "doctor"/"patient"), or leaves the first sentences without a speaker.
+    """
+    start, end = response.find("{"), response.rfind("}")
+    if start == -1 or end <= start:
+        raise ValueError("Response does not contain a JSON object")
+    data = json.loads(response[start:end + 1])
+    if not isinstance(data, dict):
+        raise ValueError("Response JSON is not an object")
+    starts = {}
+    for key, value in data.items():
+        index = int(key)
+        speaker = SPEAKERS.get(str(value).strip().upper()[:1])
+        if not 1 <= index <= count or speaker is None:
+            raise ValueError(f"Invalid turn {key!r}: {value!r}")
+        starts[index] = speaker
+    if 1 not in starts and previous_speaker is None:
+        raise ValueError("The first sentence has no speaker")
+    speakers = []
+    current = previous_speaker
+    for index in range(1, count + 1):
+        current = starts.get(index, current)
+        speakers.append(current)
+    return speakers
+
+def parse_annotated_text(text):
+    """
+    Read the turns of a rewritten transcript ("Doctor: ..." / "Patient: ..." lines), as returned in
+    rewrite mode. Lines without a label continue the previous turn.
+
+    Returns:
+        list of dict: Turns with "speaker" ("Doctor", "Patient" or None) and "text".
+    """
+    turns = []
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        match = TURN_PATTERN.match(line)
+        if match:
+            turns.append({"speaker": match.group(1).capitalize(), "text": match.group(2).strip()})
+        elif turns:
+            turns[-1]["text"] += " " + line.strip()
+        else:
+            turns.append({"speaker": None, "text": line.strip()})
+    return turns
+
+def label_speaker_turns(transcript_batch, client, openai_chat_model="gpt-4", previous_speaker=None):
+    """
+    Annotate a batch by asking only for its speaker turns, and rebuild the turns locally. Falls back to
+    the rewrite prompt (annotate_speaker_roles) if the labels do not validate.
+
+    Args:
+        transcript_batch (str): The transcript text to annotate.
+        client: OpenAI client object to interact with OpenAI's chat models.
+        openai_chat_model (str): The model name to be used for OpenAI chat completion.
+        previous_speaker (str, optional): Who spoke last in the previous batch, for consistency across batches.
+
+    Returns:
+        tuple: The batch's turns (list of dict with "speaker" and "text"), and whether the fallback was used.
+    """
+    sentences = [transcript_batch[start:end] for start, end in sentence_spans(transcript_batch)]
+    if not sentences:
+        return [], False
+    chat_completion = client.chat.completions.create(
+        **label_request(sentences, openai_chat_model, previous_speaker=previous_speaker)
+    )
+    response = chat_completion.choices[0].message.content
+    try:
+        speakers = parse_turn_labels(response, len(sentences), previous_speaker=previous_speaker)
+    except ValueError:
+        # The compact labels did not validate; have the model rewrite the batch as before
+        return parse_annotated_text(annotate_speaker_roles(transcript_batch, client, openai_chat_model)), True
+    turns = []
+    for speaker, sentence in zip(speakers, sentences):
+        if turns and turns[-1]["speaker"] == speaker:
+            turns[-1]["text"] += " " + sentence
+        else:
+            turns.append({"speaker": speaker, "text": sentence})
+    return turns, False
+
+def format_turns(turns):
+    """
+    Write turns as an annotated transcript, one "Doctor: ..." or "Patient: ..." line per turn.
+    """
+    return "\n".join(f"{turn['speaker']}: {turn['text']}" if turn["speaker"] else turn["text"] for turn in turns)
+
+def annotate_transcript(transcript, client, openai_chat_model="gpt-4", max_tokens=1000, count_tokens=None, record=None,
+                        mode="rewrite", return_turns=False):
+    """
+    Annotate the speaker roles of a transcript held in memory.
+
+    Args:
+        transcript (str): The transcript text.
+        client: OpenAI client object to interact with OpenAI's chat models.
+        openai_chat_model (str): The model name to be used for OpenAI chat completion.
+        max_tokens (int): The size of each batch sent to the model, measured with count_tokens (default: 1000).
+        count_tokens (callable, optional): Maps a text to its size. Defaults to counting words.
+        record (StageRecord, optional): Telemetry record that the chunk count is added to.
+        mode (str): "rewrite" has the model rewrite every batch with speaker labels (the default). "labels"
+            sends numbered sentences and asks only for where each speaker turn starts, rebuilding the text
+            locally, so far fewer tokens are generated; the batches are then annotated in order, each
+            told who spoke last in the previous one.
+        return_turns (bool): Also return the structured turns (default: False).
+
+    Returns:
+        str: The annotated transcript, or a tuple of it and the list of turns ({"speaker", "text"}) if
+            return_turns is True. In rewrite mode the turns are read back from the model's text.
+    """
+    transcript_batches = truncate_transcript(transcript, max_words=max_tokens, count_tokens=count_tokens)
+    if record is not None:
+        record.add(chunks=len(transcript_batches))
+    if mode == "labels":
+        turns = []
+        for batch in transcript_batches:
+            previous_speaker = turns[-1]["speaker"] if turns else None
+            batch_turns, _ = label_speaker_turns(batch, client, openai_chat_model, previous_speaker=previous_speaker)
+            # A turn that carries on across the batch boundary stays one turn
+            if turns and batch_turns and batch_turns[0]["speaker"] == previous_speaker and previous_speaker:
+                turns[-1]["text"] += " " + batch_turns.pop(0)["text"]
+            turns.extend(batch_turns)
+        annotated = format_turns(turns)
+        return (annotated, turns) if return_turns else annotated
+    if mode != "rewrite":
+        raise ValueError(f"Unknown annotation mode: {mode}")
+    annotated_batches = [
+        annotate_speaker_roles(batch, client, openai_chat_model)
+        for batch in transcript_batches
+    ]
+    # Combine the annotated batches into a single annotated transcript
+    annotated = "\n".join(annotated_batches)
+    return (annotated, parse_annotated_text(annotated)) if return_turns else annotated
+
+def turns_filename(filename):
+    """
+    Name of the JSON turn list saved next to an annotated transcript, e.g. "visit1.txt" -> "visit1.turns.json".
+    """
+    return os.path.splitext(filename)[0] + ".turns.json"
+
+def process_transcripts(input_folder, output_folder, client, openai_chat_model="gpt-4", cache=None,
+                        max_tokens=1000, count_tokens=None, resume=True, telemetry=None, mode="rewrite"):
     """
     Process all transcript files in the input folder to annotate speaker roles and save the results
     in the output folder.
@@ -56,6 +242,16 @@ def process_transcripts(input_folder, output_folder, client, openai_chat_model="
         output_folder (str): Path to the folder where annotated files will be saved.
         client: OpenAI client object to interact with OpenAI's chat models.
         openai_chat_model (str): The model name to be used for OpenAI chat completion.
+        cache (ResponseCache or str, optional): Serve repeated API requests from a local response cache
+            (or the path of a cache file), so unchanged batches are not sent again on reruns.
+        max_tokens (int): The size of each batch sent to the model, measured with count_tokens (default: 1000).
+        count_tokens (callable, optional): Maps a text to its size, e.g. chunking.tiktoken_counter(model).
+            Defaults to counting words.
+        resume (bool): Skip files whose content and parameters match a finished entry in the output folder's
+            manifest, so an interrupted or repeated run only processes what is left (default: True).
+        telemetry (Telemetry, optional): Records wall time, API time, tokens and chunk counts per file.
+        mode (str): "rewrite" (the default) or "labels", see annotate_transcript. In labels mode the turns are
+            also saved as a JSON list next to each annotated file (see turns_filename).
 
     Returns:
         None: Annotated files are saved to the output folder.
@@ -63,28 +259,48 @@ def process_transcripts(input_folder, output_folder, client, openai_chat_model="
     # Ensure output folder exists
     os.makedirs(output_folder, exist_ok=True)
 
+    # Answer repeated requests from the response cache, if one is given
+    client = with_cache(client, cache)
+
+    # Record finished files so reruns with the same inputs and parameters can skip them
+    manifest = StageManifest(output_folder, "annotate")
+    params = {
+        "model": openai_chat_model,
+        "max_tokens": max_tokens,
+        "tokenizer": tokenizer_name(count_tokens),
+    }
+    if mode != "rewrite":
+        params["mode"] = mode
+    params_hash = params_fingerprint(params)
+
     # Process each file in the input folder
     for filename in os.listdir(input_folder):
         if filename.endswith(".txt"):  # Assuming transcripts are stored as .txt files
             input_path = os.path.join(input_folder, filename)
             output_path = os.path.join(output_folder, filename)
 
-            # Read the transcript file
-            with open(input_path, 'r') as file:
-                transcript = file.read()
+            with track(telemetry, "annotate", filename) as record:
+                input_hash = file_sha256(input_path)
+                if resume and manifest.is_complete(filename, input_hash, params_hash):
+                    print(f"Skipping {filename}: already annotated with the same parameters")
+                    if record is not None:
+                        record.status = "skipped"
+                    continue
 
-            # Process the transcript using the helper functions
-            transcript_batches = truncate_transcript(transcript, max_words=1000)
-            annotated_batches = [
-                annotate_speaker_roles(batch, client, openai_chat_model)
-                for batch in transcript_batches
-            ]
+                # Read the transcript file
+                with open(input_path, 'r') as file:
+                    transcript = file.read()
 
-            # Combine the annotated batches into a single annotated transcript
-            annotated_transcript = "\n".join(annotated_batches)
+                # Process the transcript using the helper functions
+                annotated_transcript, turns = annotate_transcript(
+                    transcript, instrument(client, record), openai_chat_model,
+                    max_tokens=max_tokens, count_tokens=count_tokens, record=record, mode=mode, return_turns=True
+                )
 
-            # Save the annotated transcript to the output folder
-            with open(output_path, 'w') as file:
-                file.write(annotated_transcript)
+                # Save the annotated transcript to the output folder (atomically, so a crash never leaves a partial file)
+                if mode == "labels":
+                    atomic_write(os.path.join(output_folder, turns_filename(filename)), json.dumps(turns))
+                atomic_write(output_path, annotated_transcript)
+                manifest.record(filename, input_hash, params_hash, output_path)
 
             print(f"Processed and saved: {filename}")
@@ -0,0 +1,137 @@
+import os
+import json
+import random
+import argparse
+
+# Vocabulary shared with fake_llm.py, which "finds" exactly these entities in the text
+FIRST_NAMES = [
+    "Ann", "Bob", "Carol", "David", "Elena", "Farid", "Grace", "Hiro", "Ines", "Jamal",
+    "Keisha", "Liam", "Maria", "Nikhil", "Olga", "Pedro", "Quinn", "Rosa", "Samir", "Tessa",
+]
+LAST_NAMES = [
+    "Lee", "Smith", "Garcia", "Nguyen", "Okafor", "Patel", "Rossi", "Kim", "Novak", "Haddad",
+    "Brown", "Cohen", "Dubois", "Evans", "Fischer", "Gupta", "Hansen", "Ito", "Jones", "Khan",
+]
+LOCATIONS = [
+    "Boston", "Springfield", "Main Street", "Oak Avenue", "Riverside Clinic", "St. Mary's Hospital",
+    "Cedar Lane", "Lakeview", "Maple Drive", "Northgate Pharmacy", "Elm Street", "Westfield",
+]
+MONTHS = [
+    "January", "February", "March", "April", "May", "June",
+    "July", "August", "September", "October", "November", "December",
+]
+
+DOCTOR_LINES = [
+    "How have you been feeling since the last visit?",
+    "Any chest pain or shortness of breath?",
+    "Let's go over your medications.",
+    "I would like to order some blood work.",
+    "Are you taking the lisinopril every morning?",
+    "Your blood pressure looks a little high today.",
+    "Have you noticed any swelling in your ankles?",
+    "We can adjust the dose if the side effects continue.",
+    "I'll send a referral to {name} at {location}.",
+    "Please come back on {date} so we can recheck the labs.",
+]
+PATIENT_LINES = [
+    "Mostly okay, but I get tired in the afternoons.",
+    "No chest pain, just some headaches.",
+    "I ran out of the pills about a week ago.",
+    "My daughter {name} drives me to appointments.",
+    "I moved to {location} last month.",
+    "The pain started around {date}.",
+    "Sometimes I forget the evening dose.",
+    "I have been sleeping badly and my back hurts.",
+    "I saw {name} at {location} for the knee.",
+    "Yes, I still walk every day.",
+]
+
+#################################### Entities ########################################
+def random_name(rng):
+    return f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}"
+
+def random_date(rng):
+    if rng.random() < 0.5:
+        return f"{rng.choice(MONTHS)} {rng.randint(1, 28)}"
+    return f"{rng.randint(1, 12)}/{rng.randint(1, 28)}/{rng.randint(2015, 2024)}"
+
+#################################### Generator ########################################
+def generate_transcript(rng, turns=40, entity_density=0.3, speaker_labels=False):
+    """
+    Generate a synthetic doctor-patient conversation with known names, locations and dates.
+
+    Parameters:
+    - rng (random.Random): The random generator to draw from.
+    - turns (int): Number of speaker turns (default: 40).
+    - entity_density (float): Probability that a turn mentions entities (default: 0.3).
+    - speaker_labels (bool): Prefix each turn with "Doctor:" or "Patient:" (default: False, like raw Whisper output).
+
+    Returns:
+    - tuple: The transcript text and a dict of the "names", "locations" and "dates" it contains.
+    """
+    entities = {"names": set(), "locations": set(), "dates": set()}
+    lines = []
+    for turn in range(turns):
+        speaker = "Doctor" if turn % 2 == 0 else "Patient"
+        pool = DOCTOR_LINES if speaker == "Doctor" else PATIENT_LINES
+        sentences = []
+        for _ in range(rng.randint(1, 3)):
+            # Templates with placeholders are only used when the turn should mention entities
+            if rng.random() < entity_density:
+                template = rng.choice([line for line in pool if "{" in line])
+            else:
+                template = rng.choice([line for line in pool if "{" not in line])
+            values = {"name": random_name(rng), "location": rng.choice(LOCATIONS), "date": random_date(rng)}
+            for key, category in (("name", "names"), ("location", "locations"), ("date", "dates")):
+                if "{" + key + "}" in template:
+                    entities[category].add(values[key])
+            sentences.append(template.format(**values))
+        text = " ".join(sentences)
+        lines.append(f"{speaker}: {text}" if speaker_labels else text)
+    return " ".join(lines), {category: sorted(values) for category, values in entities.items()}
+
+def generate_corpus(output_folder, count=20, seed=0, turns=(20, 80), entity_density=0.3, speaker_labels=False):
+    """
+    Write a folder of synthetic transcripts plus a labels.jsonl file with the entities in each one.
+
+    Parameters:
+    - output_folder (str): Folder to write the transcripts to.
+    - count (int): Number of transcripts (default: 20).
+    - seed (int): Seed, so the same corpus can be regenerated (default: 0).
+    - turns (tuple of int): Minimum and maximum number of speaker turns per transcript (default: (20, 80)).
+    - entity_density (float): Probability that a turn mentions entities (default: 0.3).
+    - speaker_labels (bool): Prefix each turn with its speaker (default: False).
+
+    Returns:
+    - list of str: Paths of the generated transcripts.
+    """
+    os.makedirs(output_folder, exist_ok=True)
+    rng = random.Random(seed)
+    paths = []
+    with open(os.path.join(output_folder, "labels.jsonl"), "w", encoding="utf-8") as labels:
+        for index in range(count):
+            text, entities = generate_transcript(
+                rng, turns=rng.randint(*turns), entity_density=entity_density, speaker_labels=speaker_labels
+            )
+            file_name = f"synthetic_{index:05d}.txt"
+            path = os.path.join(output_folder, file_name)
+            with open(path, "w", encoding="utf-8") as file:
+                file.write(text)
+            labels.write(json.dumps({"file": file_name, **entities}) + "\n")
+            paths.append(path)
+    return paths
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic clinic transcripts with known entities.")
+    parser.add_argument("output_folder")
+    parser.add_argument("--count", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--min-turns", type=int, default=20)
+    parser.add_argument("--max-turns", type=int, default=80)
+    parser.add_argument("--entity-density", type=float, default=0.3)
+    parser.add_argument("--speaker-labels", action="store_true")
+    args = parser.parse_args()
+    generate_corpus(
+        args.output_folder, count=args.count, seed=args.seed, turns=(args.min_turns, args.max_turns),
+        entity_density=args.entity_density, speaker_labels=args.speaker_labels
+    )
@@ -0,0 +1,261 @@
+import csv
+import json
+import time
+import hashlib
+import threading
+import contextlib
+from types import SimpleNamespace
+
+# Counters kept for every file and stage; all of them are sums, so they aggregate by addition
+COUNTERS = [
+    "wall_seconds",
+    "api_seconds",
+    "api_calls",
+    "cached_calls",
+    "errors",
+    "retries",
+    "prompt_tokens",
+    "completion_tokens",
+    "chunks",
+    "audio_seconds",
+    "processing_seconds",
+]
+
+#################################### Records ########################################
+class StageRecord:
+    """
+    Timings and usage of one file in one stage. Updated from several threads when the stage's API calls
+    run through a dispatcher, so every update goes through add().
+
+    Only counts, timings and an opaque file id are kept: no transcript text, entities or mappings.
+    """
+    def __init__(self, stage, file_id):
+        self.stage = stage
+        self.file_id = file_id
+        self.status = "ok"
+        self.error = None
+        self.lock = threading.Lock()
+        for counter in COUNTERS:
+            setattr(self, counter, 0)
+
+    def add(self, **counts):
+        with self.lock:
+            for counter, value in counts.items():
+                setattr(self, counter, getattr(self, counter) + value)
+
+    def to_dict(self):
+        record = {"stage": self.stage, "file_id": self.file_id, "status": self.status, "error": self.error}
+        record.update({counter: getattr(self, counter) for counter in COUNTERS})
+        record["real_time_factor"] = self.processing_seconds / self.audio_seconds if self.audio_seconds else None
+        return record
+
+class InstrumentedClient:
+    """
+    Wraps an OpenAI client (or a CachedClient) so that every client.chat.completions.create call adds its
+    duration, token usage and failures to a StageRecord. Every failed call counts as an error; the ones an
+    LLMDispatcher then retries also count as retries, through the on_retry hook attached to the error.
+    Every other attribute is passed through.
+
+    Parameters:
+    - client: The OpenAI API client instance to wrap.
+    - record (StageRecord): The record of the file being processed.
+    """
+    def __init__(self, client, record):
+        self.client = client
+        self.record = record
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = self.client.chat.completions.create(**kwargs)
+        except Exception as error:
+            self.record.add(api_seconds=time.perf_counter() - start, errors=1)
+            # Only the dispatcher knows whether the call is tried again; it calls this before backing off
+            error.on_retry = lambda: self.record.add(retries=1)
+            raise
+        elapsed = time.perf_counter() - start
+        if getattr(response, "from_cache", False):
+            self.record.add(api_seconds=elapsed, cached_calls=1)
+            return response
+        usage = getattr(response, "usage", None)
+        self.record.add(
+            api_seconds=elapsed,
+            api_calls=1,
+            prompt_tokens=getattr(usage, "prompt_tokens", 0) or 0,
+            completion_tokens=getattr(usage, "completion_tokens", 0) or 0
+        )
+        return response
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+#################################### Collector ########################################
+class Telemetry:
+    """
+    Collects a StageRecord per file and stage for transcribe_folder, deidentify_transcripts and
+    process_transcripts, and exports them as a JSON log and a Prometheus-text or CSV summary.
+
+    File names can themselves identify patients, so records carry a truncated SHA-256 of the file name
+    instead, unless include_file_names is set.
+
+    Parameters:
+    - log_path (str, optional): JSON Lines file that each record is appended to as soon as its file is done.
+    - include_file_names (bool): Emit file names instead of hashed file ids (default: False).
+    """
+    def __init__(self, log_path=None, include_file_names=False):
+        self.log_path = log_path
+        self.include_file_names = include_file_names
+        self.records = []
+        self.lock = threading.Lock()
+
+    def file_id(self, file_name):
+        if self.include_file_names:
+            return file_name
+        return hashlib.sha256(file_name.encode("utf-8")).hexdigest()[:16]
+
+    @contextlib.contextmanager
+    def track(self, stage, file_name):
+        """
+        Record one file's pass through a stage. The wall time covers the body of the with block; an exception
+        marks the record as failed (keeping only the error type) and is re-raised.
+
+        Parameters:
+        - stage (str): The stage name, e.g. "transcribe", "deidentify" or "annotate".
+        - file_name (str): The input file name.
+
+        Yields:
+        - StageRecord: The record to add counts to, or to mark as "skipped".
+        """
+        record = StageRecord(stage, self.file_id(file_name))
+        start = time.perf_counter()
+        try:
+            yield record
+        except BaseException as error:
+            record.status = "failed"
+            record.error = type(error).__name__
+            raise
+        finally:
+            record.add(wall_seconds=time.perf_counter() - start)
+            self.add_record(record)
+
+    def record_file(self, stage, file_name, status="ok", error=None, **counts):
+        """
+        Add a record for work timed elsewhere, e.g. in a worker process that cannot share this object.
+
+        Parameters:
+        - stage (str): The stage name.
+        - file_name (str): The input file name.
+        - status (str): "ok", "skipped" or "failed" (default: "ok").
+        - error (str, optional): The error type of a failed file.
+        - **counts: Counter values, e.g. wall_seconds=12.5, audio_seconds=300.0.
+        """
+        record = StageRecord(stage, self.file_id(file_name))
+        record.status = status
+        record.error = error
+        record.add(**counts)
+        self.add_record(record)
+
+    def add_record(self, record):
+        with self.lock:
+            self.records.append(record)
+            if self.log_path is not None:
+                with open(self.log_path, "a", encoding="utf-8") as file:
+                    file.write(json.dumps({"timestamp": time.time(), **record.to_dict()}) + "\n")
+
+    #################################### Export ########################################
+    def summary(self):
+        """
+        Aggregate the records per stage.
+
+        Returns:
+        - dict: For each stage, the file counts per status, the summed counters, and the real-time factor
+          (processing seconds per audio second) where audio was processed.
+        """
+        stages = {}
+        with self.lock:
+            records = list(self.records)
+        for record in records:
+            stage = stages.setdefault(record.stage, {"files": {}, **{counter: 0 for counter in COUNTERS}})
+            stage["files"][record.status] = stage["files"].get(record.status, 0) + 1
+            for counter in COUNTERS:
+                stage[counter] += getattr(record, counter)
+        for stage in stages.values():
+            stage["real_time_factor"] = (
+                stage["processing_seconds"] / stage["audio_seconds"] if stage["audio_seconds"] else None
+            )
+        return stages
+
+    def write_json_log(self, path):
+        with self.lock:
+            records = [record.to_dict() for record in self.records]
+        with open(path, "w", encoding="utf-8") as file:
+            for record in records:
+                file.write(json.dumps(record) + "\n")
+
+    def write_prometheus(self, path):
+        lines = []
+        summary = self.summary()
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP ads_{name} {help_text}")
+            lines.append(f"# TYPE ads_{name} {kind}")
+            for labels, value in samples:
+                label_text = ",".join(f'{key}="{value}"' for key, value in labels.items())
+                lines.append(f"ads_{name}{{{label_text}}} {value}")
+
+        metric("files_total", "counter", "Files handled, by stage and status.", [
+            ({"stage": stage, "status": status}, count)
+            for stage, values in summary.items() for status, count in sorted(values["files"].items())
+        ])
+        for counter in COUNTERS:
+            metric(f"{counter}_total", "counter", f"Sum of {counter.replace('_', ' ')} over all files.", [
+                ({"stage": stage}, values[counter]) for stage, values in summary.items()
+            ])
+        metric("real_time_factor", "gauge", "Processing seconds per second of audio.", [
+            ({"stage": stage}, values["real_time_factor"])
+            for stage, values in summary.items() if values["real_time_factor"] is not None
+        ])
+        with open(path, "w", encoding="utf-8") as file:
+            file.write("\n".join(lines) + "\n")
+
+    def write_csv(self, path):
+        fields = ["stage", "files_ok", "files_skipped", "files_failed", *COUNTERS, "real_time_factor"]
+        with open(path, "w", encoding="utf-8", newline="") as file:
+            writer = csv.DictWriter(file, fieldnames=fields)
+            writer.writeheader()
+            for stage, values in self.summary().items():
+                writer.writerow({
+                    "stage": stage,
+                    "files_ok": values["files"].get("ok", 0),
+                    "files_skipped": values["files"].get("skipped", 0),
+                    "files_failed": values["files"].get("failed", 0),
+                    **{counter: values[counter] for counter in COUNTERS},
+                    "real_time_factor": values["real_time_factor"],
+                })
+
+    def write_summary(self, path):
+        """
+        Write the per-stage summary as CSV if the path ends in ".csv", otherwise as Prometheus text.
+        """
+        if path.lower().endswith(".csv"):
+            self.write_csv(path)
+        else:
+            self.write_prometheus(path)
+
+#################################### Helpers ########################################
+def track(telemetry, stage, file_name):
+    """
+    telemetry.track(stage, file_name), or a context yielding None when telemetry is off.
+    """
+    if telemetry is None:
+        return contextlib.nullcontext()
+    return telemetry.track(stage, file_name)
+
+def instrument(client, record):
+    """
+    Wrap a client so its calls are counted in record, or return it unchanged when record is None.
+    """
+    if record is None:
+        return client
+    return InstrumentedClient(client, record)
@@ -0,0 +1,31 @@
+import io
+import contextlib
+from openai import OpenAI
+from batch_api import bulk_deidentify_transcripts
+from deidentification import deidentify_transcripts
+from fake_llm import FakeOpenAIClient, fake_reply
+from local_batch_server import LocalBatchServer
+from synthetic_transcripts import generate_corpus
+
+def test_batch_mappings_match_the_online_path(tmp_path):
+    corpus_folder = str(tmp_path / "corpus")
+    generate_corpus(corpus_folder, count=3, seed=0, turns=(10, 30), entity_density=0.5)
+    options = {"deidentify_name": True, "deidentify_location": True, "deidentify_date": True, "max_tokens": 200}
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        online = deidentify_transcripts(
+            corpus_folder, str(tmp_path / "online"), client=FakeOpenAIClient(latency=("constant", 0.0)),
+            return_mapping=True, resume=False, **options
+        )
+        with LocalBatchServer(lambda body: fake_reply(body["messages"])) as server:
+            client = OpenAI(base_url=server.base_url, api_key="local")
+            # The stand-in server completes a job after one in-progress poll, so polling need not wait
+            batch = bulk_deidentify_transcripts(
+                corpus_folder, str(tmp_path / "batch"), str(tmp_path / "work"), client,
+                poll_interval=0, return_mapping=True, **options
+            )
+
+    assert set(batch) == set(online)
+    assert any(mapping for mappings in online.values() for mapping in mappings.values())
+    for key in online:
+        assert batch[key] == dict(online[key])
@@ -0,0 +1,21 @@
+import pytest
+from chunking import iter_chunks, iter_file_chunks
+
+def transcript_with_long_sentence(long_words=40):
+    short = [f"Sentence number {index} is short." for index in range(12)]
+    long = " ".join(f"word{index}" for index in range(long_words)) + "."
+    return " ".join(short[:6] + [long] + short[6:])
+
+@pytest.mark.parametrize("block_size", [64, 200, 1 << 16])
+def test_file_chunks_match_text_chunks_around_a_long_sentence(tmp_path, block_size):
+    # The long sentence is cut into two full pieces and a rest that shares a chunk with the next sentence;
+    # the smaller blocks end in the middle of it
+    text = transcript_with_long_sentence()
+    path = tmp_path / "transcript.txt"
+    path.write_text(text, encoding="utf-8")
+
+    chunks = list(iter_chunks(text, max_tokens=15))
+
+    assert list(iter_file_chunks(str(path), max_tokens=15, block_size=block_size)) == chunks
+    assert all(len(chunk.text.split()) <= 15 for chunk in chunks)
+    assert all(text[chunk.start:chunk.end] == chunk.text for chunk in chunks)
@@ -0,0 +1,15 @@
+from entity_prefilter import EntityPrefilter
+
+def test_candidate_overlapping_an_entity_of_another_category_goes_to_the_model():
+    prefilter = EntityPrefilter(known_entities={"names": {"Ann"}, "locations": {"Boston"}})
+    assert prefilter.resolve("Last year I moved to Ann Arbor for work.", "locations") == ("llm", None)
+
+def test_candidate_extending_a_known_entity_goes_to_the_model():
+    prefilter = EntityPrefilter(known_entities={"locations": {"Springfield"}})
+    assert prefilter.resolve("Now she lives in Springfield Heights with her son.", "locations") == ("llm", None)
+
+def test_candidate_within_a_known_entity_is_resolved_locally():
+    prefilter = EntityPrefilter(known_entities={"locations": {"Springfield"}})
+    assert prefilter.resolve("Now she lives in Springfield with her son.", "locations") == (
+        "resolved_locally", {"Springfield"}
+    )
@@ -0,0 +1,70 @@
+import os
+import io
+import contextlib
+import pytest
+from llm_dispatch import LLMDispatcher
+from fake_llm import FakeOpenAIClient, InternalServerError
+from synthetic_transcripts import generate_corpus
+from deidentification import deidentify_transcripts
+
+def no_sleep(seconds):
+    pass
+
+def run_deidentify(corpus_folder, output_folder, client, dispatcher=None, max_file_workers=1):
+    with contextlib.redirect_stdout(io.StringIO()):
+        mappings = deidentify_transcripts(
+            corpus_folder, output_folder, deidentify_name=True, deidentify_location=True, deidentify_date=True,
+            client=client, return_mapping=True, dispatcher=dispatcher, max_file_workers=max_file_workers,
+            max_tokens=200, resume=False
+        )
+    outputs = {}
+    for name in sorted(os.listdir(output_folder)):
+        if name.endswith(".txt"):
+            with open(os.path.join(output_folder, name), "r", encoding="utf-8") as file:
+                outputs[name] = file.read()
+    return outputs, mappings
+
+def test_concurrent_matches_serial_with_injected_failures(tmp_path):
+    corpus_folder = str(tmp_path / "corpus")
+    generate_corpus(corpus_folder, count=6, seed=0, turns=(20, 60), entity_density=0.5)
+
+    serial_client = FakeOpenAIClient(latency=("constant", 0.0), seed=0)
+    serial = run_deidentify(corpus_folder, str(tmp_path / "serial"), serial_client)
+
+    # Three in ten calls fail with a rate limit or server error; the dispatcher has to retry every one of them
+    concurrent_client = FakeOpenAIClient(latency=("constant", 0.0), error_rate=0.3, seed=0)
+    dispatcher = LLMDispatcher(max_concurrency=4, max_retries=10, sleep=no_sleep, seed=0)
+    concurrent = run_deidentify(
+        corpus_folder, str(tmp_path / "concurrent"), concurrent_client, dispatcher=dispatcher, max_file_workers=3
+    )
+
+    assert concurrent_client.errors > 0
+    assert concurrent_client.calls == serial_client.calls + concurrent_client.errors
+    assert concurrent == serial
+
+def test_retries_transient_errors_with_backoff():
+    failures = iter([InternalServerError("The server had an error", status_code=500)] * 2)
+    delays = []
+
+    def flaky(item):
+        error = next(failures, None)
+        if error is not None:
+            raise error
+        return item.upper()
+
+    dispatcher = LLMDispatcher(max_concurrency=1, base_delay=1.0, max_delay=4.0, sleep=delays.append, seed=0)
+    assert dispatcher.call(flaky, "ok") == "OK"
+    assert len(delays) == 2
+    assert all(0 <= delay <= 4.0 for delay in delays)
+
+def test_does_not_retry_other_errors():
+    calls = []
+
+    def broken(item):
+        calls.append(item)
+        raise ValueError("not transient")
+
+    dispatcher = LLMDispatcher(sleep=no_sleep)
+    with pytest.raises(ValueError):
+        dispatcher.map(broken, ["a"])
+    assert calls == ["a"]
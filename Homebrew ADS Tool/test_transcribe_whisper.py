@@ -0,0 +1,53 @@
+import os
+import json
+import numpy as np
+import transcribe_whisper
+from transcribe_whisper import transcribe_folder, transcript_filename, segments_filename
+from telemetry import Telemetry
+
+SAMPLE_RATE = 16000
+
+class FakeWhisperModel:
+    # Answers every segment with its length, so the transcript shows how the audio was split
+    def transcribe(self, audio, language="en", word_timestamps=False):
+        seconds = len(audio) / SAMPLE_RATE
+        text = f" [{seconds:.1f}s]"
+        segment = {"start": 0.0, "end": seconds, "text": text}
+        if word_timestamps:
+            segment["words"] = [{"word": text.strip(), "start": 0.0, "end": seconds, "probability": 1.0}]
+        return {"text": text, "segments": [segment]}
+
+def speech_with_pauses(bursts=3, speech_seconds=2.0, pause_seconds=1.0):
+    rng = np.random.default_rng(0)
+    parts = []
+    for _ in range(bursts):
+        parts.append(0.3 * rng.standard_normal(int(speech_seconds * SAMPLE_RATE)).astype(np.float32))
+        parts.append(np.zeros(int(pause_seconds * SAMPLE_RATE), dtype=np.float32))
+    return np.concatenate(parts)
+
+def test_segmented_transcription_with_telemetry(tmp_path, monkeypatch):
+    input_folder = tmp_path / "audio"
+    input_folder.mkdir()
+    (input_folder / "visit.wav").write_bytes(b"not decoded; load_audio is replaced")
+    output_folder = str(tmp_path / "transcripts")
+    audio = speech_with_pauses()
+    monkeypatch.setattr(transcribe_whisper.whisper, "load_audio", lambda path: audio)
+    monkeypatch.setattr(transcribe_whisper.whisper, "load_model", lambda name: FakeWhisperModel())
+
+    telemetry = Telemetry()
+    failures = transcribe_folder(
+        str(input_folder), output_folder=output_folder, telemetry=telemetry, segmented=True,
+        vad_options={"max_segment_seconds": 2.5}
+    )
+
+    assert failures == {}
+    with open(os.path.join(output_folder, transcript_filename("visit.wav")), "r", encoding="utf-8") as file:
+        transcript = file.read()
+    with open(os.path.join(output_folder, segments_filename("visit.wav")), "r", encoding="utf-8") as file:
+        segments = json.load(file)["segments"]
+    assert len(segments) > 1
+    assert transcript == "".join(segment["text"] for segment in segments)
+    summary = telemetry.summary()["transcribe"]
+    assert summary["files"] == {"ok": 1}
+    assert summary["chunks"] == len(segments)
+    assert summary["audio_seconds"] == len(audio) / SAMPLE_RATE
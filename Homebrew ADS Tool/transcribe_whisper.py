@@ -1,39 +1,481 @@
 import os
+import json
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
 import whisper
+from manifest import StageManifest, atomic_write, file_sha256, params_fingerprint
 
-def transcribe_folder(input_folder, model_name="base", language="en", output_folder="transcripts"):
+AUDIO_EXTENSIONS = ('.wav', '.mp3', '.m4a', '.flac', '.ogg')
+
+# Whisper model loaded once per worker process by _init_worker
+_worker_model = None
+
+def transcript_filename(filename):
+    """
+    Name of the transcript written for an audio file, e.g. "visit1.wav" -> "visit1_raw_transcript.txt".
+    """
+    return os.path.splitext(filename)[0] + "_raw_transcript.txt"
+
+def segments_filename(filename):
+    """
+    Name of the timestamp sidecar written next to a segmented transcript, e.g.
+    "visit1.wav" -> "visit1_raw_transcript.segments.json".
+    """
+    return os.path.splitext(filename)[0] + "_raw_transcript.segments.json"
+
+def transcribe_audio(model, file_path, language="en", timings=None):
+    """
+    Transcribes a single audio file with a loaded Whisper model.
+
+    Parameters:
+        model: A loaded Whisper model.
+        file_path (str): Path to the audio file.
+        language (str): Language code for the transcription (e.g., "en" for English).
+        timings (dict, optional): If given, filled with the length of the recording ("audio_seconds") and
+            the time taken to decode and transcribe it ("processing_seconds").
+
+    Returns:
+        str: The transcript text.
+    """
+    if timings is None:
+        return model.transcribe(file_path, language=language)['text']
+    start = time.perf_counter()
+    # Decode the audio here rather than inside transcribe, so its length is known at no extra cost
+    audio = whisper.load_audio(file_path)
+    text = model.transcribe(audio, language=language)['text']
+    timings["audio_seconds"] = len(audio) / whisper.audio.SAMPLE_RATE
+    timings["processing_seconds"] = time.perf_counter() - start
+    return text
+
+def transcribe_file(model, file_path, language="en", output_folder="transcripts", timings=None):
+    """
+    Transcribes a single audio file with a loaded Whisper model and saves the transcript as a text file.
+
+    Parameters:
+        model: A loaded Whisper model.
+        file_path (str): Path to the audio file.
+        language (str): Language code for the transcription (e.g., "en" for English).
+        output_folder (str): Path to the folder where the transcription will be saved.
+        timings (dict, optional): Filled with the audio and processing seconds, as in transcribe_audio.
+
+    Returns:
+        str: The name of the transcript file.
+    """
+    # Transcribe the audio file
+    text = transcribe_audio(model, file_path, language=language, timings=timings)
+
+    # Generate output filename
+    output_filename = transcript_filename(os.path.basename(file_path))
+    output_path = os.path.join(output_folder, output_filename)
+
+    # Save the transcription to a text file (atomically, so a crash never leaves a partial file)
+    atomic_write(output_path, text)
+    return output_filename
+
+#################################### Segmented Transcription ########################################
+def split_on_silence(
+    audio,
+    sample_rate=16000,
+    frame_seconds=0.03,
+    silence_db=-35.0,
+    floor_db=-70.0,
+    min_silence_seconds=0.4,
+    max_segment_seconds=30.0,
+    padding_seconds=0.2
+):
+    """
+    Split a recording into speech segments at pauses, using the energy of short frames (no model needed).
+
+    A frame is silent when its energy is more than silence_db below the loudest frame of the recording,
+    or below floor_db in absolute terms (full scale = 0 dB).
+    Pauses of at least min_silence_seconds are candidate cut points, and speech is packed into segments of
+    up to max_segment_seconds (Whisper's 30-second window) between them; speech without a long enough pause
+    is cut at its quietest frame. Silence at the edges of each segment is trimmed to padding_seconds, and
+    segments with no speech at all are dropped.
+
+    Parameters:
+        audio (numpy.ndarray): Mono samples, e.g. from whisper.load_audio.
+        sample_rate (int): Samples per second (default: 16000, Whisper's rate).
+        frame_seconds (float): Length of the energy frames (default: 0.03).
+        silence_db (float): Silence threshold relative to the loudest frame, in dB (default: -35).
+        floor_db (float): Frames below this absolute level are always silent, in dB (default: -70).
+        min_silence_seconds (float): Shortest pause to cut at (default: 0.4).
+        max_segment_seconds (float): Longest segment (default: 30).
+        padding_seconds (float): Silence kept around the speech of each segment (default: 0.2).
+
+    Returns:
+        list of tuple: The (start, end) sample offsets of each segment, in order.
+    """
+    frame = max(1, int(frame_seconds * sample_rate))
+    count = len(audio) // frame
+    if count == 0:
+        return [(0, len(audio))] if len(audio) else []
+    frames = np.asarray(audio[:count * frame], dtype=np.float32).reshape(count, frame)
+    energy = 10 * np.log10(np.mean(frames ** 2, axis=1) + 1e-10)
+    voiced = (energy >= energy.max() + silence_db) & (energy >= floor_db)
+    if not voiced.any():
+        return []
+
+    # Cut points: the middle of every pause that is long enough
+    min_silence = max(1, int(round(min_silence_seconds / frame_seconds)))
+    cuts = []
+    run_start = None
+    for index, is_voiced in enumerate(np.append(voiced, True)):
+        if not is_voiced and run_start is None:
+            run_start = index
+        elif is_voiced and run_start is not None:
+            if index - run_start >= min_silence:
+                cuts.append((run_start + index) // 2)
+            run_start = None
+
+    # Pack the speech between cut points into segments of at most max_segment frames
+    max_segment = max(1, int(max_segment_seconds / frame_seconds))
+    segments = []
+    start = 0
+    while start < count:
+        end = min(start + max_segment, count)
+        if end < count:
+            fitting = [cut for cut in cuts if start < cut <= end]
+            # No pause within reach: cut at the quietest frame of the second half of the window
+            end = fitting[-1] if fitting else start + max_segment // 2 + int(np.argmin(energy[start + max_segment // 2:end]))
+        speech = np.flatnonzero(voiced[start:end])
+        if len(speech):
+            padding = int(padding_seconds / frame_seconds)
+            first = max(start, start + speech[0] - padding)
+            last = min(end, start + speech[-1] + 1 + padding)
+            segments.append((first * frame, len(audio) if last == count else last * frame))
+        start = end
+    return segments
+
+def decode_segment(model, audio, language="en", word_timestamps=True):
+    """
+    Transcribe one segment and keep its text and Whisper's segment and word timestamps.
+
+    Returns:
+        dict: "text", and "segments" with the "start", "end", "text" and (with word_timestamps) "words"
+            of each Whisper segment, in seconds from the start of the audio given.
+    """
+    result = model.transcribe(audio, language=language, word_timestamps=word_timestamps)
+    segments = []
+    for segment in result.get("segments", []):
+        entry = {"start": float(segment["start"]), "end": float(segment["end"]), "text": segment["text"]}
+        if word_timestamps:
+            entry["words"] = [
+                {
+                    "word": word["word"], "start": float(word["start"]), "end": float(word["end"]),
+                    "probability": float(word.get("probability", 0.0)),
+                }
+                for word in segment.get("words", [])
+            ]
+        segments.append(entry)
+    return {"text": result["text"], "segments": segments}
+
+def _shift(segment, offset):
+    # Move a decoded segment's timestamps from segment time to recording time
+    shifted = {**segment, "start": segment["start"] + offset, "end": segment["end"] + offset}
+    if "words" in segment:
+        shifted["words"] = [
+            {**word, "start": word["start"] + offset, "end": word["end"] + offset} for word in segment["words"]
+        ]
+    return shifted
+
+def transcribe_file_segmented(
+    model,
+    file_path,
+    language="en",
+    output_folder="transcripts",
+    timings=None,
+    executor=None,
+    word_timestamps=True,
+    vad_options=None
+):
+    """
+    Transcribe an audio file segment by segment, streaming the transcript to disk as segments complete.
+
+    The recording is split at pauses (see split_on_silence) and the segments are decoded in order, or in
+    parallel on a worker pool. Each segment's text is appended to "<transcript>.partial" as soon as it and
+    every segment before it are done, so the start of a long visit can be read within seconds; the file is
+    renamed to the final transcript name once the whole recording is done. Segment and word timestamps,
+    relative to the start of the recording, are saved next to the transcript (see segments_filename).
+
+    Parameters:
+        model: A loaded Whisper model (unused, and may be None, when executor is given).
+        file_path (str): Path to the audio file.
+        language (str): Language code for the transcription (e.g., "en" for English).
+        output_folder (str): Path to the folder where the transcript and sidecar will be saved.
+        timings (dict, optional): Filled with "audio_seconds", "processing_seconds" and "chunks" (segments).
+        executor (ProcessPoolExecutor, optional): A pool from start_worker_pool that decodes the segments.
+        word_timestamps (bool): Also keep per-word timestamps (default: True).
+        vad_options (dict, optional): Keyword arguments for split_on_silence.
+
+    Returns:
+        str: The name of the transcript file.
+    """
+    start = time.perf_counter()
+    audio = whisper.load_audio(file_path)
+    sample_rate = whisper.audio.SAMPLE_RATE
+    spans = split_on_silence(audio, sample_rate=sample_rate, **(vad_options or {}))
+
+    if executor is None:
+        results = (decode_segment(model, audio[first:last], language, word_timestamps) for first, last in spans)
+    else:
+        # Submitted all at once, but collected in order, so the partial transcript is always a prefix
+        futures = [
+            executor.submit(_decode_segment_in_worker, audio[first:last], language, word_timestamps)
+            for first, last in spans
+        ]
+        results = (future.result() for future in futures)
+
+    output_filename = transcript_filename(os.path.basename(file_path))
+    output_path = os.path.join(output_folder, output_filename)
+    partial_path = output_path + ".partial"
+    sidecar = {"file": os.path.basename(file_path), "audio_seconds": len(audio) / sample_rate, "segments": []}
+    try:
+        with open(partial_path, "w", encoding="utf-8") as partial:
+            for (first, last), result in zip(spans, results):
+                partial.write(result["text"])
+                partial.flush()
+                if "first_text_seconds" not in sidecar:
+                    sidecar["first_text_seconds"] = time.perf_counter() - start
+                offset = first / sample_rate
+                sidecar["segments"].append({
+                    "start": offset,
+                    "end": last / sample_rate,
+                    "text": result["text"],
+                    "segments": [_shift(segment, offset) for segment in result["segments"]],
+                })
+            os.fsync(partial.fileno())
+    except BaseException:
+        if executor is not None:
+            for future in futures:
+                future.cancel()
+        raise
+
+    # The sidecar is in place before the transcript, so a finished transcript always has its timestamps
+    atomic_write(os.path.join(output_folder, segments_filename(os.path.basename(file_path))), json.dumps(sidecar))
+    os.replace(partial_path, output_path)
+    if timings is not None:
+        timings["audio_seconds"] = sidecar["audio_seconds"]
+        timings["processing_seconds"] = time.perf_counter() - start
+        timings["chunks"] = len(spans)
+    return output_filename
+
+#################################### Worker Pool ########################################
+def _init_worker(model_name, threads_per_worker):
+    global _worker_model
+    import torch
+    # Limit intra-op threads so that the workers together do not oversubscribe the cores
+    torch.set_num_threads(threads_per_worker)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # Inter-op threads can only be set before any parallel work has started
+        pass
+    _worker_model = whisper.load_model(model_name)
+
+def _transcribe_in_worker(file_path, language, output_folder):
+    timings = {}
+    output_filename = transcribe_file(
+        _worker_model, file_path, language=language, output_folder=output_folder, timings=timings
+    )
+    return output_filename, timings
+
+def transcribe_audio_in_worker(file_path, language):
+    """
+    Transcribes a single audio file with the Whisper model of the worker process running it. Submit it to
+    a pool from start_worker_pool.
+
+    Parameters:
+        file_path (str): Path to the audio file.
+        language (str): Language code for the transcription (e.g., "en" for English).
+
+    Returns:
+        str: The transcript text.
+    """
+    return transcribe_audio(_worker_model, file_path, language=language)
+
+def _decode_segment_in_worker(audio, language, word_timestamps):
+    return decode_segment(_worker_model, audio, language=language, word_timestamps=word_timestamps)
+
+def start_worker_pool(model_name="base", num_workers=2, threads_per_worker=None):
+    """
+    Start a pool of worker processes that each hold a loaded Whisper model.
+
+    Parameters:
+        model_name (str): Whisper model to load in every worker.
+        num_workers (int): Number of worker processes.
+        threads_per_worker (int, optional): Intra-op threads per worker. Defaults to the CPU count divided
+            by num_workers.
+
+    Returns:
+        ProcessPoolExecutor: The pool. Submit transcribe_audio_in_worker to it to get a recording's transcript.
+    """
+    threads_per_worker = threads_per_worker or max(1, (os.cpu_count() or 1) // num_workers)
+    # Spawned workers start clean instead of inheriting the parent's torch thread pools
+    return ProcessPoolExecutor(
+        max_workers=num_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(model_name, threads_per_worker)
+    )
+
+def _transcribe_with_pool(file_paths, model_name, language, output_folder, num_workers, threads_per_worker, on_done,
+                          on_failed):
+    failures = {}
+    with start_worker_pool(model_name, num_workers, threads_per_worker) as executor:
+        # Files are submitted largest first; idle workers pull the next one from the shared queue
+        futures = {
+            executor.submit(_transcribe_in_worker, file_path, language, output_folder): file_path
+            for file_path in file_paths
+        }
+        for future in as_completed(futures):
+            filename = os.path.basename(futures[future])
+            try:
+                output_filename, timings = future.result()
+            except Exception as error:
+                failures[filename] = f"{type(error).__name__}: {error}"
+                print(f"Failed to transcribe '{filename}': {failures[filename]}")
+                on_failed(futures[future], error)
+            else:
+                on_done(futures[future], output_filename, timings)
+                print(f"Transcribed '{filename}' and saved as '{output_filename}'")
+    return failures
+
+#################################### Main Function ########################################
+def transcribe_folder(
+    input_folder,
+    model_name="base",
+    language="en",
+    output_folder="transcripts",
+    num_workers=1,
+    threads_per_worker=None,
+    resume=True,
+    telemetry=None,
+    segmented=False,
+    word_timestamps=True,
+    vad_options=None
+):
     """
     Transcribes each audio file in the input folder using Whisper and saves the transcript as a text file.
-    
+
     Parameters:
         input_folder (str): Path to the folder containing audio files.
         model_name (str): Whisper model to use ("tiny", "base", "small", "medium", "large").
         language (str): Language code for the transcription (e.g., "en" for English).
         output_folder (str): Path to the folder where transcriptions will be saved.
-    """
-    # Load the Whisper model
-    model = whisper.load_model(model_name)
+        num_workers (int): Number of worker processes. With 1 (the default) files are transcribed one after
+            another in this process. With more, each worker loads the model once and takes files from a
+            shared queue, largest first; a file that fails is reported without stopping the others.
+        threads_per_worker (int, optional): Intra-op threads per worker. Defaults to the CPU count divided
+            by num_workers.
+        resume (bool): Skip audio files whose content and parameters match a finished entry in the output
+            folder's manifest, so an interrupted or repeated run only transcribes what is left (default: True).
+        telemetry (Telemetry, optional): Records the audio length, processing time and real-time factor per file.
+        segmented (bool): Split each recording at pauses and stream its transcript to disk segment by segment,
+            with a JSON sidecar of segment and word timestamps (see transcribe_file_segmented). Files are then
+            taken one at a time and, with more than one worker, their segments are decoded in parallel, so
+            the first text of each recording is available within seconds (default: False).
+        word_timestamps (bool): With segmented, also keep per-word timestamps (default: True).
+        vad_options (dict, optional): With segmented, keyword arguments for split_on_silence.
 
+    Returns:
+        dict: Files that failed to transcribe, mapped to their error message (always empty with one worker,
+            where errors are raised).
+    """
     # Create output folder if it doesn't exist
     os.makedirs(output_folder, exist_ok=True)
-    
-    # Iterate over each file in the input folder
-    for filename in os.listdir(input_folder):
-        file_path = os.path.join(input_folder, filename)
-        
-        # Check if the file is an audio file 
-        if filename.lower().endswith(('.wav', '.mp3', '.m4a', '.flac', '.ogg')):
-            # Transcribe the audio file
-            result = model.transcribe(file_path, language=language)
-            
-            # Generate output filename
-            output_filename = os.path.splitext(filename)[0] + "_raw_transcript.txt"
-            output_path = os.path.join(output_folder, output_filename)
-            
-            # Save the transcription to a text file
-            with open(output_path, "w", encoding="utf-8") as f:
-                f.write(result['text'])
-                
-            print(f"Transcribed '{filename}' and saved as '{output_filename}'")
-
-    print("Transcription completed for all audio files.")
\ No newline at end of file
+
+    # Collect the audio files in the input folder
+    file_paths = [
+        os.path.join(input_folder, filename) for filename in os.listdir(input_folder)
+        if filename.lower().endswith(AUDIO_EXTENSIONS)
+    ]
+
+    # Skip files already transcribed with the same model and language
+    manifest = StageManifest(output_folder, "transcribe")
+    params = {"model_name": model_name, "language": language}
+    if segmented:
+        params.update(segmented=True, word_timestamps=word_timestamps, vad_options=vad_options or {})
+    params_hash = params_fingerprint(params)
+    input_hashes = {file_path: file_sha256(file_path) for file_path in file_paths}
+    if resume:
+        pending = []
+        for file_path in file_paths:
+            if manifest.is_complete(os.path.basename(file_path), input_hashes[file_path], params_hash):
+                print(f"Skipping '{os.path.basename(file_path)}': already transcribed with the same parameters")
+                if telemetry is not None:
+                    telemetry.record_file("transcribe", os.path.basename(file_path), status="skipped")
+            else:
+                pending.append(file_path)
+        file_paths = pending
+
+    def on_done(file_path, output_filename, timings):
+        manifest.record(
+            os.path.basename(file_path), input_hashes[file_path], params_hash,
+            os.path.join(output_folder, output_filename)
+        )
+        if telemetry is not None:
+            # Whole-file decoding leaves "chunks" unset; the timings themselves are left as they are
+            telemetry.record_file(
+                "transcribe", os.path.basename(file_path),
+                wall_seconds=timings["processing_seconds"], **{"chunks": 1, **timings}
+            )
+
+    def on_failed(file_path, error):
+        if telemetry is not None:
+            telemetry.record_file("transcribe", os.path.basename(file_path), status="failed", error=type(error).__name__)
+
+    failures = {}
+    if segmented and file_paths:
+        # One file at a time, its segments spread over the pool (or decoded here with one worker)
+        executor = start_worker_pool(model_name, num_workers, threads_per_worker) if num_workers > 1 else None
+        model = whisper.load_model(model_name) if executor is None else None
+        try:
+            for file_path in file_paths:
+                filename = os.path.basename(file_path)
+                timings = {}
+                try:
+                    output_filename = transcribe_file_segmented(
+                        model, file_path, language=language, output_folder=output_folder, timings=timings,
+                        executor=executor, word_timestamps=word_timestamps, vad_options=vad_options
+                    )
+                except Exception as error:
+                    on_failed(file_path, error)
+                    if executor is None:
+                        raise
+                    failures[filename] = f"{type(error).__name__}: {error}"
+                    print(f"Failed to transcribe '{filename}': {failures[filename]}")
+                    continue
+                on_done(file_path, output_filename, timings)
+                print(f"Transcribed '{filename}' in {timings['chunks']} segment(s) and saved as '{output_filename}'")
+        finally:
+            if executor is not None:
+                executor.shutdown()
+    elif num_workers > 1:
+        # Largest files first, so a long recording does not start last and hold up the run
+        file_paths.sort(key=os.path.getsize, reverse=True)
+        failures = _transcribe_with_pool(
+            file_paths, model_name, language, output_folder, num_workers, threads_per_worker, on_done, on_failed
+        )
+    elif file_paths:
+        # Load the Whisper model
+        model = whisper.load_model(model_name)
+        for file_path in file_paths:
+            timings = {}
+            try:
+                output_filename = transcribe_file(
+                    model, file_path, language=language, output_folder=output_folder, timings=timings
+                )
+            except Exception as error:
+                on_failed(file_path, error)
+                raise
+            on_done(file_path, output_filename, timings)
+            print(f"Transcribed '{os.path.basename(file_path)}' and saved as '{output_filename}'")
+
+    if failures:
+        print(f"Transcription completed with {len(failures)} failed file(s): {', '.join(sorted(failures))}")
+    else:
+        print("Transcription completed for all audio files.")
+    return failures